@@ -0,0 +1,224 @@
+#Libraries
+import json
+import os
+import sys
+import time
+from collections import OrderedDict
+
+from metadata_transformer import load_compiled_metadata, to_qiime_metadata
+from pipeline_cache import artifact_uuid, file_digest
+
+
+#This script caches loaded artifacts and metadata for the step scripts.
+#Within one process (e.g. a script loading the same table for several actions) loaded
+#objects are kept in a memory-bounded LRU cache keyed on the artifact UUID or
+#the content hash of the metadata file. Across runs, artifacts are kept
+#extracted in a QIIME 2 cache directory, so loading them again does not unzip
+#the archive. The cache directory is bounded as well: the size and last use
+#of every entry are tracked next to it, and the least recently used entries
+#are removed once the budget is exceeded. Large one-off artifacts (the
+#taxonomy classifier) are not extracted into it.
+
+
+
+#Repository root and the on-disk cache (ARTIFACT_CACHE_DIR="" disables it)
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+DISK_CACHE_DIR = os.environ.get("ARTIFACT_CACHE_DIR", os.path.join(ROOT_DIR, ".artifact_cache"))
+
+#Memory budget of the in-process cache
+MAX_MEMORY_MB = int(os.environ.get("ARTIFACT_CACHE_MB", 2048))
+
+#Size budget of the on-disk cache and the largest artifact (.qza size) it takes
+MAX_DISK_MB = int(os.environ.get("ARTIFACT_DISK_CACHE_MB", 8192))
+MAX_DISK_ARTIFACT_MB = int(os.environ.get("ARTIFACT_DISK_CACHE_MAX_ARTIFACT_MB", 1024))
+
+
+class LRUCache:
+    '''
+    Least recently used cache bounded by the estimated size of its entries.
+    An entry larger than the whole budget is returned but not kept.
+    '''
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, key: str, value, size: int) -> None:
+        if key in self.entries:
+            self.n_bytes -= self.entries.pop(key)[1]
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (value, size)
+        self.n_bytes += size
+        while self.n_bytes > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.n_bytes -= evicted_size
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.n_bytes = 0
+
+
+_memory_cache = LRUCache(MAX_MEMORY_MB * 1024 * 1024)
+_disk_cache = None
+
+
+def disk_cache():
+    '''Returns the QIIME 2 cache used across runs, None if it is disabled.'''
+    global _disk_cache
+    if not DISK_CACHE_DIR:
+        return None
+    if _disk_cache is None:
+        from qiime2.core.cache import Cache
+        _disk_cache = Cache(DISK_CACHE_DIR)
+    return _disk_cache
+
+
+def _cache_key(uuid: str) -> str:
+    #Keys of the QIIME 2 cache have to be valid Python identifiers
+    return "a_" + uuid.replace("-", "_")
+
+
+def _entry_size(cache, key: str) -> int:
+    #Size of the extracted payload of a cache entry in bytes
+    data_dir = os.path.join(str(cache.path), "data", key[2:].replace("_", "-"))
+    return sum(os.path.getsize(os.path.join(dirpath, name))
+               for dirpath, _, names in os.walk(data_dir) for name in names)
+
+
+def record_disk_use(cache, key: str, max_bytes: int = MAX_DISK_MB * 1024 * 1024) -> list:
+    '''
+    Marks a cache entry as used and removes the least recently used other
+    entries while the on-disk cache is larger than max_bytes.
+        Parameters:
+        ----------
+        cache : qiime2.core.cache.Cache
+            The on-disk cache
+        key : str
+            Key of the entry that was just loaded or saved
+        max_bytes : int
+            Size budget of the cache directory
+        Returns:
+        -------
+        list
+            Keys of the removed entries
+    '''
+    usage_fp = str(cache.path).rstrip(os.sep) + ".usage.json"
+    usage = {}
+    if os.path.exists(usage_fp):
+        with open(usage_fp) as fh:
+            usage = json.load(fh)
+
+    #Entries saved before the tracking started count as the oldest ones
+    keys = set(cache.get_keys())
+    usage = {name: entry for name, entry in usage.items() if name in keys}
+    for name in keys - set(usage):
+        usage[name] = {"bytes": _entry_size(cache, name), "last_used": 0}
+    usage[key] = {"bytes": usage.get(key, {}).get("bytes") or _entry_size(cache, key), "last_used": time.time()}
+
+    removed = []
+    total = sum(entry["bytes"] for entry in usage.values())
+    for name in sorted(usage, key=lambda name: usage[name]["last_used"]):
+        if total <= max_bytes:
+            break
+        if name == key:
+            continue
+        cache.remove(name)
+        total -= usage.pop(name)["bytes"]
+        removed.append(name)
+    if removed:
+        cache.garbage_collection()
+
+    with open(usage_fp + ".tmp", "w") as fh:
+        json.dump(usage, fh, indent=2, sort_keys=True)
+    os.replace(usage_fp + ".tmp", usage_fp)
+    return removed
+
+
+def load_artifact(artifact_fp: str, disk: bool = True):
+    '''
+    Loads an artifact, reusing an already loaded or extracted copy with the same UUID.
+        Parameters:
+        ----------
+        artifact_fp : str
+            File path of the .qza
+        disk : bool
+            Keep the artifact extracted in the on-disk cache (False for one-off
+            artifacts; artifacts above MAX_DISK_ARTIFACT_MB are never kept)
+        Returns:
+        -------
+        qiime2.Artifact
+    '''
+    from qiime2 import Artifact
+
+    uuid = artifact_uuid(artifact_fp)
+    artifact = _memory_cache.get(uuid)
+    if artifact is not None:
+        return artifact
+
+    cache = disk_cache()
+    if not disk or os.path.getsize(artifact_fp) > MAX_DISK_ARTIFACT_MB * 1024 * 1024:
+        cache = None
+    key = _cache_key(uuid)
+    if cache is not None and key in cache.get_keys():
+        artifact = cache.load(key)
+        record_disk_use(cache, key)
+    else:
+        artifact = Artifact.load(artifact_fp)
+        if cache is not None:
+            artifact = cache.save(artifact, key)
+            record_disk_use(cache, key)
+
+    # The extracted payload is on disk, the zip size is a fair estimate of what a view costs
+    _memory_cache.put(uuid, artifact, os.path.getsize(artifact_fp))
+    return artifact
+
+
+def load_metadata(metadata_fp: str):
+    '''
+    Loads sample metadata, parsed once per process for the same file content.
+    Metadata compiled by metadata_transformer.py is taken from its binary cache.
+        Parameters:
+        ----------
+        metadata_fp : str
+            File path of the metadata TSV
+        Returns:
+        -------
+        qiime2.Metadata
+    '''
+    from qiime2 import Metadata
+
+    digest = file_digest(metadata_fp)
+    key = "sha256:" + digest
+    metadata = _memory_cache.get(key)
+    if metadata is None:
+        compiled = load_compiled_metadata(metadata_fp, digest)
+        metadata = Metadata.load(metadata_fp) if compiled is None else to_qiime_metadata(compiled)
+        size = int(metadata.to_dataframe().memory_usage(deep=True).sum())
+        _memory_cache.put(key, metadata, size)
+    return metadata
+
+
+def cache_info() -> dict:
+    '''Returns the hits, misses, entries and memory use of the in-process cache.'''
+    return {"hits": _memory_cache.hits, "misses": _memory_cache.misses,
+            "entries": len(_memory_cache.entries), "bytes": _memory_cache.n_bytes}
+
+
+# --- EXECUTION BLOCK ---
+if __name__ == '__main__':
+    # in command line: python artifact_cache.py <file.qza> ... (pre-extracts artifacts into the disk cache)
+    for fp in sys.argv[1:]:
+        load_artifact(fp)
+        print("Cached %s (%s)" % (fp, artifact_uuid(fp)))
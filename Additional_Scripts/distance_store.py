@@ -0,0 +1,292 @@
+#Libraries
+import argparse
+import glob
+import mmap
+import os
+import struct
+
+import numpy as np
+
+
+#This script stores distance matrices in a compact binary format (.cdm):
+#only the condensed upper triangle (row by row, without the diagonal) is
+#kept, as little-endian float32, after a small header and the sample IDs.
+#A .cdm file is memory mapped, so readers only touch the pages of the
+#distances they use (e.g. the rows of a subset of samples), and a matrix of
+#20k samples takes ~800 MB instead of several GB of TSV text per metric.
+#
+#Layout:
+#   magic b'CDM2' | uint32 header size | uint64 number of samples |
+#   uint64 size of the ID block | source UUID (36 bytes, zero padded) |
+#   IDs (UTF-8, newline separated) | zero padding to 8 bytes |
+#   float32 distances (n * (n - 1) / 2)
+#
+#The source UUID is the UUID of the DistanceMatrix artifact the file was
+#converted from; a .cdm next to a .qza is only used if it belongs to that
+#artifact. Files of the first version (b'CDM1', no source) are still read.
+#Conversion from and to DistanceMatrix .qza is lossless at float32 precision.
+
+
+
+MAGIC = b'CDM2'
+LEGACY_MAGIC = b'CDM1'
+HEADER = struct.Struct('<4sIQQ')
+SOURCE = struct.Struct('<36s')
+
+#Suffix of the compact files, written next to <metric>_distance_matrix.qza
+SUFFIX = '.cdm'
+
+#Rows written per chunk when converting a square matrix
+WRITE_ROWS = 1024
+
+
+def compact_fp(qza_fp: str) -> str:
+    '''Returns the file path of the compact file belonging to a distance matrix .qza.'''
+    return os.path.splitext(qza_fp)[0] + SUFFIX
+
+
+def condensed_index(n: int, rows: np.ndarray, columns: np.ndarray) -> np.ndarray:
+    '''Returns the positions of the pairs (row, column), row != column, in the condensed triangle.'''
+    low = np.minimum(rows, columns).astype(np.int64)
+    high = np.maximum(rows, columns).astype(np.int64)
+    return n * low - low * (low + 1) // 2 + high - low - 1
+
+
+def write_condensed(output_fp: str, distances: np.ndarray, ids: list, source: str = None) -> str:
+    '''
+    Writes a square distance matrix in the compact format.
+        Parameters:
+        ----------
+        output_fp : str
+            File path of the .cdm file
+        distances : np.ndarray
+            Square, symmetric distance matrix (or a condensed vector)
+        ids : list
+            Sample IDs in the order of the rows
+        source : str
+            UUID of the DistanceMatrix artifact the distances come from (None if there is none)
+        Returns:
+        -------
+        str
+            File path of the written file
+    '''
+    n = len(ids)
+    id_block = '\n'.join(str(sample_id) for sample_id in ids).encode('utf-8')
+    header_size = HEADER.size + SOURCE.size
+    padding = (-(header_size + len(id_block))) % 8
+    tmp_fp = output_fp + '.tmp'
+    with open(tmp_fp, 'wb') as of:
+        of.write(HEADER.pack(MAGIC, header_size, n, len(id_block)))
+        of.write(SOURCE.pack((source or '').encode('ascii')))
+        of.write(id_block)
+        of.write(b'\0' * padding)
+        distances = np.asarray(distances)
+        if distances.ndim == 1:
+            if len(distances) != n * (n - 1) // 2:
+                raise ValueError(f"condensed vector of length {len(distances)} does not match {n} IDs")
+            of.write(distances.astype('<f4').tobytes())
+        else:
+            if distances.shape != (n, n):
+                raise ValueError(f"matrix of shape {distances.shape} does not match {n} IDs")
+            for start in range(0, n, WRITE_ROWS):
+                of.write(b''.join(distances[i, i + 1:].astype('<f4').tobytes()
+                                  for i in range(start, min(start + WRITE_ROWS, n))))
+    os.replace(tmp_fp, output_fp)
+    return output_fp
+
+
+class CondensedMatrix:
+    '''
+    Memory mapped distance matrix in the compact format.
+    Use as context manager; .condensed is a float32 view into the file.
+    '''
+
+    def __init__(self, cdm_fp: str):
+        self.fp = cdm_fp
+        with open(cdm_fp, 'rb') as fh:
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_size, n, id_size = HEADER.unpack_from(self._mmap, 0)
+        if magic not in (MAGIC, LEGACY_MAGIC):
+            self._mmap.close()
+            raise ValueError(f"{cdm_fp} is not a compact distance matrix")
+        self.n = n
+        self.source = None
+        if magic == MAGIC:
+            self.source = SOURCE.unpack_from(self._mmap, HEADER.size)[0].rstrip(b'\0').decode('ascii') or None
+        id_block = self._mmap[header_size:header_size + id_size].decode('utf-8')
+        self.ids = id_block.split('\n') if n else []
+        offset = header_size + id_size
+        offset += (-offset) % 8
+        self.condensed = np.frombuffer(self._mmap, dtype='<f4', count=n * (n - 1) // 2, offset=offset)
+        self._positions = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        self.condensed = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            # A reference to .condensed held elsewhere keeps the map alive
+            pass
+
+    def __reduce__(self):
+        # Worker processes map the file themselves instead of receiving the distances
+        return (CondensedMatrix, (self.fp,))
+
+    def index_of(self, ids) -> np.ndarray:
+        '''Returns the row positions of sample IDs.'''
+        if self._positions is None:
+            self._positions = {sample_id: position for position, sample_id in enumerate(self.ids)}
+        return np.array([self._positions[sample_id] for sample_id in ids], dtype=np.int64)
+
+    def row(self, i: int, dtype=np.float64) -> np.ndarray:
+        '''Returns the distances of sample i to all samples.'''
+        columns = np.arange(self.n)
+        values = np.zeros(self.n, dtype=dtype)
+        others = columns != i
+        values[others] = self.condensed[condensed_index(self.n, np.full(self.n - 1, i), columns[others])]
+        return values
+
+    def rows(self, start: int, stop: int, dtype=np.float64) -> np.ndarray:
+        '''Returns the distances of the samples start..stop-1 to all samples (a block of rows).'''
+        block = np.zeros((stop - start, self.n), dtype=dtype)
+        for i in range(start, stop):
+            # Left of the diagonal: column i of the earlier rows; right of it: one contiguous run
+            if i > 0:
+                block[i - start, :i] = self.condensed[condensed_index(self.n, np.arange(i), np.full(i, i))]
+            first = condensed_index(self.n, np.array([i]), np.array([i + 1]))[0] if i + 1 < self.n else 0
+            block[i - start, i + 1:] = self.condensed[first:first + self.n - i - 1]
+        return block
+
+    def submatrix(self, index, dtype=np.float64) -> np.ndarray:
+        '''Returns the square matrix of the samples at the given positions (only their distances are read).'''
+        index = np.asarray(index, dtype=np.int64)
+        rows, columns = np.triu_indices(len(index), k=1)
+        square = np.zeros((len(index), len(index)), dtype=dtype)
+        values = self.condensed[condensed_index(self.n, index[rows], index[columns])]
+        square[rows, columns] = values
+        square[columns, rows] = values
+        return square
+
+    def square(self, dtype=np.float64) -> np.ndarray:
+        '''Returns the full square matrix.'''
+        from scipy.spatial.distance import squareform
+
+        return squareform(self.condensed.astype(dtype), checks=False)
+
+
+class DenseMatrix:
+    '''Square distance matrix in memory with the reading interface of CondensedMatrix.'''
+
+    def __init__(self, distances: np.ndarray, ids: list):
+        self.distances = distances
+        self.ids = list(ids)
+        self.n = len(self.ids)
+        self._positions = None
+
+    index_of = CondensedMatrix.index_of
+
+    def row(self, i: int, dtype=np.float64) -> np.ndarray:
+        return self.distances[i].astype(dtype)
+
+    def rows(self, start: int, stop: int, dtype=np.float64) -> np.ndarray:
+        return self.distances[start:stop].astype(dtype)
+
+    def submatrix(self, index, dtype=np.float64) -> np.ndarray:
+        return self.distances[np.ix_(index, index)].astype(dtype)
+
+    def square(self, dtype=np.float64) -> np.ndarray:
+        return self.distances.astype(dtype)
+
+
+def open_matrix(fp: str):
+    '''
+    Opens a distance matrix for reading: a .cdm file (or the .cdm next to a
+    .qza, if it was converted from that artifact) is memory mapped, a .qza is
+    read into memory.
+        Parameters:
+        ----------
+        fp : str
+            File path of a .cdm or DistanceMatrix .qza
+        Returns:
+        -------
+        CondensedMatrix or DenseMatrix
+    '''
+    from pipeline_cache import artifact_uuid
+    from qza_io import read_distance_matrix
+
+    if fp.endswith(SUFFIX):
+        return CondensedMatrix(fp)
+    if os.path.exists(compact_fp(fp)):
+        matrix = CondensedMatrix(compact_fp(fp))
+        if matrix.source is not None:
+            current = matrix.source == artifact_uuid(fp)
+        else:
+            # Files without a source (first version): not older than the .qza
+            current = os.path.getmtime(compact_fp(fp)) >= os.path.getmtime(fp)
+        if current:
+            return matrix
+        matrix.close()
+    return DenseMatrix(*read_distance_matrix(fp))
+
+
+def read_compact(cdm_fp: str, dtype=np.float64) -> tuple:
+    '''Returns (square array, sample IDs) of a .cdm file, like qza_io.read_distance_matrix.'''
+    with CondensedMatrix(cdm_fp) as matrix:
+        return matrix.square(dtype), list(matrix.ids)
+
+
+def qza_to_compact(qza_fp: str, cdm_fp: str = None) -> str:
+    '''Converts a DistanceMatrix .qza into the compact format.'''
+    from pipeline_cache import artifact_uuid
+    from qza_io import read_distance_matrix
+
+    distances, ids = read_distance_matrix(qza_fp)
+    return write_condensed(cdm_fp or compact_fp(qza_fp), distances, ids, artifact_uuid(qza_fp))
+
+
+def artifact_to_compact(artifact, cdm_fp: str) -> str:
+    '''Writes a loaded DistanceMatrix artifact in the compact format.'''
+    from skbio import DistanceMatrix
+
+    distance_matrix = artifact.view(DistanceMatrix)
+    return write_condensed(cdm_fp, distance_matrix.condensed_form(), list(distance_matrix.ids), str(artifact.uuid))
+
+
+def compact_to_qza(cdm_fp: str, qza_fp: str) -> str:
+    '''Converts a compact file back into a DistanceMatrix .qza (float32 values).'''
+    from qiime2 import Artifact
+    from skbio import DistanceMatrix
+
+    distances, ids = read_compact(cdm_fp)
+    Artifact.import_data('DistanceMatrix', DistanceMatrix(distances, ids)).save(qza_fp)
+    return qza_fp
+
+
+# --- EXECUTION BLOCK ---
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert distance matrices between .qza and the compact .cdm format.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    to_cdm = subparsers.add_parser('to-cdm', help='.qza -> .cdm (a directory converts all *_distance_matrix.qza)')
+    to_cdm.add_argument('input')
+    to_cdm.add_argument('output', nargs='?', default=None)
+    to_qza = subparsers.add_parser('to-qza', help='.cdm -> .qza')
+    to_qza.add_argument('input')
+    to_qza.add_argument('output')
+    args = parser.parse_args()
+
+    if args.command == 'to-cdm':
+        inputs = (sorted(glob.glob(os.path.join(args.input, '*_distance_matrix.qza')))
+                  if os.path.isdir(args.input) else [args.input])
+        for qza_fp in inputs:
+            cdm_fp = qza_to_compact(qza_fp, args.output if len(inputs) == 1 else None)
+            print(f"{qza_fp} -> {cdm_fp} ({os.path.getsize(cdm_fp) / 1e6:.1f} MB)")
+    else:
+        print(f"{args.input} -> {compact_to_qza(args.input, args.output)}")
+
+# in command line: python distance_store.py to-cdm ../Step7_PhylogeneticTree/core_diversity_results/core_metrics
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+#Libraries
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+#This script replaces Data/20241209-raw_data/check_md5.sh. It reads the same
+#md5 list of the sequencing provider, hashes the files in a thread pool with
+#large chunked reads and remembers the checksums of verified files (keyed on
+#path, size and modification time) so untouched files are not hashed again.
+
+
+
+#Read size for hashing (hashlib releases the GIL for large buffers)
+CHUNK_SIZE = 8 * 1024 * 1024
+
+#Name of the checksum cache written into the data directory
+CACHE_FN = ".md5_cache.json"
+
+MD5_PATTERN = re.compile(r'^[0-9a-fA-F]{32}$')
+
+
+def read_md5_list(md5_fp: str) -> dict:
+    '''
+    Reads the provider md5 list (File, Size, md5sum, Download_link per line).
+        Parameters:
+        ----------
+        md5_fp : str
+            File path of the *_md5sum_DownloadLink.txt file
+        Returns:
+        -------
+        dict
+            Maps file names to the expected md5 checksum
+    '''
+    expected = {}
+    with open(md5_fp) as fh:
+        for line in fh:
+            fields = line.split()
+            # Header and malformed lines have no checksum in the third column
+            if len(fields) >= 3 and MD5_PATTERN.match(fields[2]):
+                expected[fields[0]] = fields[2].lower()
+    return expected
+
+
+def file_md5(fp: str, chunk_size: int = CHUNK_SIZE) -> str:
+    '''Returns the md5 hex digest of a file, read in chunks of chunk_size.'''
+    digest = hashlib.md5()
+    with open(fp, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_cache(cache_fp: str) -> dict:
+    '''Loads the checksum cache, an empty cache if it does not exist.'''
+    if cache_fp is None or not os.path.exists(cache_fp):
+        return {}
+    with open(cache_fp) as fh:
+        return json.load(fh)
+
+
+def save_cache(cache: dict, cache_fp: str) -> None:
+    '''Writes the checksum cache atomically.'''
+    tmp_fp = cache_fp + '.tmp'
+    with open(tmp_fp, 'w') as fh:
+        json.dump(cache, fh, indent=1, sort_keys=True)
+    os.replace(tmp_fp, cache_fp)
+
+
+def verify_files(jobs: list, n_workers: int = 8, cache_fp: str = None,
+                 verbose: bool = True) -> dict:
+    '''
+    Verifies files against their expected md5 checksums in parallel.
+        Parameters:
+        ----------
+        jobs : list
+            (file path, expected md5) pairs
+        n_workers : int
+            Number of files hashed at the same time
+        cache_fp : str
+            Checksum cache (JSON), no caching if None
+        verbose : bool
+            Print one status line per file and a summary
+        Returns:
+        -------
+        dict
+            Maps every file path to 'OK', 'FAILED' or 'missing'
+    '''
+    cache = load_cache(cache_fp)
+    results = {}
+    to_hash = []
+
+    for fp, expected_md5 in jobs:
+        fp = os.path.abspath(fp)
+        if not os.path.exists(fp):
+            results[fp] = 'missing'
+            continue
+        stat = os.stat(fp)
+        cached = cache.get(fp)
+        if cached and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            results[fp] = 'OK' if cached['md5'] == expected_md5 else 'FAILED'
+        else:
+            to_hash.append((fp, expected_md5, stat))
+
+    start = time.time()
+    n_bytes = sum(stat.st_size for _, _, stat in to_hash)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        digests = executor.map(file_md5, [fp for fp, _, _ in to_hash])
+        for (fp, expected_md5, stat), digest in zip(to_hash, digests):
+            results[fp] = 'OK' if digest == expected_md5 else 'FAILED'
+            cache[fp] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'md5': digest}
+    elapsed = time.time() - start
+
+    if cache_fp is not None and to_hash:
+        save_cache(cache, cache_fp)
+
+    if verbose:
+        for fp, status in results.items():
+            print("%s: %s" % (os.path.basename(fp), status))
+        counts = {status: list(results.values()).count(status) for status in ('OK', 'FAILED', 'missing')}
+        print("%d OK, %d FAILED, %d missing (%d from cache)" % (
+            counts['OK'], counts['FAILED'], counts['missing'],
+            len(results) - counts['missing'] - len(to_hash)))
+        if to_hash:
+            print("Hashed %.1f MB in %.1f s (%.1f MB/s)" % (
+                n_bytes / 1e6, elapsed, n_bytes / 1e6 / max(elapsed, 1e-9)))
+
+    return results
+
+
+def verify_md5(md5_fp: str, data_dir: str, filenames: list = None, n_workers: int = 8,
+               use_cache: bool = True, verbose: bool = True) -> dict:
+    '''
+    Verifies the files of data_dir listed in the provider md5 list.
+        Parameters:
+        ----------
+        md5_fp : str
+            File path of the *_md5sum_DownloadLink.txt file
+        data_dir : str
+            Directory containing the listed files
+        filenames : list
+            Only verify these file names (default: all listed files)
+        n_workers : int
+            Number of files hashed at the same time
+        use_cache : bool
+            Read and update the checksum cache in data_dir
+        verbose : bool
+            Print one status line per file and a summary
+    '''
+    expected = read_md5_list(md5_fp)
+    if filenames is not None:
+        filenames = set(filenames)
+        expected = {fn: md5 for fn, md5 in expected.items() if fn in filenames}
+    jobs = [(os.path.join(data_dir, fn), md5) for fn, md5 in expected.items()]
+    cache_fp = os.path.join(data_dir, CACHE_FN) if use_cache else None
+    return verify_files(jobs, n_workers, cache_fp, verbose)
+
+
+# --- EXECUTION BLOCK ---
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Verify downloaded files against the provider md5 list.')
+    parser.add_argument('md5_file', help='*_md5sum_DownloadLink.txt of the sequencing provider')
+    parser.add_argument('--data-dir', default='.', help='directory with the downloaded files (default: .)')
+    parser.add_argument('--threads', type=int, default=8, help='files hashed at the same time')
+    parser.add_argument('--no-cache', action='store_true', help='hash every file again')
+    parser.add_argument('--strict', action='store_true', help='also fail if listed files are missing')
+    args = parser.parse_args()
+
+    results = verify_md5(args.md5_file, args.data_dir, n_workers=args.threads,
+                         use_cache=not args.no_cache)
+    statuses = set(results.values())
+    if 'FAILED' in statuses or (args.strict and 'missing' in statuses):
+        sys.exit(1)
+
+# in command line (inside Data/20241209-raw_data):
+# python ../../Additional_Scripts/md5_verifier.py 20241209_HN00230849_MAS_Report/assets/spgs/HN00230849_23samples_md5sum_DownloadLink.txt
@@ -1,35 +1,287 @@
 #Libraries
+import argparse
+import csv
+import os
+import pickle
+import re
+
 import pandas as pd
 
+from pipeline_cache import file_digest
+
+
+#This script compiles the sample metadata sheet into the metadata used by the
+#pipeline. The sheet (CSV/TSV with any delimiter, or .xlsx) is validated,
+#typed and normalized once:
+#   - blank lines, lines quoted as a whole and stray whitespace are removed
+#   - sample IDs and column names must be unique and non-empty
+#   - numeric columns are detected, decimal commas ("7,6") become floats
+#   - a "#q2:types" row in the sheet overrides the detected types
+#The result is written as a QIIME 2 metadata TSV (with a "#q2:types" row)
+#and as a compact binary cache next to it, which load_compiled_metadata
+#reads without parsing text. The cache records the hash of the TSV it was
+#written with, so an edited TSV is never shadowed by an old cache.
+
+
+
+#Input sheet, QIIME 2 metadata TSV and binary cache (relative to the repository root)
+INPUT_FP = 'Data/metadata_for_q.csv'
+OUTPUT_TSV_FP = 'Data/metadata.tsv'
+CACHE_SUFFIX = '.pkl'
+
+#Bumped whenever the layout of the cache changes
+CACHE_VERSION = 1
+
+#Header names QIIME 2 accepts for the ID column (compared case-insensitively)
+ID_HEADERS = {'id', 'sampleid', 'sample id', 'sample-id', 'featureid', 'feature id', 'feature-id',
+              '#sampleid', '#sample id', '#featureid', '#feature id', '#otuid', '#otu id', 'sample_name'}
+
+#Values that stand for a missing value
+MISSING_VALUES = {'', 'na', 'nan', 'n/a', 'none', 'null'}
+
+#Numbers with a decimal point or a decimal comma
+NUMBER_PATTERN = re.compile(r'^[+-]?(\d+([.,]\d*)?|[.,]\d+)([eE][+-]?\d+)?$')
+
+
+class MetadataError(ValueError):
+    '''Raised when the metadata sheet cannot be used as QIIME 2 metadata.'''
+
+
+def cache_fp_for(tsv_fp: str) -> str:
+    '''Returns the file path of the binary cache belonging to a metadata TSV.'''
+    return os.path.splitext(tsv_fp)[0] + CACHE_SUFFIX
+
+
+def _clean_lines(text: str) -> list:
+    '''Drops blank and delimiter-only lines and unwraps lines that are quoted as a whole.'''
+    lines = []
+    for line in text.splitlines():
+        line = line.strip('\r\n')
+        if len(line) >= 2 and line[0] == '"' and line[-1] == '"' and line.count('"') == 2:
+            line = line[1:-1]
+        if line.strip(' \t;,'):
+            lines.append(line)
+    return lines
+
+
+def read_sheet(input_fp: str) -> pd.DataFrame:
+    '''
+    Reads the metadata sheet with every value as string.
+        Parameters:
+        ----------
+        input_fp : str
+            CSV/TSV file (the delimiter is detected) or .xlsx file
+        Returns:
+        -------
+        pd.DataFrame
+            Raw sheet, the header line as column names
+    '''
+    if input_fp.endswith(('.xlsx', '.xls')):
+        sheet = pd.read_excel(input_fp, dtype=str, header=None)
+        sheet = sheet.dropna(how='all').fillna('')
+        return pd.DataFrame(sheet.iloc[1:].to_numpy(), columns=sheet.iloc[0].tolist())
+
+    with open(input_fp, encoding='utf-8-sig') as fh:
+        lines = _clean_lines(fh.read())
+    if not lines:
+        raise MetadataError(f"{input_fp} contains no metadata")
+    delimiter = csv.Sniffer().sniff(lines[0], delimiters='\t;,').delimiter
+    rows = list(csv.reader(lines, delimiter=delimiter))
+    width = len(rows[0])
+    for number, row in enumerate(rows[1:], start=2):
+        if len(row) > width and any(value.strip() for value in row[width:]):
+            raise MetadataError(f"{input_fp}: row {number} has {len(row)} values, the header has {width}")
+    rows = [(row + [''] * width)[:width] for row in rows]
+    return pd.DataFrame(rows[1:], columns=rows[0])
+
+
+def detect_type(values: pd.Series) -> str:
+    '''Returns 'numeric' if every non-missing value is a number (decimal comma allowed), else 'categorical'.'''
+    present = values.dropna()
+    if present.empty:
+        return 'categorical'
+    return 'numeric' if present.map(lambda value: bool(NUMBER_PATTERN.match(value))).all() else 'categorical'
+
 
-#This script transforms metadata csv files in tsv files
+def to_numeric(values: pd.Series, column: str) -> pd.Series:
+    '''Converts a column to float, decimal commas included.'''
+    converted = pd.to_numeric(values.str.replace(',', '.', regex=False), errors='coerce')
+    invalid = values.notna() & converted.isna()
+    if invalid.any():
+        raise MetadataError(f"column {column} is numeric but contains {', '.join(values[invalid].unique()[:5])}")
+    return converted.astype(float)
 
 
+def compile_sheet(sheet: pd.DataFrame, types: dict = None) -> pd.DataFrame:
+    '''
+    Validates, types and normalizes the raw sheet.
+        Parameters:
+        ----------
+        sheet : pd.DataFrame
+            Raw sheet as returned by read_sheet
+        types : dict
+            Column types that override the detection ('numeric' or 'categorical')
+        Returns:
+        -------
+        pd.DataFrame
+            Metadata indexed by sample ID, numeric columns as float and
+            categorical columns as str (missing values as NaN)
+    '''
+    sheet = sheet.copy()
+    sheet.columns = [str(column).strip() for column in sheet.columns]
+    columns = list(sheet.columns)
+    if any(not column for column in columns):
+        raise MetadataError("the sheet contains a column without a name")
+    duplicated = sorted({column for column in columns if columns.count(column) > 1})
+    if duplicated:
+        raise MetadataError(f"duplicated columns: {', '.join(duplicated)}")
+    for column in sheet.columns:
+        sheet[column] = sheet[column].astype(str).str.strip()
+        sheet.loc[sheet[column].str.lower().isin(MISSING_VALUES), column] = None
+
+    # Column types given in the sheet itself
+    types = dict(types or {})
+    id_header = sheet.columns[0]
+    directives = sheet[id_header].str.lower() == '#q2:types'
+    if directives.any():
+        row = sheet[directives].iloc[0]
+        types = {**{column: row[column] for column in sheet.columns[1:] if pd.notna(row[column])}, **types}
+    sheet = sheet[~directives & ~sheet[id_header].fillna('').str.startswith('#')]
+
+    # Validation of the header and the IDs
+    if id_header.lower() not in ID_HEADERS:
+        raise MetadataError(f"the first column ({id_header!r}) is not a QIIME 2 ID header, e.g. 'sample-id'")
+    columns = list(sheet.columns[1:])
+    reserved = [column for column in columns if column.lower() in ID_HEADERS]
+    if reserved:
+        raise MetadataError(f"column names reserved for the ID column: {', '.join(reserved)}")
+    ids = sheet[id_header]
+    if ids.isna().any():
+        raise MetadataError(f"{int(ids.isna().sum())} rows without a sample ID")
+    duplicated = sorted(ids[ids.duplicated()].unique())
+    if duplicated:
+        raise MetadataError(f"duplicated sample IDs: {', '.join(duplicated)}")
+    unknown = {column: column_type for column, column_type in types.items()
+               if column not in columns or column_type not in ('numeric', 'categorical')}
+    if unknown:
+        raise MetadataError(f"invalid column types: {unknown}")
+
+    # Typing
+    metadata = sheet.set_index(id_header)
+    metadata.index = pd.Index(metadata.index.astype(object), name=id_header, dtype=object)
+    for column in columns:
+        column_type = types.get(column) or detect_type(metadata[column])
+        if column_type == 'numeric':
+            metadata[column] = to_numeric(metadata[column], column)
+        else:
+            metadata[column] = metadata[column].astype(object)
+    return metadata
+
+
+def column_types(metadata: pd.DataFrame) -> dict:
+    '''Returns the QIIME 2 type of every column.'''
+    return {column: 'numeric' if pd.api.types.is_float_dtype(metadata[column]) else 'categorical'
+            for column in metadata.columns}
+
+
+def write_tsv(metadata: pd.DataFrame, output_tsv: str) -> None:
+    '''Writes QIIME 2 metadata TSV with a "#q2:types" row (decimal points, missing values empty).'''
+    types = column_types(metadata)
+    with open(output_tsv, 'w', newline='') as of:
+        writer = csv.writer(of, delimiter='\t', lineterminator='\n')
+        writer.writerow([metadata.index.name] + list(metadata.columns))
+        writer.writerow(['#q2:types'] + [types[column] for column in metadata.columns])
+        for sample_id, row in zip(metadata.index, metadata.itertuples(index=False)):
+            writer.writerow([sample_id] + ['' if pd.isna(value) else '%.15g' % value if isinstance(value, float) else value
+                                           for value in row])
+
+
+def write_cache(metadata: pd.DataFrame, output_tsv: str, cache_fp: str = None) -> str:
+    '''Writes the binary cache of a compiled TSV and returns its file path.'''
+    cache_fp = cache_fp or cache_fp_for(output_tsv)
+    payload = {'version': CACHE_VERSION, 'tsv_sha256': file_digest(output_tsv),
+               'types': column_types(metadata), 'metadata': metadata}
+    tmp_fp = cache_fp + '.tmp'
+    with open(tmp_fp, 'wb') as of:
+        pickle.dump(payload, of, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_fp, cache_fp)
+    return cache_fp
 
-#transformer function
-def metadata_transformer(input_csv:pd.DataFrame, output_tsv: str) -> None:
+
+def metadata_transformer(input_fp: str, output_tsv: str, types: dict = None) -> pd.DataFrame:
     '''
-    The function takes a pandas dataframe as input and saves it as a tsv file
+    Compiles the metadata sheet into a QIIME 2 metadata TSV and its binary cache.
         Parameters:
         ----------
-        input_csv : pd.DataFrame
-            Input metadata in csv format as pandas dataframe
+        input_fp : str
+            Metadata sheet (CSV/TSV or .xlsx)
         output_tsv : str
-            File path to save the transformed metadata in tsv format
+            File path to save the QIIME 2 metadata TSV, the cache is saved next to it
+        types : dict
+            Column types that override the detection
+        Returns:
+        -------
+        pd.DataFrame
+            The compiled metadata
+    '''
+    metadata = compile_sheet(read_sheet(input_fp), types)
+    write_tsv(metadata, output_tsv)
+    write_cache(metadata, output_tsv)
+    return metadata
+
+
+def load_compiled_metadata(tsv_fp: str, digest: str = None) -> pd.DataFrame:
+    '''
+    Loads compiled metadata from the binary cache next to the TSV.
+        Parameters:
+        ----------
+        tsv_fp : str
+            File path of the compiled metadata TSV
+        digest : str
+            SHA-256 of the TSV if already known, the cache is only used if it
+            was written with this TSV content
+        Returns:
+        -------
+        pd.DataFrame
+            The compiled metadata, None if there is no current cache
     '''
-    input_csv.to_csv(output_tsv, sep = '\t', index = False)
+    cache_fp = cache_fp_for(tsv_fp)
+    if not os.path.exists(cache_fp):
+        return None
+    with open(cache_fp, 'rb') as fh:
+        payload = pickle.load(fh)
+    if payload.get('version') != CACHE_VERSION:
+        return None
+    if payload['tsv_sha256'] != (digest or file_digest(tsv_fp)):
+        return None
+    return payload['metadata']
+
+
+def to_qiime_metadata(metadata: pd.DataFrame):
+    '''Wraps compiled metadata into qiime2.Metadata without parsing the TSV again.'''
+    from qiime2 import Metadata
+
+    return Metadata(metadata)
 
 
 #Execution
 if __name__ == "__main__":
-    #Input metadata csv file path
-    input_csv_fp = 'Data/metadata_for_q.csv'
-    
-    #Output metadata tsv file path
-    output_tsv_fp = 'Data/metadata.tsv'
-    
-    #Read the input csv file as pandas dataframe
-    input_csv_df = pd.read_csv(input_csv_fp, sep = ";")
-    
-    #Call the transformer function
-    metadata_transformer(input_csv_df, output_tsv_fp)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Compile the metadata sheet into QIIME 2 metadata and a binary cache.')
+    parser.add_argument('input', nargs='?', default=INPUT_FP, help='metadata sheet (default: %(default)s)')
+    parser.add_argument('output', nargs='?', default=OUTPUT_TSV_FP, help='QIIME 2 metadata TSV (default: %(default)s)')
+    parser.add_argument('--type', action='append', default=[], metavar='COLUMN=TYPE',
+                        help='override a detected column type (numeric or categorical)')
+    args = parser.parse_args()
+
+    types = dict(assignment.split('=', 1) for assignment in args.type)
+    try:
+        metadata = metadata_transformer(args.input, args.output, types)
+    except MetadataError as error:
+        parser.exit(1, f"Invalid metadata in {args.input}: {error}\n")
+
+    print(f"Compiled {len(metadata)} samples and {len(metadata.columns)} columns from {args.input}")
+    for column, column_type in column_types(metadata).items():
+        print(f"  {column}: {column_type}")
+    print(f"Metadata saved to {args.output} and {cache_fp_for(args.output)}")
+
+# in command line (from the repository root): python Additional_Scripts/metadata_transformer.py Data/metadata_for_q.csv Data/metadata.tsv
@@ -0,0 +1,173 @@
+#Libraries
+import ast
+import hashlib
+import json
+import os
+import zipfile
+
+
+#This script provides the content-hash keys and the cache index used by the
+#pipeline runner to decide whether a step has to be recomputed
+
+
+
+#Default location of the cache index (repository root)
+CACHE_INDEX_FP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".pipeline_cache.json")
+
+#Read size used when hashing plain files
+CHUNK_SIZE = 1024 * 1024
+
+
+def artifact_uuid(artifact_fp: str) -> str:
+    '''
+    Reads the UUID of a QIIME 2 archive (.qza/.qzv) without extracting it.
+    The UUID is the name of the root directory inside the zip file.
+        Parameters:
+        ----------
+        artifact_fp : str
+            File path of the .qza or .qzv archive
+        Returns:
+        -------
+        str
+            UUID of the archive
+    '''
+    try:
+        with zipfile.ZipFile(artifact_fp) as zf:
+            first_member = zf.namelist()[0]
+    except (zipfile.BadZipFile, IndexError):
+        raise ValueError('Not a QIIME 2 archive: %s' % artifact_fp)
+    return first_member.split('/', 1)[0]
+
+
+def file_digest(fp: str) -> str:
+    '''
+    Computes the sha256 hex digest of a file in chunks.
+        Parameters:
+        ----------
+        fp : str
+            File path of the file to hash
+    '''
+    digest = hashlib.sha256()
+    with open(fp, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def input_fingerprint(fp: str) -> str:
+    '''
+    Returns the identity of a step input: the archive UUID for QIIME 2
+    artifacts and visualizations, the content hash for every other file.
+        Parameters:
+        ----------
+        fp : str
+            File path of the input
+    '''
+    if fp.endswith(('.qza', '.qzv')):
+        return 'uuid:%s' % artifact_uuid(fp)
+    return 'sha256:%s' % file_digest(fp)
+
+
+def local_modules(script_fp: str, search_dirs: list) -> list:
+    '''
+    Finds the local helper modules a script imports, directly or through
+    other helpers (e.g. diversity_analysis.py -> beta_engine.py ->
+    distance_store.py). Modules are looked up in the directory of the
+    importing file first, then in search_dirs; installed packages are not
+    found there and are ignored.
+        Parameters:
+        ----------
+        script_fp : str
+            File path of the step script
+        search_dirs : list
+            Directories the scripts add to sys.path (Additional_Scripts, step directories)
+        Returns:
+        -------
+        list
+            Sorted file paths of the imported helper modules
+    '''
+    found = set()
+    pending = [os.path.abspath(script_fp)]
+    while pending:
+        fp = pending.pop()
+        try:
+            with open(fp) as fh:
+                tree = ast.parse(fh.read(), filename=fp)
+        except (OSError, SyntaxError, UnicodeDecodeError, ValueError):
+            continue
+        names = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names.update(alias.name.split('.')[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module:
+                names.add(node.module.split('.')[0])
+        for name in names:
+            for directory in [os.path.dirname(fp)] + list(search_dirs):
+                module_fp = os.path.abspath(os.path.join(directory, name + '.py'))
+                if os.path.exists(module_fp):
+                    if module_fp not in found and module_fp != os.path.abspath(script_fp):
+                        found.add(module_fp)
+                        pending.append(module_fp)
+                    break
+    return sorted(found)
+
+
+def step_key(input_fps: list, params: dict, script_fp: str = None, helper_fps: list = None) -> str:
+    '''
+    Builds the cache key of a step from the identities of its inputs, its
+    parameters and (optionally) the content of the script that runs it and
+    of the local helper modules it imports.
+        Parameters:
+        ----------
+        input_fps : list
+            File paths of all inputs of the step
+        params : dict
+            Parameters of the step (must be JSON serializable)
+        script_fp : str
+            File path of the step script, editing the script invalidates the key
+        helper_fps : list
+            File paths of the helper modules of the script (see local_modules),
+            editing one of them invalidates the key as well
+    '''
+    payload = {
+        'inputs': [input_fingerprint(fp) for fp in input_fps],
+        'params': params,
+        'script': file_digest(script_fp) if script_fp is not None else None,
+        'helpers': {os.path.basename(fp): file_digest(fp) for fp in helper_fps or []},
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class CacheIndex:
+    '''
+    Maps every output file of the pipeline to the key it was produced with.
+    The index is a small JSON file so it can be inspected or deleted by hand.
+    '''
+
+    def __init__(self, index_fp: str = CACHE_INDEX_FP):
+        self.index_fp = os.path.abspath(index_fp)
+        self.entries = {}
+        if os.path.exists(self.index_fp):
+            with open(self.index_fp) as fh:
+                self.entries = json.load(fh)
+
+    def _entry_name(self, fp: str) -> str:
+        #Outputs are stored relative to the index so the repository can move
+        return os.path.relpath(os.path.abspath(fp), os.path.dirname(self.index_fp))
+
+    def is_current(self, output_fps: list, key: str) -> bool:
+        '''Returns True if every output exists and was produced with key.'''
+        for fp in output_fps:
+            if not os.path.exists(fp) or self.entries.get(self._entry_name(fp)) != key:
+                return False
+        return True
+
+    def record(self, output_fps: list, key: str) -> None:
+        '''Stores key for all outputs and writes the index to disk.'''
+        for fp in output_fps:
+            self.entries[self._entry_name(fp)] = key
+        tmp_fp = self.index_fp + '.tmp'
+        with open(tmp_fp, 'w') as fh:
+            json.dump(self.entries, fh, indent=2, sort_keys=True)
+        os.replace(tmp_fp, self.index_fp)
@@ -0,0 +1,625 @@
+#!/usr/bin/env python
+
+#Libraries
+import argparse
+import os
+import subprocess
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from pipeline_cache import CacheIndex, local_modules, step_key
+from pipeline_worker import submit, worker_available
+
+
+#This script runs the step scripts of the pipeline in dependency order and
+#skips every step whose outputs were already produced from the same input
+#artifacts (UUIDs), the same parameters and the same version of the script and
+#of the local helper modules it imports.
+#
+#Parameters are handed to the step scripts as environment variables, every
+#script falls back to its own default if the variable is not set.
+#
+#Independent steps (e.g. the ASV and OTU branches, taxonomy and phylogeny)
+#can run at the same time. Steps that start their own worker threads
+#(DADA2, VSEARCH, MAFFT/FastTree, classify_sklearn, core metrics) get a share
+#of a global core budget through the N_THREADS variable instead of all cores.
+
+
+
+#Repository root, all paths below are relative to it
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+METADATA = "Data/metadata.tsv"
+METADATA_SHEET = "Data/metadata_for_q.csv"
+MD5_LIST = "20241209-raw_data/20241209_HN00230849_MAS_Report/assets/spgs/HN00230849_23samples_md5sum_DownloadLink.txt"
+
+#Pipeline definition
+#Every step is executed inside its own directory (the scripts use relative paths).
+#The dependency graph follows from matching the inputs of a step with the
+#outputs of the other steps. 'threads' marks the steps that use N_THREADS,
+#'env' holds fixed variables that select one branch of a shared script.
+#'auto_inputs' maps a file to parameters: the file is only an input of the
+#step (and of its cache key) while one of these parameters is set to "auto".
+#'optional' steps are only run when they are named as a target (or needed by
+#one): the OTU decontamination needs Sample_or_Control/Concentration columns
+#that Data/metadata.tsv does not have yet.
+#Step3 (demultiplexing) is not part of the graph: the reads are delivered demultiplexed.
+STEPS = [
+    {
+        'name': 'metadata',
+        'dir': 'Additional_Scripts',
+        'command': ['metadata_transformer.py', '../' + METADATA_SHEET, '../' + METADATA],
+        'inputs': [METADATA_SHEET],
+        'outputs': [METADATA, 'Data/metadata.pkl'],
+        'params': {},
+    },
+    {
+        'name': 'metadata_tabulate',
+        'dir': 'Step1_MetadataVisualization',
+        'command': ['metadata_tabulate.py'],
+        'inputs': [METADATA],
+        'outputs': ['Step1_MetadataVisualization/tabulated_metadata.qzv'],
+        'params': {},
+    },
+    {
+        'name': 'import',
+        'dir': 'Step2_ImportingData',
+        'command': ['fq-manifestor.py', '../Data/20241209-raw_data', 'fastq-manifest.tsv',
+                    '--md5-file', '../Data/' + MD5_LIST],
+        'inputs': ['Data/' + MD5_LIST],
+        'outputs': ['Step2_ImportingData/demux.qza',
+                    'Step2_ImportingData/fastq-manifest.tsv'],
+        'params': {},
+    },
+    {
+        'name': 'quality_profile',
+        'dir': 'Step4_QCFeatureTableConstruction',
+        'command': ['quality_profiler.py'],
+        'inputs': ['Step2_ImportingData/fastq-manifest.tsv'],
+        'outputs': ['Step4_QCFeatureTableConstruction/quality_suggestions.json',
+                    'Step4_QCFeatureTableConstruction/quality_profile.tsv'],
+        'params': {},
+        'threads': True,
+    },
+    {
+        # TRIM_LEFT_*/TRUNC_LEN_* = auto takes the value from quality_suggestions.json
+        'name': 'dada2',
+        'dir': 'Step4_QCFeatureTableConstruction',
+        'command': ['dada2.py'],
+        'inputs': ['Step2_ImportingData/demux.qza'],
+        'auto_inputs': {'Step4_QCFeatureTableConstruction/quality_suggestions.json':
+                        ['TRIM_LEFT_F', 'TRUNC_LEN_F', 'TRIM_LEFT_R', 'TRUNC_LEN_R']},
+        'outputs': ['Step4_QCFeatureTableConstruction/table.qza',
+                    'Step4_QCFeatureTableConstruction/rep-seqs.qza',
+                    'Step4_QCFeatureTableConstruction/denoising-stats.qza'],
+        'params': {'TRIM_LEFT_F': 15, 'TRUNC_LEN_F': 280, 'TRIM_LEFT_R': 0, 'TRUNC_LEN_R': 240},
+        'threads': True,
+    },
+    {
+        'name': 'vsearch',
+        'dir': 'Step4_QCFeatureTableConstruction',
+        'command': ['vsearch.py'],
+        'inputs': ['Step4_QCFeatureTableConstruction/table.qza',
+                   'Step4_QCFeatureTableConstruction/rep-seqs.qza'],
+        'outputs': ['Step4_QCFeatureTableConstruction/table-dn-97.qza',
+                    'Step4_QCFeatureTableConstruction/rep-seqs-dn-97.qza'],
+        'params': {},
+        'threads': True,
+    },
+    {
+        'name': 'featuretable_summary_asv',
+        'dir': 'Step4_QCFeatureTableConstruction',
+        'command': ['featuretable_summary_avs.py'],
+        'inputs': ['Step4_QCFeatureTableConstruction/table.qza',
+                   'Step4_QCFeatureTableConstruction/rep-seqs.qza',
+                   METADATA],
+        'outputs': ['Step4_QCFeatureTableConstruction/table-summary.qzv',
+                    'Step4_QCFeatureTableConstruction/rep-seqs-summary.qzv'],
+        'params': {},
+    },
+    {
+        'name': 'featuretable_summary_otu',
+        'dir': 'Step4_QCFeatureTableConstruction',
+        'command': ['featuretable_summary_otu.py'],
+        'inputs': ['Step4_QCFeatureTableConstruction/table-dn-97.qza',
+                   'Step4_QCFeatureTableConstruction/rep-seqs-dn-97.qza',
+                   METADATA],
+        'outputs': ['Step4_QCFeatureTableConstruction/table-dn-97-summary.qzv',
+                    'Step4_QCFeatureTableConstruction/rep-seqs-dn-97-summary.qzv'],
+        'params': {},
+    },
+    {
+        'name': 'filtering_asv',
+        'dir': 'Step5_Filtering',
+        'command': ['filtering.py'],
+        'inputs': ['Step4_QCFeatureTableConstruction/table.qza'],
+        'outputs': ['Step5_Filtering/asv_table-filtered.qza'],
+        'params': {'MIN_SAMPLES': 2},
+        'env': {'FILTER_BRANCHES': 'asv'},
+    },
+    {
+        'name': 'filtering_otu',
+        'dir': 'Step5_Filtering',
+        'command': ['filtering.py'],
+        'inputs': ['Step4_QCFeatureTableConstruction/table-dn-97.qza'],
+        'outputs': ['Step5_Filtering/otu_table-filtered.qza'],
+        'params': {'MIN_SAMPLES': 2},
+        'env': {'FILTER_BRANCHES': 'otu'},
+    },
+    {
+        'name': 'summarize_filtering',
+        'dir': 'Step5_Filtering',
+        'command': ['summarize_filtering.py'],
+        'inputs': ['Step5_Filtering/asv_table-filtered.qza', METADATA],
+        'outputs': ['Step5_Filtering/asv_table-filtered-summary.qzv'],
+        'params': {},
+    },
+    {
+        'name': 'decontamination_asv',
+        'dir': 'Step6_Decontamination',
+        'command': ['decontamination.py', '--variants', 'asv'],
+        'inputs': ['Step5_Filtering/asv_table-filtered.qza',
+                   'Step4_QCFeatureTableConstruction/rep-seqs.qza',
+                   METADATA],
+        'outputs': ['Step6_Decontamination/asv_decontam_scores.qza',
+                    'Step6_Decontamination/asv_decontam_score_viz.qzv',
+                    'Step6_Decontamination/filtered-table.qza',
+                    'Step6_Decontamination/filtered-rep-seqs.qza'],
+        'params': {'THRESHOLD': 0.1},
+    },
+    {
+        'name': 'decontamination_otu',
+        'optional': True,
+        'dir': 'Step6_Decontamination',
+        'command': ['decontamination.py', '--variants', 'otu'],
+        'inputs': ['Step5_Filtering/otu_table-filtered.qza',
+                   'Step4_QCFeatureTableConstruction/rep-seqs-dn-97.qza',
+                   METADATA],
+        'outputs': ['Step6_Decontamination/otu_comb_decontam_scores.qza',
+                    'Step6_Decontamination/otu_decontam_score_viz.qzv',
+                    'Step6_Decontamination/otu_table-decontam.qza',
+                    'Step6_Decontamination/otu_rep_seqs-decontam.qza'],
+        'params': {'THRESHOLD': 0.1},
+    },
+    {
+        'name': 'phylogenetic_tree',
+        'dir': 'Step7_PhylogeneticTree',
+        'command': ['phylogenetic_tree.py'],
+        'inputs': ['Step6_Decontamination/filtered-rep-seqs.qza'],
+        'outputs': ['Step7_PhylogeneticTree/asv_rooted_tree.qza'],
+        'params': {},
+        'env': {'TREE_BRANCHES': 'asv'},
+        'threads': True,
+    },
+    {
+        'name': 'phylogenetic_tree_otu',
+        'optional': True,
+        'dir': 'Step7_PhylogeneticTree',
+        'command': ['phylogenetic_tree.py'],
+        'inputs': ['Step6_Decontamination/otu_rep_seqs-decontam.qza'],
+        'outputs': ['Step7_PhylogeneticTree/otu_rooted_tree.qza'],
+        'params': {},
+        'env': {'TREE_BRANCHES': 'otu'},
+        'threads': True,
+    },
+    {
+        # Retention of the candidate sampling depths, SAMPLING_DEPTH/MAX_DEPTH = auto take the chosen depths
+        # (the fixed depths stay the defaults, the chosen one may drop more samples)
+        'name': 'sampling_depth',
+        'dir': 'Step7_PhylogeneticTree',
+        'command': ['sampling_depth.py'],
+        'inputs': ['Step6_Decontamination/filtered-table.qza', METADATA],
+        'outputs': ['Step7_PhylogeneticTree/sampling_depth.json',
+                    'Step7_PhylogeneticTree/sampling_depth_report.tsv'],
+        'params': {'MIN_SAMPLE_FRACTION': 0.75, 'MIN_GROUP_SAMPLES': 2},
+    },
+    {
+        'name': 'diversity_analysis',
+        'dir': 'Step7_PhylogeneticTree',
+        'command': ['diversity_analysis.py'],
+        'inputs': ['Step7_PhylogeneticTree/asv_rooted_tree.qza',
+                   'Step6_Decontamination/filtered-table.qza',
+                   METADATA],
+        'auto_inputs': {'Step7_PhylogeneticTree/sampling_depth.json': ['SAMPLING_DEPTH']},
+        'outputs': ['Step7_PhylogeneticTree/core_diversity_results/core_metrics/rarefied_table.qza',
+                    'Step7_PhylogeneticTree/core_diversity_results/core_metrics/unweighted_unifrac_distance_matrix.qza',
+                    'Step7_PhylogeneticTree/core_diversity_results/core_metrics/weighted_unifrac_distance_matrix.qza',
+                    'Step7_PhylogeneticTree/core_diversity_results/core_metrics/jaccard_distance_matrix.qza',
+                    'Step7_PhylogeneticTree/core_diversity_results/core_metrics/bray_curtis_distance_matrix.qza',
+                    'Step7_PhylogeneticTree/core_diversity_results/core_metrics/faith_pd_vector.qza',
+                    'Step7_PhylogeneticTree/core_diversity_results/core_metrics/observed_features_vector.qza',
+                    'Step7_PhylogeneticTree/core_diversity_results/core_metrics/shannon_vector.qza',
+                    'Step7_PhylogeneticTree/core_diversity_results/core_metrics/evenness_vector.qza',
+                    'Step7_PhylogeneticTree/core_diversity_results/core_metrics/bray_curtis_pcoa_results.qza',
+                    'Step7_PhylogeneticTree/core_diversity_results/alpha_group_significance_faith_pd.qzv',
+                    'Step7_PhylogeneticTree/core_diversity_results/beta_group_significance_unweighted_unifrac_disease_state.qzv',
+                    'Step7_PhylogeneticTree/core_diversity_results/emperor_unweighted_unifrac.qzv'],
+        'params': {'SAMPLING_DEPTH': 9000, 'COMPACT_DISTANCES': 0},
+        'threads': True,
+    },
+    {
+        # Every categorical column against all distance matrices and alpha vectors
+        'name': 'group_significance',
+        'dir': 'Step7_PhylogeneticTree',
+        'command': ['group_significance.py'],
+        'inputs': ['Step7_PhylogeneticTree/core_diversity_results/core_metrics/%s' % fn
+                   for fn in ['unweighted_unifrac_distance_matrix.qza', 'weighted_unifrac_distance_matrix.qza',
+                              'jaccard_distance_matrix.qza', 'bray_curtis_distance_matrix.qza',
+                              'faith_pd_vector.qza', 'observed_features_vector.qza',
+                              'shannon_vector.qza', 'evenness_vector.qza']] + [METADATA],
+        'outputs': ['Step7_PhylogeneticTree/core_diversity_results/group_significance.tsv'],
+        'params': {'PERMUTATIONS': 999},
+        'threads': True,
+    },
+    {
+        # Means and dispersion of the diversity metrics over repeated rarefactions
+        'name': 'rarefaction_replicates',
+        'dir': 'Step7_PhylogeneticTree',
+        'command': ['rarefaction_replicates.py'],
+        'inputs': ['Step6_Decontamination/filtered-table.qza',
+                   'Step7_PhylogeneticTree/asv_rooted_tree.qza'],
+        'auto_inputs': {'Step7_PhylogeneticTree/sampling_depth.json': ['SAMPLING_DEPTH']},
+        'outputs': ['Step7_PhylogeneticTree/core_diversity_results/rarefaction_replicates/alpha_replicates.tsv',
+                    'Step7_PhylogeneticTree/core_diversity_results/rarefaction_replicates/unweighted_unifrac_distance_matrix.qza'],
+        'params': {'SAMPLING_DEPTH': 9000, 'RAREFACTION_REPLICATES': 10},
+        'threads': True,
+    },
+    {
+        'name': 'alpha_rarefaction',
+        'dir': 'Step8_AlphaRarefaction',
+        'command': ['alpha_rarefactioning.py'],
+        'inputs': ['Step6_Decontamination/filtered-table.qza',
+                   'Step7_PhylogeneticTree/asv_rooted_tree.qza',
+                   METADATA],
+        'auto_inputs': {'Step7_PhylogeneticTree/sampling_depth.json': ['MAX_DEPTH']},
+        'outputs': ['Step8_AlphaRarefaction/asv_alpha_rarefaction.qzv'],
+        'params': {'MAX_DEPTH': 13000, 'STEPS': 10, 'ITERATIONS': 10},
+        'threads': True,
+    },
+    {
+        'name': 'taxonomy',
+        'dir': 'Step9_TaxonomicAnalysis',
+        'command': ['taxonomy.py'],
+        'inputs': ['Step4_QCFeatureTableConstruction/rep-seqs.qza',
+                   'Step6_Decontamination/filtered-table.qza',
+                   METADATA],
+        'outputs': ['Step9_TaxonomicAnalysis/taxonomy.qza',
+                    'Step9_TaxonomicAnalysis/taxonomy_barplot.qzv'],
+        'params': {},
+        'threads': True,
+    },
+    {
+        'name': 'abundance',
+        'dir': 'Step10_AbundanceAnalysis',
+        'command': ['abundance.py'],
+        'inputs': ['Step6_Decontamination/filtered-table.qza',
+                   'Step9_TaxonomicAnalysis/taxonomy.qza',
+                   METADATA],
+        'outputs': ['Step10_AbundanceAnalysis/ancombc_results.qza',
+                    'Step10_AbundanceAnalysis/ancombc_disease_barplot.qzv',
+                    'Step10_AbundanceAnalysis/ancombc_tooth_barplot.qzv'],
+        'params': {},
+    },
+]
+
+#Directories the step scripts import their helper modules from (added to sys.path by the scripts)
+HELPER_DIRS = sorted({os.path.join(ROOT_DIR, step['dir']) for step in STEPS})
+
+
+
+def step_inputs(step: dict, overrides: dict = None) -> list:
+    '''
+    Returns the inputs of step: its fixed inputs plus every 'auto_inputs'
+    file one of whose parameters resolves to "auto".
+    '''
+    params = resolve_params(step, overrides or {})
+    auto_inputs = [fp for fp, names in step.get('auto_inputs', {}).items()
+                   if any(str(params.get(name)) == 'auto' for name in names)]
+    return step['inputs'] + auto_inputs
+
+
+def step_dependencies(steps: list, overrides: dict = None) -> dict:
+    '''
+    Derives the dependency graph of the pipeline from the step definitions.
+        Parameters:
+        ----------
+        steps : list
+            Step definitions (see STEPS)
+        overrides : dict
+            Parameter overrides (decide which 'auto_inputs' are inputs)
+        Returns:
+        -------
+        dict
+            Maps every step name to the names of the steps producing its inputs
+    '''
+    producers = {}
+    for step in steps:
+        for output in step['outputs']:
+            producers[output] = step['name']
+
+    return {step['name']: sorted({producers[fp] for fp in step_inputs(step, overrides) if fp in producers})
+            for step in steps}
+
+
+def select_steps(steps: list, targets: list, overrides: dict = None) -> list:
+    '''
+    Returns the steps needed to build targets (including all upstream steps)
+    in an order in which every step comes after its dependencies.
+        Parameters:
+        ----------
+        steps : list
+            Step definitions (see STEPS)
+        targets : list
+            Names of the requested steps, all steps except the optional ones if empty
+        overrides : dict
+            Parameter overrides
+    '''
+    by_name = {step['name']: step for step in steps}
+    dependencies = step_dependencies(steps, overrides)
+
+    unknown = [name for name in targets if name not in by_name]
+    if unknown:
+        raise ValueError('Unknown pipeline step(s): %s' % ', '.join(unknown))
+
+    ordered = []
+    visiting = set()
+
+    def visit(name):
+        if name in ordered:
+            return
+        if name in visiting:
+            raise ValueError('Dependency cycle at step: %s' % name)
+        visiting.add(name)
+        for dependency in dependencies[name]:
+            visit(dependency)
+        visiting.discard(name)
+        ordered.append(name)
+
+    for name in (targets or [step['name'] for step in steps if not step.get('optional')]):
+        visit(name)
+
+    return [by_name[name] for name in ordered]
+
+
+def resolve_params(step: dict, overrides: dict) -> dict:
+    '''Returns the parameters of step with the command line overrides applied.'''
+    params = {name: overrides.get(name, default) for name, default in step['params'].items()}
+    params.update(step.get('env', {}))
+    return params
+
+
+def step_command(step: dict) -> list:
+    '''Returns the command line that executes the step script.'''
+    script = step['command'][0]
+    interpreter = ['bash'] if script.endswith('.sh') else [sys.executable]
+    return interpreter + step['command']
+
+
+def run_step(step: dict, params: dict, n_threads: int = None, use_worker: bool = False) -> None:
+    '''
+    Executes a single step script inside its step directory.
+        Parameters:
+        ----------
+        step : dict
+            Step definition (see STEPS)
+        params : dict
+            Resolved parameters, handed to the script as environment variables
+        n_threads : int
+            Number of threads the step may use (N_THREADS), unset if None
+        use_worker : bool
+            Run Python steps in the running pipeline worker (pipeline_worker.py)
+    '''
+    step_env = {name: str(value) for name, value in params.items()}
+    if n_threads is not None:
+        step_env['N_THREADS'] = str(n_threads)
+
+    if use_worker and step['command'][0].endswith('.py'):
+        response = submit({'op': 'script', 'dir': step['dir'], 'script': step['command'][0],
+                           'args': step['command'][1:], 'env': step_env})
+        print(response['output'], end='')
+        if response['status'] != 0:
+            raise subprocess.CalledProcessError(response['status'], step_command(step))
+        return
+
+    env = dict(os.environ)
+    env.update(step_env)
+    subprocess.run(step_command(step), cwd=os.path.join(ROOT_DIR, step['dir']),
+                   env=env, check=True)
+
+
+def split_cores(free_cores: int, n_threaded: int) -> int:
+    '''
+    Returns the number of cores a thread-consuming step gets when it starts:
+    an equal share of the free cores between the thread-consuming steps that
+    are ready to run, at least one.
+    '''
+    return max(1, free_cores // max(1, n_threaded))
+
+
+def run_pipeline(targets: list = None, overrides: dict = None,
+                 force: bool = False, dry_run: bool = False,
+                 index: CacheIndex = None, jobs: int = 1,
+                 cores: int = None, use_worker: bool = False) -> list:
+    '''
+    Runs the pipeline and skips every step whose outputs are up to date.
+    Up to jobs steps whose dependencies are finished run at the same time.
+    A failed step does not stop the other branches: every step that does not
+    depend on it is still run, and all failures are reported at the end.
+        Parameters:
+        ----------
+        targets : list
+            Names of the steps to build (with their upstream steps), all if None
+        overrides : dict
+            Parameter values overriding the defaults in STEPS
+        force : bool
+            Re-run the selected steps even if their outputs are current
+        dry_run : bool
+            Only report which steps would run
+        index : CacheIndex
+            Cache index to use, the repository index if None
+        jobs : int
+            Maximum number of steps running at the same time
+        cores : int
+            Core budget shared by the running steps, all cores if None
+        use_worker : bool
+            Run Python steps in the running pipeline worker
+        Returns:
+        -------
+        list
+            Names of the steps that were (or would have been) executed
+        Raises:
+        -------
+        RuntimeError
+            If one or more steps failed (after all other runnable steps finished)
+    '''
+    overrides = overrides or {}
+    index = index or CacheIndex()
+    cores = cores or os.cpu_count() or 1
+    if use_worker and not dry_run and not worker_available():
+        raise ValueError('No pipeline worker is running, start it with: '
+                         'python Additional_Scripts/pipeline_worker.py serve')
+    dependencies = step_dependencies(STEPS, overrides)
+
+    pending = select_steps(STEPS, targets or [], overrides)
+    finished = set()
+    executed = []
+    rebuilt = set()
+    running = {}
+    free_cores = cores
+    failures = {}
+
+    def prepare(step):
+        #Returns the cache key of step, None if it is up to date
+        params = resolve_params(step, overrides)
+        input_fps = [os.path.join(ROOT_DIR, fp) for fp in step_inputs(step, params)]
+        output_fps = [os.path.join(ROOT_DIR, fp) for fp in step['outputs']]
+        script_fp = os.path.join(ROOT_DIR, step['dir'], step['command'][0])
+
+        #In a dry run the inputs rebuilt by an upstream step are not known yet
+        if dry_run and any(fp in rebuilt for fp in input_fps):
+            return ''
+        missing = [fp for fp in input_fps if not os.path.exists(fp)]
+        if missing:
+            raise FileNotFoundError('Missing inputs for step %s: %s' % (step['name'], missing))
+        key = step_key(input_fps, params, script_fp, local_modules(script_fp, HELPER_DIRS))
+        if not force and index.is_current(output_fps, key):
+            return None
+        return key
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        while pending or running:
+            ready = [step for step in pending
+                     if all(name in finished for name in dependencies[step['name']])]
+            n_threaded = sum(1 for step in ready if step.get('threads'))
+
+            for step in ready:
+                if len(running) >= max(1, jobs) or free_cores < 1:
+                    break
+                pending.remove(step)
+                try:
+                    key = prepare(step)
+                except Exception as e:
+                    print("[failed] %s: %s" % (step['name'], e))
+                    failures[step['name']] = e
+                    continue
+                if key is None:
+                    print("[skip] %s is up to date" % step['name'])
+                    finished.add(step['name'])
+                    continue
+
+                executed.append(step['name'])
+                rebuilt.update(os.path.join(ROOT_DIR, fp) for fp in step['outputs'])
+                if dry_run:
+                    print("[would run] %s" % step['name'])
+                    finished.add(step['name'])
+                    continue
+
+                params = resolve_params(step, overrides)
+                n_threads = None
+                n_cores = 1
+                if step.get('threads'):
+                    n_threads = cores if jobs <= 1 else split_cores(free_cores, n_threaded)
+                    n_cores = n_threads
+                    n_threaded -= 1
+                free_cores -= n_cores
+                print("[run] %s %s%s" % (step['name'], params if params else '',
+                                         ' (%d threads)' % n_threads if n_threads else ''))
+                future = executor.submit(run_step, step, params, n_threads, use_worker)
+                running[future] = (step, key, n_cores)
+
+            if not running:
+                #Everything left waits for a step that was skipped in this pass
+                if not any(all(name in finished for name in dependencies[step['name']])
+                           for step in pending):
+                    break
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step, key, n_cores = running.pop(future)
+                free_cores += n_cores
+                try:
+                    future.result()
+                except Exception as e:
+                    print("[failed] %s: %s" % (step['name'], e))
+                    failures[step['name']] = e
+                    continue
+                index.record([os.path.join(ROOT_DIR, fp) for fp in step['outputs']], key)
+                finished.add(step['name'])
+                print("[done] %s" % step['name'])
+
+    if failures:
+        #Steps left pending wait (directly or through another step) for a failed one
+        for step in pending:
+            print("[not run] %s (an upstream step failed)" % step['name'])
+        raise RuntimeError('%d step(s) failed: %s' % (len(failures), '; '.join(
+            '%s (%s)' % (name, e) for name, e in failures.items())))
+    return executed
+
+
+def parse_overrides(assignments: list) -> dict:
+    '''Parses NAME=VALUE assignments from the command line.'''
+    overrides = {}
+    for assignment in assignments:
+        name, sep, value = assignment.partition('=')
+        if not sep:
+            raise ValueError('Parameter must be given as NAME=VALUE: %s' % assignment)
+        overrides[name] = value
+    return overrides
+
+
+# --- EXECUTION BLOCK ---
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the pipeline steps that are out of date.')
+    parser.add_argument('targets', nargs='*',
+                        help='steps to build (default: all), e.g. diversity_analysis')
+    parser.add_argument('--set', dest='overrides', action='append', default=[],
+                        metavar='NAME=VALUE', help='override a step parameter, e.g. SAMPLING_DEPTH=10000')
+    parser.add_argument('--force', action='store_true', help='re-run the selected steps')
+    parser.add_argument('--dry-run', action='store_true', help='only list the steps that would run')
+    parser.add_argument('--list', action='store_true', help='print the steps and their dependencies')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of independent steps to run at the same time')
+    parser.add_argument('--cores', type=int, default=None,
+                        help='core budget shared by the running steps (default: all cores)')
+    parser.add_argument('--worker', action='store_true',
+                        help='run the Python steps in the running pipeline worker')
+    args = parser.parse_args()
+
+    if args.list:
+        optional = {step['name'] for step in STEPS if step.get('optional')}
+        for name, dependencies in step_dependencies(STEPS).items():
+            print("%s <- %s%s" % (name, ', '.join(dependencies) if dependencies else '-',
+                                  ' (optional, only run as target)' if name in optional else ''))
+        sys.exit(0)
+
+    try:
+        run_pipeline(args.targets, parse_overrides(args.overrides),
+                     force=args.force, dry_run=args.dry_run,
+                     jobs=args.jobs, cores=args.cores, use_worker=args.worker)
+    except (ValueError, FileNotFoundError, RuntimeError) as e:
+        print(f"❌ ERROR: Pipeline stopped. Details: {e}")
+        sys.exit(1)
+
+# in command line: python Additional_Scripts/pipeline_runner.py diversity_analysis --set SAMPLING_DEPTH=10000
+#                  python Additional_Scripts/pipeline_runner.py --jobs 4 --cores 16
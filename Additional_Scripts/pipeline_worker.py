@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+#Libraries
+import argparse
+import contextlib
+import io
+import os
+import runpy
+import sys
+import time
+import traceback
+from multiprocessing.connection import Client, Listener
+
+
+#This script keeps one Python process with the QIIME 2 plugin manager loaded
+#and runs step scripts or single actions on request over a local socket.
+#Loading the plugin manager takes several seconds per process, with the
+#worker this cost is paid once instead of once per step script.
+#
+#Requests are handled one after another: the step scripts change the working
+#directory and the environment, which are process wide. The modules of the
+#repository a script imports (helpers like beta_engine or qza_io) are unloaded
+#after every request, so an edited helper is imported again by the next step
+#and module constants read from the environment do not leak between steps.
+
+
+
+#Repository root and default socket location
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+SOCKET_FP = os.path.join(ROOT_DIR, ".pipeline_worker.sock")
+
+
+def load_plugin_manager():
+    '''Imports QIIME 2 and initializes the plugin manager (the slow part).'''
+    from qiime2.sdk import PluginManager
+    return PluginManager()
+
+
+def is_repository_module(module) -> bool:
+    '''Returns True if module was loaded from a file inside the repository.'''
+    module_fp = getattr(module, '__file__', None)
+    if not module_fp:
+        return False
+    return os.path.abspath(module_fp).startswith(ROOT_DIR + os.sep)
+
+
+def run_script(script_dir: str, script: str, args: list = None, env: dict = None) -> dict:
+    '''
+    Runs a step script inside the worker as if it was started with python.
+        Parameters:
+        ----------
+        script_dir : str
+            Directory the script is executed in (relative to the repository root)
+        script : str
+            File name of the script inside script_dir
+        args : list
+            Command line arguments of the script (sys.argv[1:])
+        env : dict
+            Environment variables set while the script runs
+        Returns:
+        -------
+        dict
+            Exit status and the captured output of the script
+    '''
+    work_dir = os.path.join(ROOT_DIR, script_dir)
+    script_fp = os.path.join(work_dir, script)
+
+    old_cwd, old_argv, old_path = os.getcwd(), sys.argv, list(sys.path)
+    old_env = dict(os.environ)
+    old_modules = set(sys.modules)
+    output = io.StringIO()
+    status = 0
+
+    os.chdir(work_dir)
+    sys.argv = [script_fp] + list(args or [])
+    sys.path.insert(0, work_dir)
+    os.environ.update({name: str(value) for name, value in (env or {}).items()})
+    try:
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            runpy.run_path(script_fp, run_name='__main__')
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception:
+        output.write(traceback.format_exc())
+        status = 1
+    finally:
+        os.chdir(old_cwd)
+        sys.argv = old_argv
+        sys.path[:] = old_path
+        os.environ.clear()
+        os.environ.update(old_env)
+        for name in [name for name, module in sys.modules.items()
+                     if name not in old_modules and is_repository_module(module)]:
+            del sys.modules[name]
+
+    return {'status': status, 'output': output.getvalue()}
+
+
+def run_action(plugin_manager, plugin: str, action: str, inputs: dict = None,
+               metadata: dict = None, params: dict = None, outputs: dict = None) -> dict:
+    '''
+    Runs a single QIIME 2 action and saves its outputs.
+        Parameters:
+        ----------
+        plugin_manager : PluginManager
+            The loaded plugin manager
+        plugin : str
+            Plugin name, e.g. feature_table or feature-table
+        action : str
+            Action name, e.g. summarize
+        inputs : dict
+            Maps input names to artifact file paths
+        metadata : dict
+            Maps metadata parameter names to a metadata file path or to a
+            [file path, column name] pair for MetadataColumn parameters
+        params : dict
+            Plain parameters of the action
+        outputs : dict
+            Maps output names to the file paths they are saved to
+        Returns:
+        -------
+        dict
+            Exit status and the paths of the saved outputs
+    '''
+    from qiime2 import Artifact, Metadata
+
+    plugin_obj = plugin_manager.plugins[plugin.replace('_', '-')]
+    action_obj = plugin_obj.actions[action.replace('-', '_')]
+
+    kwargs = dict(params or {})
+    for name, fp in (inputs or {}).items():
+        kwargs[name] = Artifact.load(fp)
+    for name, source in (metadata or {}).items():
+        if isinstance(source, (list, tuple)):
+            kwargs[name] = Metadata.load(source[0]).get_column(source[1])
+        else:
+            kwargs[name] = Metadata.load(source)
+
+    results = action_obj(**kwargs)
+
+    saved = {}
+    for name, fp in (outputs or {}).items():
+        saved[name] = getattr(results, name).save(fp)
+    return {'status': 0, 'outputs': saved}
+
+
+def serve(address: str = SOCKET_FP) -> None:
+    '''
+    Loads the plugin manager and answers requests until a shutdown request.
+        Parameters:
+        ----------
+        address : str
+            File path of the unix socket to listen on
+    '''
+    start = time.time()
+    plugin_manager = load_plugin_manager()
+    print("Plugin manager loaded in %.1f s" % (time.time() - start))
+
+    if os.path.exists(address):
+        os.remove(address)
+    listener = Listener(address, family='AF_UNIX')
+    os.chmod(address, 0o600)
+    print("Worker listening on %s" % address)
+
+    try:
+        while True:
+            with listener.accept() as conn:
+                request = conn.recv()
+                op = request.get('op')
+                start = time.time()
+                try:
+                    if op == 'ping':
+                        response = {'status': 0}
+                    elif op == 'shutdown':
+                        conn.send({'status': 0})
+                        break
+                    elif op == 'script':
+                        response = run_script(request['dir'], request['script'],
+                                              request.get('args'), request.get('env'))
+                    elif op == 'action':
+                        response = run_action(plugin_manager, request['plugin'], request['action'],
+                                              request.get('inputs'), request.get('metadata'),
+                                              request.get('params'), request.get('outputs'))
+                    else:
+                        response = {'status': 1, 'output': 'Unknown request: %s' % op}
+                except Exception:
+                    response = {'status': 1, 'output': traceback.format_exc()}
+                response['seconds'] = time.time() - start
+                print("%s finished in %.2f s (status %s)" % (op, response['seconds'], response['status']))
+                conn.send(response)
+    finally:
+        listener.close()
+        if os.path.exists(address):
+            os.remove(address)
+
+
+def submit(request: dict, address: str = SOCKET_FP) -> dict:
+    '''
+    Sends a request to a running worker and waits for the response.
+        Parameters:
+        ----------
+        request : dict
+            Request with an 'op' key ('ping', 'script', 'action' or 'shutdown')
+        address : str
+            File path of the worker socket
+    '''
+    with Client(address, family='AF_UNIX') as conn:
+        conn.send(request)
+        return conn.recv()
+
+
+def worker_available(address: str = SOCKET_FP) -> bool:
+    '''Returns True if a worker answers on address.'''
+    if not os.path.exists(address):
+        return False
+    try:
+        return submit({'op': 'ping'}, address)['status'] == 0
+    except (ConnectionError, OSError, EOFError):
+        return False
+
+
+# --- EXECUTION BLOCK ---
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Persistent QIIME 2 worker for the pipeline scripts.')
+    parser.add_argument('--socket', default=SOCKET_FP, help='unix socket of the worker')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('serve', help='start the worker (blocks)')
+    subparsers.add_parser('stop', help='stop a running worker')
+    run_parser = subparsers.add_parser('run', help='run a step script in the worker')
+    run_parser.add_argument('dir', help='step directory, e.g. Step5_Filtering')
+    run_parser.add_argument('script', help='script inside the step directory')
+    run_parser.add_argument('args', nargs=argparse.REMAINDER, help='arguments of the script')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.socket)
+    elif args.command == 'stop':
+        submit({'op': 'shutdown'}, args.socket)
+    else:
+        response = submit({'op': 'script', 'dir': args.dir, 'script': args.script,
+                           'args': args.args, 'env': {}}, args.socket)
+        print(response['output'], end='')
+        print("(%.2f s in worker)" % response['seconds'])
+        sys.exit(response['status'])
+
+# in command line: python Additional_Scripts/pipeline_worker.py serve &
+#                  python Additional_Scripts/pipeline_worker.py run Step5_Filtering summarize_filtering.py
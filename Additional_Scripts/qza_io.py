@@ -0,0 +1,288 @@
+#Libraries
+import io
+import mmap
+import os
+import shutil
+import struct
+import zipfile
+
+
+#This script contains helpers to write and read QIIME 2 archives (.qza/.qzv)
+#directly as zip files
+
+
+
+#Members that are already compressed are stored instead of deflated again
+STORED_SUFFIXES = ('.gz', '.bz2', '.xz', '.zip', '.qza')
+
+#Deflated members are extracted once into <EXTRACT_CACHE_DIR>/<uuid>/ and
+#memory mapped from there (can be moved with the QZA_CACHE_DIR variable)
+EXTRACT_CACHE_DIR = os.environ.get(
+    'QZA_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".qza_cache"))
+
+#Fixed part of a zip local file header (the data follows name and extra field)
+LOCAL_HEADER_SIZE = 30
+
+
+def _archive_root(artifact) -> str:
+    '''
+    Returns the directory of a loaded/created artifact that contains the
+    archive root (<uuid>/VERSION, <uuid>/metadata.yaml, <uuid>/data, ...).
+    '''
+    path = str(artifact._archiver.path)
+    uuid = str(artifact.uuid)
+    if os.path.basename(os.path.normpath(path)) == uuid:
+        return os.path.dirname(os.path.normpath(path))
+    if os.path.isdir(os.path.join(path, uuid)):
+        return path
+    raise ValueError('Could not locate the archive root of artifact %s' % uuid)
+
+
+def save_stored(artifact, output_fp: str, stored_suffixes: tuple = STORED_SUFFIXES) -> str:
+    '''
+    Saves an artifact like Artifact.save, but stores members that are already
+    compressed (e.g. fastq.gz) without deflating them a second time. The result
+    is a regular .qza that QIIME 2 loads like any other archive.
+        Parameters:
+        ----------
+        artifact : qiime2.Artifact
+            Artifact to save
+        output_fp : str
+            File path of the .qza to write
+        stored_suffixes : tuple
+            File name suffixes written with ZIP_STORED
+        Returns:
+        -------
+        str
+            File path of the written archive
+    '''
+    root = _archive_root(artifact)
+    source = os.path.join(root, str(artifact.uuid))
+    tmp_fp = output_fp + '.tmp'
+
+    with zipfile.ZipFile(tmp_fp, mode='w', compression=zipfile.ZIP_DEFLATED,
+                         allowZip64=True) as zf:
+        for dirpath, dirnames, filenames in os.walk(source):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                fp = os.path.join(dirpath, filename)
+                arcname = os.path.relpath(fp, root).replace(os.sep, '/')
+                compression = (zipfile.ZIP_STORED if filename.endswith(stored_suffixes)
+                               else zipfile.ZIP_DEFLATED)
+                zf.write(fp, arcname=arcname, compress_type=compression)
+
+    os.replace(tmp_fp, output_fp)
+    return output_fp
+
+
+class MappedFile(io.RawIOBase):
+    '''Read-only, seekable file object over a memoryview (used to hand members to h5py/pandas).'''
+
+    def __init__(self, view: memoryview):
+        self.view = view
+        self.pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        n = max(0, min(len(buffer), len(self.view) - self.pos))
+        buffer[:n] = self.view[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: len(self.view)}[whence]
+        self.pos = max(0, base + offset)
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+    def close(self) -> None:
+        # Releasing the view allows the underlying map to be closed
+        self.view.release()
+        self.view = memoryview(b'')
+        super().close()
+
+
+class QzaReader:
+    '''
+    Read-only access to the payload of a .qza without Artifact.load.
+
+    Stored members are memory mapped directly inside the archive, deflated
+    members are extracted once into the extract cache and memory mapped from
+    there. Use as a context manager, the maps are closed on exit.
+    '''
+
+    def __init__(self, qza_fp: str, cache_dir: str = EXTRACT_CACHE_DIR):
+        self.qza_fp = qza_fp
+        self.cache_dir = cache_dir
+        self.zf = zipfile.ZipFile(qza_fp)
+        self.uuid = self.zf.namelist()[0].split('/', 1)[0]
+        self._maps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        for mm in self._maps:
+            try:
+                mm.close()
+            except BufferError:
+                # A member view is still in use, the map is closed with it
+                pass
+        self._maps = []
+        self.zf.close()
+
+    def _map(self, fp: str) -> mmap.mmap:
+        with open(fp, 'rb') as fh:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mm)
+        return mm
+
+    def data_members(self) -> list:
+        '''Returns the file names inside <uuid>/data/.'''
+        prefix = '%s/data/' % self.uuid
+        return [name[len(prefix):] for name in self.zf.namelist()
+                if name.startswith(prefix) and not name.endswith('/')]
+
+    def member(self, name: str) -> memoryview:
+        '''
+        Returns a read-only view of a file in <uuid>/data/ (no copy of the data).
+            Parameters:
+            ----------
+            name : str
+                File name inside the data directory, e.g. feature-table.biom
+        '''
+        mm, start, size = self._locate(name)
+        return memoryview(mm)[start:start + size]
+
+    def _locate(self, name: str) -> tuple:
+        '''Returns (mmap, offset, size) of a data member, extracting deflated members once.'''
+        info = self.zf.getinfo('%s/data/%s' % (self.uuid, name))
+        if info.file_size == 0:
+            return b'', 0, 0
+
+        if info.compress_type == zipfile.ZIP_STORED:
+            # The data starts after the local header, its name and extra field
+            with open(self.qza_fp, 'rb') as fh:
+                fh.seek(info.header_offset)
+                header = fh.read(LOCAL_HEADER_SIZE)
+            name_len, extra_len = struct.unpack('<HH', header[26:30])
+            start = info.header_offset + LOCAL_HEADER_SIZE + name_len + extra_len
+            return self._map(self.qza_fp), start, info.file_size
+
+        cached_fp = os.path.join(self.cache_dir, self.uuid, 'data', name)
+        if not os.path.exists(cached_fp) or os.path.getsize(cached_fp) != info.file_size:
+            os.makedirs(os.path.dirname(cached_fp), exist_ok=True)
+            tmp_fp = '%s.%d.tmp' % (cached_fp, os.getpid())
+            with self.zf.open(info) as src, open(tmp_fp, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 4 * 1024 * 1024)
+            os.replace(tmp_fp, cached_fp)
+        return self._map(cached_fp), 0, info.file_size
+
+    def open_member(self, name: str) -> MappedFile:
+        '''Returns a seekable file object over a data member.'''
+        return MappedFile(self.member(name))
+
+    def table(self) -> tuple:
+        '''
+        Reads a FeatureTable (BIOM 2.1 HDF5) as a SciPy CSR matrix.
+            Returns:
+            -------
+            tuple
+                (feature x sample csr_matrix, feature IDs, sample IDs)
+        '''
+        import h5py
+        import numpy as np
+        import scipy.sparse as sp
+
+        with self.open_member('feature-table.biom') as fh, h5py.File(fh, 'r') as h5:
+            feature_ids = np.array([i.decode() for i in h5['observation/ids'][:]], dtype=object)
+            sample_ids = np.array([i.decode() for i in h5['sample/ids'][:]], dtype=object)
+            matrix = sp.csr_matrix((h5['observation/matrix/data'][:],
+                                    h5['observation/matrix/indices'][:],
+                                    h5['observation/matrix/indptr'][:]),
+                                   shape=(len(feature_ids), len(sample_ids)))
+        return matrix, feature_ids, sample_ids
+
+    def distance_matrix(self) -> tuple:
+        '''
+        Reads a DistanceMatrix (distance-matrix.tsv) as a NumPy array.
+            Returns:
+            -------
+            tuple
+                (square float array, sample IDs)
+        '''
+        import pandas as pd
+
+        with self.open_member('distance-matrix.tsv') as fh:
+            frame = pd.read_csv(io.BufferedReader(fh), sep='\t', index_col=0, dtype={0: str})
+        return frame.to_numpy(dtype=float), list(frame.index.astype(str))
+
+    def alpha_diversity(self):
+        '''
+        Reads SampleData[AlphaDiversity] (alpha-diversity.tsv) as a pandas Series.
+            Returns:
+            -------
+            pd.Series
+                Alpha values indexed by sample ID, named after the metric
+        '''
+        import pandas as pd
+
+        with self.open_member('alpha-diversity.tsv') as fh:
+            frame = pd.read_csv(io.BufferedReader(fh), sep='\t', index_col=0, dtype={0: str})
+        series = frame.iloc[:, 0].astype(float)
+        series.index = series.index.astype(str)
+        return series
+
+    def sequences(self, name: str = 'dna-sequences.fasta'):
+        '''Yields (id, sequence) of a FASTA member one record at a time.'''
+        data, start, size = self._locate(name)
+        stop = start + size
+        seq_id, parts = None, []
+        while start < stop:
+            end = data.find(b'\n', start, stop)
+            end = stop if end == -1 else end
+            line = data[start:end].rstrip(b'\r')
+            start = end + 1
+            if line.startswith(b'>'):
+                if seq_id is not None:
+                    yield seq_id, b''.join(parts).decode()
+                seq_id, parts = line[1:].split(None, 1)[0].decode(), []
+            elif line:
+                parts.append(line)
+        if seq_id is not None:
+            yield seq_id, b''.join(parts).decode()
+
+
+def read_table(qza_fp: str) -> tuple:
+    '''Returns (csr_matrix, feature IDs, sample IDs) of a FeatureTable .qza.'''
+    with QzaReader(qza_fp) as qza:
+        return qza.table()
+
+
+def read_distance_matrix(qza_fp: str) -> tuple:
+    '''Returns (square array, sample IDs) of a DistanceMatrix .qza.'''
+    with QzaReader(qza_fp) as qza:
+        return qza.distance_matrix()
+
+
+def read_alpha_diversity(qza_fp: str):
+    '''Returns the values of a SampleData[AlphaDiversity] .qza as a pandas Series.'''
+    with QzaReader(qza_fp) as qza:
+        return qza.alpha_diversity()
+
+
+def iter_sequences(qza_fp: str):
+    '''Lazily yields (feature ID, sequence) of a FeatureData[Sequence] .qza.'''
+    with QzaReader(qza_fp) as qza:
+        yield from qza.sequences()
@@ -1,5 +1,7 @@
 #!/bin/bash
 
+# Superseded by Additional_Scripts/md5_verifier.py (parallel and cached)
+
 # File containing the MD5 checksums
 MD5_FILE="20241209_HN00230849_MAS_Report/assets/spgs/HN00230849_23samples_md5sum_DownloadLink.txt"
 
@@ -4,12 +4,16 @@
 
 # Library
 import os
-from qiime2 import Artifact, Metadata
+import sys
+
 import qiime2.plugins.composition.actions as composition_actions
 import qiime2.plugins.taxa.actions as taxa_actions
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Additional_Scripts'))
+from artifact_cache import load_artifact, load_metadata
+
 # paths and names
-METADATA = os.path.join("../", "Data/", "metadata_for_q.csv")
+METADATA = os.path.join("../", "Data/", "metadata.tsv")
 TABLE = os.path.join("../", "Step6_Decontamination/", "filtered-table.qza")
 TAXONOMY = os.path.join("../", "Step9_TaxonomicAnalysis/", "taxonomy.qza")
 
@@ -26,8 +30,8 @@ print("=============================================")
 #Loading  artifact
 print("Loading artifacts...")
 try:
-    table = Artifact.load(TABLE)
-    metadata = Metadata.load(METADATA)
+    table = load_artifact(TABLE)
+    metadata = load_metadata(METADATA)
 except Exception as e:
     print(f"An error occurred while loading artifacts: {e}")
     exit(1)
@@ -62,7 +66,7 @@ print("Collapsing to Genus level...")
 
 print("Loading taxonomy artifact...")
 try:
-    taxonomy = Artifact.load(TAXONOMY)
+    taxonomy = load_artifact(TAXONOMY)
 except Exception as e:
     print(f"An error occurred while loading taxonomy artifact: {e}")
     exit(1)
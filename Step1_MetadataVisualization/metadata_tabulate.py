@@ -5,12 +5,15 @@
 #This script reads a metadata file and generates a QIIME 2 visualization by 
 #tabulating the metadata using tabulate from the qiime2.plugins
 
-import qiime2
 from qiime2.plugins.metadata.actions import tabulate
 import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Additional_Scripts'))
+from artifact_cache import load_metadata
 
 # Setting up paths and filenames
-METADATA_FILE = '../Data/metadata_for_q.csv' 
+METADATA_FILE = '../Data/metadata.tsv' 
 
 # Output visualization file name
 OUTPUT_VIS_FILE = 'tabulated_metadata.qzv'
@@ -28,7 +31,7 @@ print(f"Reading metadata from: {METADATA_FILE}")
 # The tabulate action requires the metadata to be passed as a QIIME 2 Metadata object.
 # We read the file directly into this object.
 try:
-    metadata_obj = qiime2.Metadata.load(METADATA_FILE)
+    metadata_obj = load_metadata(METADATA_FILE)
 except Exception as e:
     print(f"Error loading metadata file. Check formatting (TSV/CSV dialect).")
     print(f"Details: {e}")
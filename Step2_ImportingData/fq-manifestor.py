@@ -1,11 +1,155 @@
 #!/usr/bin/env python
 
-import glob
+import argparse
+import gzip
+import json
 import os.path
 import re 
+import shutil
 import sys
-import subprocess
-import shlex
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Additional_Scripts'))
+
+#Read size used when checking the gzip files
+CHUNK_SIZE = 4 * 1024 * 1024
+
+def _list_dir(dirpath, dir_cache=None):
+    """
+    Returns (name, is_dir, is_symlink) of the entries of a directory in scandir order.
+
+    With a dir_cache the listing is reused as long as the modification time of
+    the directory is unchanged (adding, removing or renaming entries updates it).
+    """
+    if dir_cache is not None:
+        try:
+            mtime_ns = os.stat(dirpath).st_mtime_ns
+        except OSError:
+            return []
+        cached = dir_cache.get(dirpath)
+        if cached is not None and cached['mtime_ns'] == mtime_ns:
+            return cached['entries']
+
+    try:
+        with os.scandir(dirpath) as it:
+            entries = [[entry.name, entry.is_dir(), entry.is_symlink()] for entry in it]
+    except OSError:
+        entries = []
+
+    if dir_cache is not None:
+        dir_cache[dirpath] = {'mtime_ns': mtime_ns, 'entries': entries}
+    return entries
+
+
+def _points_to_parent(dirpath, name):
+    """True if the symlink dirpath/name resolves to dirpath or one of its parents."""
+    target = os.path.realpath(os.path.join(dirpath, name))
+    real_dirpath = os.path.realpath(dirpath)
+    return real_dirpath == target or real_dirpath.startswith(target.rstrip(os.sep) + os.sep)
+
+
+def find_fastqs(input_dir, fq_extensions=('fastq.gz', 'fq.gz'), dir_cache=None):
+    """
+    Finds the fastq files below input_dir in one os.scandir walk.
+
+    The order is the one of glob.glob('<input_dir>/**/*.<extension>', recursive=True)
+    run once per extension: grouped by extension, directories in pre-order,
+    entries in scandir order, hidden files and directories skipped. Symlinked
+    directories are followed like glob does, unless they point back to one of
+    their parents (glob would loop until the path gets too long).
+    """
+    suffixes = ['.' + fq_extension for fq_extension in fq_extensions]
+    by_extension = [[] for _ in suffixes]
+
+    stack = [input_dir]
+    while stack:
+        dirpath = stack.pop()
+        subdirs = []
+        for name, is_dir, is_symlink in _list_dir(dirpath, dir_cache):
+            if name.startswith('.'):
+                continue
+            if is_dir and not (is_symlink and _points_to_parent(dirpath, name)):
+                subdirs.append(os.path.join(dirpath, name))
+            for i, suffix in enumerate(suffixes):
+                if name.endswith(suffix):
+                    by_extension[i].append(os.path.join(dirpath, name))
+        # Reversed so the first subdirectory is walked next (pre-order)
+        stack.extend(reversed(subdirs))
+
+    return [fp for fps in by_extension for fp in fps]
+
+
+def pair_fastqs(fq_filepaths,
+                split_pattern='_',
+                f_read_pattern='_1.',
+                r_read_pattern='_2.'):
+    """
+    Assigns fastq files to sample IDs and read directions in one pass.
+
+    Returns the {sample-id: [forward filepath, reverse filepath]} mapping and a
+    report of the problems found: files without sample ID or read direction,
+    samples with a missing read and sample IDs found more than once for the
+    same read direction (the last file wins, as before).
+    """
+    split_re = re.compile(split_pattern)
+    f_read_re = re.compile(f_read_pattern)
+    r_read_re = re.compile(r_read_pattern)
+
+    sids_to_fps = {}
+    seen = {}
+    report = {'n_files': len(fq_filepaths),
+              'no_sample_id': [],
+              'no_direction': [],
+              'unpaired': {},
+              'duplicates': {}}
+
+    for fq_filepath in fq_filepaths:
+        fq_filename = os.path.basename(fq_filepath)
+        sid_fields = split_re.split(fq_filename, maxsplit=1)
+        if len(sid_fields) == 1:
+            report['no_sample_id'].append(fq_filepath)
+            continue
+        sid = sid_fields[0]
+
+        if f_read_re.search(fq_filename):
+            direction = 0
+        elif r_read_re.search(fq_filename):
+            direction = 1
+        else:
+            report['no_direction'].append(fq_filepath)
+            continue
+
+        sid_fps = sids_to_fps.setdefault(sid, [None, None])
+        sid_fps[direction] = fq_filepath
+        seen.setdefault((sid, direction), []).append(fq_filepath)
+
+    for (sid, direction), fps in seen.items():
+        if len(fps) > 1:
+            report['duplicates'].setdefault(sid, {})[('forward', 'reverse')[direction]] = fps
+    for sid, (fwd_fq_filepath, rev_fq_filepath) in sids_to_fps.items():
+        if fwd_fq_filepath is None:
+            report['unpaired'][sid] = 'forward'
+        elif rev_fq_filepath is None:
+            report['unpaired'][sid] = 'reverse'
+
+    report['n_samples'] = len(sids_to_fps)
+    return sids_to_fps, report
+
+
+def print_report(report):
+    """Prints the problems of a pair_fastqs report."""
+    for fp in report['no_sample_id']:
+        print('Sample ID not found in file: %s' % fp)
+    for fp in report['no_direction']:
+        print('Forward/reverse patterns not found in file: %s' % fp)
+    for sid, missing in report['unpaired'].items():
+        print('Missing %s read for sample: %s' % (missing, sid))
+    for sid, directions in report['duplicates'].items():
+        for direction, fps in directions.items():
+            print('Duplicate %s reads for sample %s, using the last one: %s'
+                  % (direction, sid, ', '.join(fps)))
+
 
 def fq_manifestor(input_dir,
                   output_fp,
@@ -14,118 +158,233 @@ def fq_manifestor(input_dir,
                   f_read_pattern='_1.',
                   r_read_pattern='_2.',
                   filter_pattern=None,
+                  md5_fp=None,
+                  n_workers=8,
+                  dir_cache_fp=None,
                   verbose=True):
 
     input_dir = os.path.abspath(input_dir)
     if verbose: print("Searching directory: %s" % input_dir)
 
-    fq_filepaths = []
-    for fq_extension in fq_extensions:
-        fq_filepaths += glob.glob('%s/**/*.%s' % (input_dir, fq_extension),
-                                 recursive = True)
+    dir_cache = None
+    if dir_cache_fp is not None:
+        dir_cache = {}
+        if os.path.exists(dir_cache_fp):
+            with open(dir_cache_fp) as fh:
+                dir_cache = json.load(fh)
+
+    fq_filepaths = find_fastqs(input_dir, fq_extensions, dir_cache)
     if filter_pattern is not None:
         fq_filepaths = [fp for fp in fq_filepaths if filter_pattern in fp]
 
+    if dir_cache is not None:
+        with open(dir_cache_fp + '.tmp', 'w') as fh:
+            json.dump(dir_cache, fh)
+        os.replace(dir_cache_fp + '.tmp', dir_cache_fp)
+
     n_fq_filepaths = len(fq_filepaths)
     if verbose: print('Found %d fastq files.' % n_fq_filepaths)
 
-    sids_to_fps = {}
+    sids_to_fps, report = pair_fastqs(fq_filepaths, split_pattern,
+                                      f_read_pattern, r_read_pattern)
+    if verbose: print_report(report)
 
-    for fq_filepath in fq_filepaths:
-        fq_filename = os.path.basename(fq_filepath)
-        sid_fields = re.split(split_pattern, fq_filename)
-
-        if len(sid_fields) == 1:
-            raise ValueError('Sample ID not found in file: %s' % fq_filepath)
-        else:
-            sid = sid_fields[0]
-
-        if bool(re.search(f_read_pattern, fq_filename)):
-            forward = True
-            reverse = False
-        elif bool(re.search(r_read_pattern, fq_filename)):
-            forward = False
-            reverse = True
-        else:
-            raise ValueError('Forward/reverse patterns not found in file: %s' % fq_filepath)
-
-        try:
-            sid_fps = sids_to_fps[sid]
-        except KeyError:
-            sid_fps = [None, None]
-
-        if forward:
-            sid_fps[0] = fq_filepath
-        else:
-            sid_fps[1] = fq_filepath
-        sids_to_fps[sid] = sid_fps
+    if report['no_sample_id']:
+        raise ValueError('Sample ID not found in file: %s' % report['no_sample_id'][0])
+    if report['no_direction']:
+        raise ValueError('Forward/reverse patterns not found in file: %s' % report['no_direction'][0])
+    if report['unpaired']:
+        raise ValueError('Missing reads for samples: %s' % ', '.join(
+            '%s (%s)' % (sid, missing) for sid, missing in report['unpaired'].items()))
 
     lines = ['sample-id\tforward-absolute-filepath\treverse-absolute-filepath']
     for sid, (fwd_fq_filepath, rev_fq_filepath) in sids_to_fps.items():
-        if fwd_fq_filepath is None:
-            raise ValueError('Missing forward read for sample: %s' % sid)
-
-        if rev_fq_filepath is None:
-            raise ValueError('Missing reverse read for sample: %s' % sid)
-
         lines.append('%s\t%s\t%s' % (sid, fwd_fq_filepath, rev_fq_filepath))
 
-    if (len(lines) - 1) != (n_fq_filepaths / 2) and verbose:
+    if 2 * (len(lines) - 1) != n_fq_filepaths and verbose:
         print("\n** WARNING**: "
               "The number of manifest records doesn't align with the number of "
               "fastq files that were found. It's possible that the match "
               "patterns aren't working correctly for your files. These can "
               "be customized when using the API.\n")
 
+    if md5_fp is not None:
+        fq_filepaths = [fp for line in lines[1:] for fp in line.split('\t')[1:]]
+        check_md5(fq_filepaths, md5_fp, input_dir, n_workers, verbose)
+
     with open(output_fp, 'w') as of:
         of.write('\n'.join(lines))
         of.write('\n')
 
+    return report
+
+def check_md5(fq_filepaths, md5_fp, input_dir, n_workers=8, verbose=True):
+    """Verifies fastq files against the provider md5 list, raises ValueError on corrupt files."""
+    from md5_verifier import CACHE_FN, read_md5_list, verify_files
+
+    expected = read_md5_list(md5_fp)
+    unlisted = [fp for fp in fq_filepaths if os.path.basename(fp) not in expected]
+    if unlisted and verbose:
+        print('** WARNING**: %d fastq files are not in the md5 list: %s'
+              % (len(unlisted), ', '.join(os.path.basename(fp) for fp in unlisted)))
+
+    jobs = [(fp, expected[os.path.basename(fp)]) for fp in fq_filepaths
+            if os.path.basename(fp) in expected]
+    results = verify_files(jobs, n_workers, os.path.join(input_dir, CACHE_FN), verbose)
+    failed = [fp for fp, status in results.items() if status == 'FAILED']
+    if failed:
+        raise ValueError('md5 checksum mismatch, refusing corrupt inputs: %s' % ', '.join(failed))
+
+def read_manifest(manifest_fp):
+    """Returns (sample-id, forward filepath, reverse filepath) records of a manifest."""
+    records = []
+    with open(manifest_fp) as fh:
+        next(fh)
+        for line in fh:
+            if line.strip():
+                sid, fwd_fp, rev_fp = line.rstrip('\n').split('\t')
+                records.append((sid, fwd_fp, rev_fp))
+    return records
+
+
+def validate_gzip(fq_filepath):
+    """Decompresses a gzip file to the end so truncated or corrupt files fail (CRC/length check)."""
+    try:
+        with gzip.open(fq_filepath, 'rb') as fh:
+            while fh.read(CHUNK_SIZE):
+                pass
+    except (OSError, EOFError) as e:
+        return '%s: %s' % (fq_filepath, e)
+    return None
+
+
+def validate_fastqs(manifest_fp, n_workers=None, verbose=True):
+    """Checks all gzip files of a manifest in parallel, raises ValueError on corrupt files."""
+    filepaths = [fp for _, fwd_fp, rev_fp in read_manifest(manifest_fp) for fp in (fwd_fp, rev_fp)]
+    if verbose: print('Validating %d gzip files...' % len(filepaths))
+
+    with ThreadPoolExecutor(max_workers=n_workers or os.cpu_count()) as executor:
+        errors = [error for error in executor.map(validate_gzip, filepaths) if error]
+
+    if errors:
+        raise ValueError('Corrupt fastq files:\n%s' % '\n'.join(errors))
+
+
+def build_paired_dirfmt(manifest_fp, staging_dir):
+    """
+    Lays out the reads of a manifest as SingleLanePerSamplePairedEndFastqDirFmt
+    using hardlinks (copies only across filesystems), no read data is rewritten.
+    """
+    manifest_lines = ['sample-id,filename,direction']
+    for i, (sid, fwd_fp, rev_fp) in enumerate(read_manifest(manifest_fp), start=1):
+        for fp, read_number, direction in ((fwd_fp, 1, 'forward'), (rev_fp, 2, 'reverse')):
+            filename = '%s_%d_L001_R%d_001.fastq.gz' % (sid, i, read_number)
+            target_fp = os.path.join(staging_dir, filename)
+            try:
+                os.link(fp, target_fp)
+            except OSError:
+                shutil.copyfile(fp, target_fp)
+            manifest_lines.append('%s,%s,%s' % (sid, filename, direction))
+
+    with open(os.path.join(staging_dir, 'MANIFEST'), 'w') as of:
+        of.write('\n'.join(manifest_lines))
+        of.write('\n')
+    with open(os.path.join(staging_dir, 'metadata.yml'), 'w') as of:
+        of.write('{phred-offset: 33}\n')
+
+
+def import_manifest(manifest_fp, output_fp, reference=False, validate=True, n_workers=None):
+    """
+    Imports the reads of a manifest as SampleData[PairedEndSequencesWithQuality].
+
+    By default this is the in-process equivalent of 'qiime tools import' with
+    PairedEndFastqManifestPhred33V2. With reference=True the gzip files are
+    validated in parallel, hardlinked into the directory format and written
+    into the archive without recompression (read once, stored as-is).
+    """
+    from qiime2 import Artifact
+
+    semantic_type = 'SampleData[PairedEndSequencesWithQuality]'
+    if not reference:
+        demux = Artifact.import_data(semantic_type, manifest_fp,
+                                     view_type='PairedEndFastqManifestPhred33V2')
+        demux.save(output_fp)
+        return
+
+    from qza_io import save_stored
+
+    if validate:
+        validate_fastqs(manifest_fp, n_workers)
+
+    # Staging next to the output so hardlinks stay on one filesystem
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_fp))) as staging_dir:
+        build_paired_dirfmt(manifest_fp, staging_dir)
+        demux = Artifact.import_data(semantic_type, staging_dir,
+                                     view_type='SingleLanePerSamplePairedEndFastqDirFmt')
+        save_stored(demux, output_fp)
+
 # --- EXECUTION BLOCK ---
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print('USAGE: python fq_manifestor.py input-directory output-filepath')
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description='Create a fastq manifest and import the reads into demux.qza.')
+    parser.add_argument('input_dir', help='directory with the *_1/_2 fastq.gz files')
+    parser.add_argument('output_fp', help='file path of the manifest')
+    parser.add_argument('--output-artifact', default='demux.qza', help='imported artifact (default: demux.qza)')
+    parser.add_argument('--reference', action='store_true',
+                        help='hardlink the reads and store them in the archive without recompression')
+    parser.add_argument('--no-validate', action='store_true',
+                        help='with --reference: skip the parallel gzip check')
+    parser.add_argument('--threads', type=int, default=None, help='threads for the gzip and md5 checks')
+    parser.add_argument('--md5-file', default=None,
+                        help='provider md5 list, corrupt fastq files (of a new or an existing manifest) stop the import')
+    parser.add_argument('--dir-cache', default=None,
+                        help='JSON cache of directory listings, unchanged directories are not listed again')
+    parser.add_argument('--report', default=None,
+                        help='write the pairing report (unpaired and duplicate sample IDs) as JSON')
+    args = parser.parse_args()
 
-    input_dir = sys.argv[1]
-    output_fp = sys.argv[2]
+    input_dir = args.input_dir
+    output_fp = args.output_fp
     output_fp_abs = os.path.abspath(output_fp)
     
 # 1. CHECK FOR EXISTING MANIFEST FILE
     if os.path.exists(output_fp_abs):
         print(f"✅ Manifest file already exists at: {output_fp_abs}")
         print("Skipping manifest generation and proceeding directly to QIIME 2 import.")
+        # The reads of an existing manifest are verified as well, they may have changed since
+        if args.md5_file is not None:
+            try:
+                fq_filepaths = [fp for _, fwd_fp, rev_fp in read_manifest(output_fp_abs) for fp in (fwd_fp, rev_fp)]
+                check_md5(fq_filepaths, args.md5_file, input_dir, args.threads or 8)
+            except Exception as e:
+                print(f"❌ ERROR: md5 verification failed. Details: {e}")
+                sys.exit(1)
     else:
         # 2. Generate the manifest file if it doesn't exist
         print("Manifest file not found. Starting generation...")
         try:
-            fq_manifestor(input_dir, output_fp) 
+            report = fq_manifestor(input_dir, output_fp, md5_fp=args.md5_file,
+                                   n_workers=args.threads or 8, dir_cache_fp=args.dir_cache)
+            if args.report is not None:
+                with open(args.report, 'w') as of:
+                    json.dump(report, of, indent=2)
             print(f"Successfully created manifest file: {output_fp_abs}")
         except Exception as e:
             print(f"❌ ERROR: Manifest generation failed. Details: {e}")
             sys.exit(1)
 
-# 2. Define and execute the QIIME 2 import command
+# 2. Import the reads in-process (no separate qiime CLI start)
     print("--- Running QIIME 2 Import ---")
+    if args.reference:
+        print("Reference mode: reads are hardlinked and stored without recompression.")
 
-    qiime_command = (
-        f"qiime tools import "
-        f"--type 'SampleData[PairedEndSequencesWithQuality]' "
-        f"--input-path {output_fp_abs} "
-        f"--output-path demux.qza "
-        f"--input-format PairedEndFastqManifestPhred33V2"
-    )
-
-    print(f"Executing: {qiime_command}")
-    
     try:
-        # Use shlex.split to correctly handle spaces and arguments
-        subprocess.run(shlex.split(qiime_command), check=True)
-        print("\n✅ Successfully imported data! Artifact saved as demux.qza.")
-    except subprocess.CalledProcessError as e:
+        import_manifest(output_fp_abs, args.output_artifact, reference=args.reference,
+                        validate=not args.no_validate, n_workers=args.threads)
+        print(f"\n✅ Successfully imported data! Artifact saved as {args.output_artifact}.")
+    except Exception as e:
         print(f"\n❌ ERROR: QIIME 2 import failed.")
         print(f"Check your manifest file paths and QIIME 2 environment.")
         print(f"Details: {e}")
         sys.exit(1)
 
-# in command line: python fq_manifestor.py ~/Fallstudie/20241209-raw_data fastq-manifest.tsv
\ No newline at end of file
+# in command line: python fq_manifestor.py ~/Fallstudie/20241209-raw_data fastq-manifest.tsv [--reference]
\ No newline at end of file
@@ -1,32 +1,554 @@
 #!/usr/bin/env python
 
+import argparse
+import itertools
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
 import qiime2.plugins.dada2.actions as dada2_actions
-from qiime2 import Artifact
-
-# 1. Load data 
-print("Loading data...")
-demux_paired = Artifact.load('../Step2_ImportingData/demux.qza')
-
-# 2. Run DADA2
-print("Running DADA2...")
-results = dada2_actions.denoise_paired(
-    demultiplexed_seqs=demux_paired,
-    trim_left_f=15,     # Cut the first 20 bases (removes the "dip" at pos 11-14) 
-    trunc_len_f=280,    # Truncate forward reads at 250 bases  
-    trim_left_r=0,      # No trimming for reverse reads
-    trunc_len_r=240,    # Truncate reverse reads at 200 bases
-    n_threads=0         # Use all available cores
-)
-
-# 3. Extract the parts we need using their specific names
-table = results.table
-representative_sequences = results.representative_sequences
-denoising_stats = results.denoising_stats
-
-# 4. Saving the files 
-print("Saving output files...")
-table.save('table.qza')
-representative_sequences.save('rep-seqs.qza')
-denoising_stats.save('denoising-stats.qza')
-
-print("Done!")
\ No newline at end of file
+import qiime2.plugins.feature_table.actions as feature_table_actions
+from qiime2 import Artifact, Metadata
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Additional_Scripts'))
+from pipeline_cache import CacheIndex, step_key
+
+# Suggestions of quality_profiler.py, used for parameters set to "auto"
+SUGGESTIONS_FP = 'quality_suggestions.json'
+
+# Input, outputs and the directory of the parameter sweep
+DEMUX_FP = '../Step2_ImportingData/demux.qza'
+OUTPUT_FNS = {'table': 'table.qza',
+              'representative_sequences': 'rep-seqs.qza',
+              'denoising_stats': 'denoising-stats.qza'}
+SWEEP_DIR = 'dada2_sweep'
+SWEEP_INDEX_FP = os.path.join(SWEEP_DIR, '.sweep_cache.json')
+
+# Sharded mode: the reads come from the import manifest, one DADA2 run per shard
+MANIFEST_FP = '../Step2_ImportingData/fastq-manifest.tsv'
+METADATA_FP = '../Data/metadata.tsv'
+SHARD_DIR = 'dada2_shards'
+SHARD_INDEX_FP = os.path.join(SHARD_DIR, '.shard_cache.json')
+
+# Read counts of the denoising stats compared in the sweep table
+STATS_COLUMNS = ['input', 'filtered', 'denoised', 'merged', 'non-chimeric']
+
+def trim_trunc_param(name, default):
+    '''
+    Reads a DADA2 trim/trunc parameter from the environment (the default if it is not set).
+    "auto" takes the value suggested by quality_profiler.py.
+        Parameters:
+        ----------
+        name : str
+            Name of the environment variable, e.g. TRUNC_LEN_F
+        default : int
+            Value used if the variable is not set
+        Returns:
+        -------
+        int
+            Number of bases
+    '''
+    value = os.environ.get(name, str(default))
+    if value != 'auto':
+        return int(value)
+    with open(SUGGESTIONS_FP) as fh:
+        return int(json.load(fh)[name.lower()])
+
+# Parameters (can be overridden by the pipeline runner through environment variables)
+TRIM_LEFT_F = trim_trunc_param('TRIM_LEFT_F', 15)
+TRUNC_LEN_F = trim_trunc_param('TRUNC_LEN_F', 280)
+TRIM_LEFT_R = trim_trunc_param('TRIM_LEFT_R', 0)
+TRUNC_LEN_R = trim_trunc_param('TRUNC_LEN_R', 240)
+N_THREADS = int(os.environ.get('N_THREADS', 0))
+
+
+def run_dada2(demux_paired, params, n_threads=0):
+    '''
+    Runs denoise_paired with the trim/trunc values in params.
+        Parameters:
+        ----------
+        demux_paired : Artifact
+            SampleData[PairedEndSequencesWithQuality]
+        params : dict
+            trim_left_f, trunc_len_f, trim_left_r and trunc_len_r
+        n_threads : int
+            Threads of DADA2 (0 = all available cores)
+        Returns:
+        -------
+        Results
+            table, representative_sequences and denoising_stats
+    '''
+    return dada2_actions.denoise_paired(
+        demultiplexed_seqs=demux_paired,
+        trim_left_f=params['trim_left_f'],    # Default 15: removes the "dip" at pos 11-14
+        trunc_len_f=params['trunc_len_f'],    # Default 280 bases
+        trim_left_r=params['trim_left_r'],    # Default 0: no trimming for reverse reads
+        trunc_len_r=params['trunc_len_r'],    # Default 240 bases
+        n_threads=n_threads                   # 0 = use all available cores
+    )
+
+
+def output_fps(output_dir):
+    '''
+    Returns the file paths of the three DADA2 outputs in a directory.
+        Parameters:
+        ----------
+        output_dir : str
+            Directory of the outputs
+        Returns:
+        -------
+        list
+            File paths of the table, representative sequences and denoising stats
+    '''
+    return [os.path.join(output_dir, fn) for fn in OUTPUT_FNS.values()]
+
+
+def save_outputs(results, output_dir):
+    '''
+    Saves the three DADA2 outputs to a directory.
+        Parameters:
+        ----------
+        results : Results
+            Results of denoise_paired
+        output_dir : str
+            Directory of the outputs (created if missing)
+        Returns:
+        -------
+        str
+            The output directory
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    for name, fn in OUTPUT_FNS.items():
+        getattr(results, name).save(os.path.join(output_dir, fn))
+    return output_dir
+
+
+def denoise_to_dir(demux_fp, params, n_threads, output_dir):
+    '''
+    Loads the reads, runs DADA2 and saves the outputs (runs in a worker process).
+        Parameters:
+        ----------
+        demux_fp : str
+            File path of the demultiplexed reads (.qza)
+        params : dict
+            Trim/trunc values (see run_dada2)
+        n_threads : int
+            Threads of DADA2
+        output_dir : str
+            Directory of the outputs
+        Returns:
+        -------
+        str
+            The output directory
+    '''
+    return save_outputs(run_dada2(Artifact.load(demux_fp), params, n_threads), output_dir)
+
+
+def pool_size(n_tasks, cores, jobs=None):
+    '''
+    Splits the cores between DADA2 runs that share them.
+        Parameters:
+        ----------
+        n_tasks : int
+            Number of DADA2 runs
+        cores : int
+            Core budget
+        jobs : int
+            Runs at the same time (default: one per core)
+        Returns:
+        -------
+        tuple
+            (jobs at a time, threads per job)
+    '''
+    n_jobs = max(1, min(jobs or cores, n_tasks, cores))
+    return n_jobs, max(1, cores // n_jobs)
+
+
+def sweep_dirname(params):
+    '''
+    Returns the directory name of one parameter combination.
+        Parameters:
+        ----------
+        params : dict
+            Trim/trunc values (see run_dada2)
+        Returns:
+        -------
+        str
+            Directory name, e.g. f15-280_r0-240
+    '''
+    return 'f%(trim_left_f)d-%(trunc_len_f)d_r%(trim_left_r)d-%(trunc_len_r)d' % params
+
+
+def stats_totals(stats_fp):
+    '''
+    Sums the read counts of a denoising stats artifact over all samples.
+        Parameters:
+        ----------
+        stats_fp : str
+            File path of the denoising stats (.qza)
+        Returns:
+        -------
+        dict
+            Summed read counts per STATS_COLUMNS column, the number of samples and the smallest non-chimeric count
+    '''
+    stats = Artifact.load(stats_fp).view(Metadata).to_dataframe()
+    totals = {column: int(stats[column].sum()) for column in STATS_COLUMNS}
+    totals['samples'] = len(stats)
+    totals['min non-chimeric'] = int(stats['non-chimeric'].min())
+    return totals
+
+
+def sweep(demux_fp, grid, cores, jobs=None, sweep_dir=SWEEP_DIR):
+    '''
+    Runs DADA2 for every parameter combination of the grid in a process pool.
+    The cores are split between the jobs that run at the same time. Every
+    result is saved in its own directory and recorded under a key of the
+    input UUID and the parameters, cached combinations are not run again.
+        Parameters:
+        ----------
+        demux_fp : str
+            File path of the demultiplexed reads (.qza)
+        grid : list
+            Values of trim_left_f, trunc_len_f, trim_left_r and trunc_len_r (one list each)
+        cores : int
+            Core budget shared by all runs
+        jobs : int
+            Runs at the same time (default: one per core)
+        sweep_dir : str
+            Directory of the results
+        Returns:
+        -------
+        list
+            One row of summed denoising stats per combination, most merged reads first
+    '''
+    combinations = [dict(zip(('trim_left_f', 'trunc_len_f', 'trim_left_r', 'trunc_len_r'), values))
+                    for values in itertools.product(*grid)]
+    index = CacheIndex(os.path.join(sweep_dir, os.path.basename(SWEEP_INDEX_FP)))
+    keys = {sweep_dirname(params): step_key([demux_fp], params) for params in combinations}
+
+    todo = [params for params in combinations
+            if not index.is_current(output_fps(os.path.join(sweep_dir, sweep_dirname(params))),
+                                    keys[sweep_dirname(params)])]
+    print("%d combinations, %d cached" % (len(combinations), len(combinations) - len(todo)))
+
+    if todo:
+        n_jobs, n_threads = pool_size(len(todo), cores, jobs)
+        print("Running %d jobs at a time with %d threads each..." % (n_jobs, n_threads))
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {executor.submit(denoise_to_dir, demux_fp, params, n_threads,
+                                       os.path.join(sweep_dir, sweep_dirname(params))): params
+                       for params in todo}
+            for future in as_completed(futures):
+                name = sweep_dirname(futures[future])
+                output_dir = future.result()
+                # Recorded by the parent only, the workers never write the index
+                index.record(output_fps(output_dir), keys[name])
+                print("Finished %s" % name)
+
+    rows = []
+    for params in combinations:
+        stats_fp = os.path.join(sweep_dir, sweep_dirname(params), OUTPUT_FNS['denoising_stats'])
+        row = dict(params)
+        row.update(stats_totals(stats_fp))
+        row['% merged'] = round(100 * row['merged'] / row['input'], 2) if row['input'] else 0.0
+        rows.append(row)
+    return sorted(rows, key=lambda row: row['merged'], reverse=True)
+
+
+def write_sweep_table(rows, output_fp):
+    '''
+    Writes the sweep comparison as TSV.
+        Parameters:
+        ----------
+        rows : list
+            Rows returned by sweep
+        output_fp : str
+            File path of the TSV
+    '''
+    columns = list(rows[0])
+    lines = ['\t'.join(columns)]
+    lines += ['\t'.join(str(row[column]) for column in columns) for row in rows]
+    with open(output_fp, 'w') as of:
+        of.write('\n'.join(lines))
+        of.write('\n')
+
+
+def cached_sweep_result(demux_fp, params, sweep_dir=SWEEP_DIR):
+    '''
+    Looks up the sweep result of one parameter combination.
+        Parameters:
+        ----------
+        demux_fp : str
+            File path of the demultiplexed reads (.qza)
+        params : dict
+            Trim/trunc values (see run_dada2)
+        sweep_dir : str
+            Directory of the sweep results
+        Returns:
+        -------
+        str
+            Directory holding the current result, None if there is none
+    '''
+    index_fp = os.path.join(sweep_dir, os.path.basename(SWEEP_INDEX_FP))
+    if not os.path.exists(index_fp):
+        return None
+    output_dir = os.path.join(sweep_dir, sweep_dirname(params))
+    if CacheIndex(index_fp).is_current(output_fps(output_dir), step_key([demux_fp], params)):
+        return output_dir
+    return None
+
+
+def read_manifest(manifest_fp):
+    '''
+    Reads the import manifest of Step 2.
+        Parameters:
+        ----------
+        manifest_fp : str
+            File path of the manifest (TSV)
+        Returns:
+        -------
+        list
+            (sample-id, forward filepath, reverse filepath) records
+    '''
+    records = []
+    with open(manifest_fp) as fh:
+        next(fh)
+        for line in fh:
+            if line.strip():
+                records.append(tuple(line.rstrip('\n').split('\t')))
+    return records
+
+
+def split_manifest(records, shard_by='run', metadata_fp=METADATA_FP):
+    '''
+    Groups manifest records into shards.
+        Parameters:
+        ----------
+        records : list
+            Manifest records (see read_manifest)
+        shard_by : str
+            "run" groups the samples by the directory of their reads (one
+            directory per sequencing run), any other value is a metadata column
+            whose values form the groups (samples without a value: "unassigned")
+        metadata_fp : str
+            File path of the metadata, used if shard_by is a column
+        Returns:
+        -------
+        dict
+            Records per shard name
+    '''
+    if shard_by == 'run':
+        groups = [os.path.basename(os.path.dirname(fwd_fp)) for _, fwd_fp, _ in records]
+    else:
+        column = Metadata.load(metadata_fp).get_column(shard_by).to_series()
+        groups = [column.get(sid) for sid, _, _ in records]
+        groups = ['unassigned' if pd.isna(group) else str(group) for group in groups]
+
+    shards = {}
+    for group, record in zip(groups, records):
+        name = re.sub(r'[^A-Za-z0-9_.-]+', '_', group) or 'unassigned'
+        shards.setdefault(name, []).append(record)
+    return shards
+
+
+def shard_key(records, params):
+    '''
+    Returns the cache key of a shard: its samples, the size and mtime of their reads and the parameters.
+        Parameters:
+        ----------
+        records : list
+            Manifest records of the shard
+        params : dict
+            Trim/trunc values (see run_dada2)
+        Returns:
+        -------
+        str
+            Cache key
+    '''
+    files = [(sid, fp, os.stat(fp).st_size, os.stat(fp).st_mtime_ns)
+             for sid, fwd_fp, rev_fp in records for fp in (fwd_fp, rev_fp)]
+    return step_key([], {'files': files, 'dada2': params})
+
+
+def denoise_shard(records, params, n_threads, output_dir):
+    '''
+    Imports the reads of one shard and denoises them with their own error model (runs in a worker process).
+        Parameters:
+        ----------
+        records : list
+            Manifest records of the shard
+        params : dict
+            Trim/trunc values (see run_dada2)
+        n_threads : int
+            Threads of DADA2
+        output_dir : str
+            Directory of the outputs
+        Returns:
+        -------
+        str
+            The output directory
+    '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        manifest_fp = os.path.join(tmp_dir, 'manifest.tsv')
+        with open(manifest_fp, 'w') as of:
+            of.write('sample-id\tforward-absolute-filepath\treverse-absolute-filepath\n')
+            of.write(''.join('%s\t%s\t%s\n' % record for record in records))
+        demux = Artifact.import_data('SampleData[PairedEndSequencesWithQuality]', manifest_fp,
+                                     view_type='PairedEndFastqManifestPhred33V2')
+    return save_outputs(run_dada2(demux, params, n_threads), output_dir)
+
+
+def merge_shards(output_dirs):
+    '''
+    Merges the tables, representative sequences and denoising stats of the shards.
+        Parameters:
+        ----------
+        output_dirs : list
+            Output directories of the shards
+        Returns:
+        -------
+        tuple
+            (table, representative sequences, denoising stats) artifacts
+    '''
+    tables = [Artifact.load(os.path.join(d, OUTPUT_FNS['table'])) for d in output_dirs]
+    seqs = [Artifact.load(os.path.join(d, OUTPUT_FNS['representative_sequences'])) for d in output_dirs]
+    stats = [Artifact.load(os.path.join(d, OUTPUT_FNS['denoising_stats'])).view(Metadata).to_dataframe()
+             for d in output_dirs]
+
+    # Feature IDs are hashes of the sequences, equal ASVs of different shards are joined
+    table = feature_table_actions.merge(tables=tables).merged_table
+    representative_sequences = feature_table_actions.merge_seqs(data=seqs).merged_data
+    denoising_stats = Artifact.import_data('SampleData[DADA2Stats]', Metadata(pd.concat(stats)))
+    return table, representative_sequences, denoising_stats
+
+
+def sharded(manifest_fp, params, cores, jobs=None, shard_by='run', shard_dir=SHARD_DIR):
+    '''
+    Runs DADA2 once per shard of the manifest in a process pool and merges
+    the results. Shards whose samples, reads and parameters are unchanged
+    are taken from the cache, so a new run only denoises that run.
+        Parameters:
+        ----------
+        manifest_fp : str
+            File path of the import manifest
+        params : dict
+            Trim/trunc values (see run_dada2)
+        cores : int
+            Core budget shared by all shards
+        jobs : int
+            Shards denoised at the same time (default: one per core)
+        shard_by : str
+            "run" or a metadata column (see split_manifest)
+        shard_dir : str
+            Directory of the shard results
+        Returns:
+        -------
+        tuple
+            (table, representative sequences, denoising stats) artifacts
+    '''
+    shards = split_manifest(read_manifest(manifest_fp), shard_by)
+    index = CacheIndex(os.path.join(shard_dir, os.path.basename(SHARD_INDEX_FP)))
+    keys = {name: shard_key(records, params) for name, records in shards.items()}
+
+    todo = [name for name in shards
+            if not index.is_current(output_fps(os.path.join(shard_dir, name)), keys[name])]
+    print("%d shards (%s), %d cached" % (len(shards), ', '.join(shards), len(shards) - len(todo)))
+
+    if todo:
+        n_jobs, n_threads = pool_size(len(todo), cores, jobs)
+        print("Running %d shards at a time with %d threads each..." % (n_jobs, n_threads))
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {executor.submit(denoise_shard, shards[name], params, n_threads,
+                                       os.path.join(shard_dir, name)): name
+                       for name in todo}
+            for future in as_completed(futures):
+                name = futures[future]
+                index.record(output_fps(future.result()), keys[name])
+                print("Finished shard %s (%d samples)" % (name, len(shards[name])))
+
+    return merge_shards([os.path.join(shard_dir, name) for name in shards])
+
+
+# --- EXECUTION BLOCK ---
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Denoise the paired reads with DADA2.')
+    parser.add_argument('--sweep', action='store_true',
+                        help='run every combination of the values below and compare the denoising stats')
+    parser.add_argument('--trim-left-f', nargs='+', type=int, default=[TRIM_LEFT_F])
+    parser.add_argument('--trunc-len-f', nargs='+', type=int, default=[TRUNC_LEN_F])
+    parser.add_argument('--trim-left-r', nargs='+', type=int, default=[TRIM_LEFT_R])
+    parser.add_argument('--trunc-len-r', nargs='+', type=int, default=[TRUNC_LEN_R])
+    parser.add_argument('--cores', type=int, default=N_THREADS or os.cpu_count(),
+                        help='with --sweep/--sharded: cores shared by all DADA2 runs')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='with --sweep/--sharded: DADA2 runs at the same time (default: one per core)')
+    parser.add_argument('--sharded', action='store_true',
+                        help='denoise the samples of the import manifest in shards and merge the results')
+    parser.add_argument('--shard-by', default='run',
+                        help='with --sharded: "run" (directory of the reads) or a metadata column (default: run)')
+    args = parser.parse_args()
+
+    params = {'trim_left_f': TRIM_LEFT_F, 'trunc_len_f': TRUNC_LEN_F,
+              'trim_left_r': TRIM_LEFT_R, 'trunc_len_r': TRUNC_LEN_R}
+    cached_dir = None if args.sweep or args.sharded else cached_sweep_result(DEMUX_FP, params)
+
+    if args.sweep:
+        grid = [args.trim_left_f, args.trunc_len_f, args.trim_left_r, args.trunc_len_r]
+        rows = sweep(DEMUX_FP, grid, args.cores, args.jobs)
+        write_sweep_table(rows, SWEEP_DIR + '.tsv')
+        for row in rows:
+            print("%s: %d of %d reads merged (%.2f %%), %d non-chimeric"
+                  % (sweep_dirname(row), row['merged'], row['input'], row['% merged'], row['non-chimeric']))
+        print("Comparison table saved to %s.tsv" % SWEEP_DIR)
+
+    elif args.sharded:
+        print("trim_left_f=%(trim_left_f)d trunc_len_f=%(trunc_len_f)d "
+              "trim_left_r=%(trim_left_r)d trunc_len_r=%(trunc_len_r)d" % params)
+        table, representative_sequences, denoising_stats = sharded(
+            MANIFEST_FP, params, args.cores, args.jobs, args.shard_by)
+
+        print("Saving merged output files...")
+        table.save(OUTPUT_FNS['table'])
+        representative_sequences.save(OUTPUT_FNS['representative_sequences'])
+        denoising_stats.save(OUTPUT_FNS['denoising_stats'])
+        print("Done!")
+
+    elif cached_dir is not None:
+        # A sweep already denoised these parameters
+        print("Reusing the sweep result in %s..." % cached_dir)
+        for fn in OUTPUT_FNS.values():
+            shutil.copyfile(os.path.join(cached_dir, fn), fn)
+        print("Done!")
+
+    else:
+        print("trim_left_f=%(trim_left_f)d trunc_len_f=%(trunc_len_f)d "
+              "trim_left_r=%(trim_left_r)d trunc_len_r=%(trunc_len_r)d" % params)
+
+        # 1. Load data
+        print("Loading data...")
+        demux_paired = Artifact.load(DEMUX_FP)
+
+        # 2. Run DADA2
+        print("Running DADA2...")
+        results = run_dada2(demux_paired, params, N_THREADS)
+
+        # 3. Extract the parts we need using their specific names
+        table = results.table
+        representative_sequences = results.representative_sequences
+        denoising_stats = results.denoising_stats
+
+        # 4. Saving the files
+        print("Saving output files...")
+        table.save(OUTPUT_FNS['table'])
+        representative_sequences.save(OUTPUT_FNS['representative_sequences'])
+        denoising_stats.save(OUTPUT_FNS['denoising_stats'])
+
+        print("Done!")
+
+# in command line: python dada2.py --sweep --trim-left-f 10 15 --trunc-len-f 260 280 --trunc-len-r 220 240 --cores 16
+#                  python dada2.py --sharded --shard-by run --cores 16
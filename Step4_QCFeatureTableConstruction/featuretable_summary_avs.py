@@ -1,16 +1,21 @@
 #!/usr/bin/env python
 
+import os
+import sys
+
 import qiime2.plugins.feature_table.actions as feature_table_actions
-from qiime2 import Artifact, Metadata
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Additional_Scripts'))
+from artifact_cache import load_artifact, load_metadata
 
 # 1. Load OTU files (from the VSEARCH step)
 print("Loading AVS files...")
-clustered_table = Artifact.load('table.qza')
-clustered_sequences = Artifact.load('rep-seqs.qza')
+clustered_table = load_artifact('table.qza')
+clustered_sequences = load_artifact('rep-seqs.qza')
 
 # 2. Load Metadata 
 print("Loading Metadata...")
-metadata = Metadata.load('../Data/metadata_for_q.csv')
+metadata = load_metadata('../Data/metadata.tsv')
 
 # --- Feature Table Summarize ---
 print("Summarizing feature table...")
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+#Libraries
+import argparse
+import gzip
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+#This script profiles the per-position read quality of the paired fastq files
+#in the import manifest and suggests the trim/trunc values for DADA2.
+#The files are streamed in batches of reads (no sample is loaded completely),
+#one sample per worker process. The suggestions are written to
+#quality_suggestions.json, dada2.py uses them for parameters set to "auto".
+
+
+
+#Paths
+MANIFEST_FP = "../Step2_ImportingData/fastq-manifest.tsv"
+SUGGESTIONS_FP = "quality_suggestions.json"
+PROFILE_FP = "quality_profile.tsv"
+
+#Phred+33 scores are counted in N_SCORES bins (higher scores go to the last bin)
+PHRED_OFFSET = 33
+N_SCORES = 64
+
+#Reads per batch and quantiles written to the profile
+BATCH_SIZE = 20000
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+
+#Minimal overlap DADA2 needs to merge the read pairs
+MIN_OVERLAP = 12
+
+
+def read_manifest(manifest_fp: str) -> list:
+    '''Returns (sample-id, forward filepath, reverse filepath) records of the import manifest.'''
+    records = []
+    with open(manifest_fp) as fh:
+        next(fh)
+        for line in fh:
+            if line.strip():
+                sid, fwd_fp, rev_fp = line.rstrip('\n').split('\t')
+                records.append((sid, fwd_fp, rev_fp))
+    return records
+
+
+def quality_batches(fq_fp: str, batch_size: int = BATCH_SIZE, max_reads: int = None):
+    '''Yields lists of quality lines (every fourth line) of a gzipped fastq file.'''
+    with gzip.open(fq_fp, 'rb') as fh:
+        qualities = itertools.islice(fh, 3, None, 4)
+        if max_reads is not None:
+            qualities = itertools.islice(qualities, max_reads)
+        while True:
+            batch = [line.rstrip(b'\r\n') for line in itertools.islice(qualities, batch_size)]
+            if not batch:
+                return
+            yield batch
+
+
+def add_batch(histogram: np.ndarray, batch: list) -> np.ndarray:
+    '''
+    Counts the quality scores of a batch of reads per position.
+        Parameters:
+        ----------
+        histogram : np.ndarray
+            Counts (positions x N_SCORES), grown if the batch has longer reads
+        batch : list
+            Quality lines (bytes) of the reads
+        Returns:
+        -------
+        np.ndarray
+            The updated histogram
+    '''
+    lengths = np.fromiter(map(len, batch), dtype=np.int64, count=len(batch))
+    scores = np.frombuffer(b''.join(batch), dtype=np.uint8).astype(np.int64) - PHRED_OFFSET
+    np.clip(scores, 0, N_SCORES - 1, out=scores)
+
+    # Position of every base within its read
+    starts = np.cumsum(lengths) - lengths
+    positions = np.arange(scores.size) - np.repeat(starts, lengths)
+
+    max_len = int(lengths.max()) if lengths.size else 0
+    if max_len > histogram.shape[0]:
+        histogram = np.vstack([histogram, np.zeros((max_len - histogram.shape[0], N_SCORES), dtype=np.int64)])
+    counts = np.bincount(positions * N_SCORES + scores, minlength=max_len * N_SCORES)
+    histogram[:max_len] += counts.reshape(max_len, N_SCORES)
+    return histogram
+
+
+def profile_file(fq_fp: str, subsample: float = None, max_reads: int = None,
+                 seed: int = 0, batch_size: int = BATCH_SIZE) -> tuple:
+    '''
+    Streams one fastq file into a per-position quality histogram.
+        Parameters:
+        ----------
+        fq_fp : str
+            Gzipped fastq file
+        subsample : float
+            Fraction of the reads that are counted (all if None)
+        max_reads : int
+            Only the first max_reads reads are read (all if None)
+        seed : int
+            Seed of the subsampling, the same seed selects the same reads of
+            the forward and the reverse file
+        Returns:
+        -------
+        tuple
+            (histogram, number of counted reads)
+    '''
+    rng = np.random.default_rng(seed)
+    histogram = np.zeros((0, N_SCORES), dtype=np.int64)
+    n_reads = 0
+    for batch in quality_batches(fq_fp, batch_size, max_reads):
+        if subsample is not None:
+            keep = rng.random(len(batch)) < subsample
+            batch = [quality for quality, k in zip(batch, keep) if k]
+            if not batch:
+                continue
+        histogram = add_batch(histogram, batch)
+        n_reads += len(batch)
+    return histogram, n_reads
+
+
+def profile_sample(record: tuple, subsample: float = None, max_reads: int = None,
+                   seed: int = 0) -> tuple:
+    '''Profiles the forward and reverse file of one manifest record (runs in a worker process).'''
+    sid, fwd_fp, rev_fp = record
+    fwd = profile_file(fwd_fp, subsample, max_reads, seed)
+    rev = profile_file(rev_fp, subsample, max_reads, seed)
+    return sid, fwd, rev
+
+
+def merge_histograms(histograms: list) -> np.ndarray:
+    '''Sums histograms of different read lengths.'''
+    max_len = max((h.shape[0] for h in histograms), default=0)
+    total = np.zeros((max_len, N_SCORES), dtype=np.int64)
+    for h in histograms:
+        total[:h.shape[0]] += h
+    return total
+
+
+def histogram_quantiles(histogram: np.ndarray, quantiles: tuple = QUANTILES) -> np.ndarray:
+    '''Returns the quality quantiles per position (positions x quantiles), nan without reads.'''
+    cumulative = np.cumsum(histogram, axis=1)
+    totals = cumulative[:, -1].astype(float)
+    result = np.empty((histogram.shape[0], len(quantiles)))
+    for j, q in enumerate(quantiles):
+        # First score whose cumulative count reaches the quantile
+        result[:, j] = (cumulative < q * totals[:, None]).sum(axis=1)
+    result[totals == 0] = np.nan
+    return result
+
+
+def suggest_trim_trunc(histogram: np.ndarray, n_reads: int, quantile: float = 0.25,
+                       min_quality: int = 25, max_trim: int = 20, window: int = 10,
+                       min_coverage: float = 0.95) -> tuple:
+    '''
+    Suggests trim_left and trunc_len for one read direction.
+
+    trim_left skips the low quality positions at the start of the reads (only
+    within the first max_trim positions). trunc_len is the first position after
+    that whose quantile is below min_quality and stays below it on average over
+    the next window positions (single dips are ignored), or where less than min_coverage of the reads are still
+    long enough (DADA2 drops reads shorter than trunc_len).
+        Returns:
+        -------
+        tuple
+            (trim_left, trunc_len)
+    '''
+    if n_reads == 0 or histogram.shape[0] == 0:
+        raise ValueError('No reads to profile')
+
+    quality = histogram_quantiles(histogram, (quantile,))[:, 0]
+    coverage = histogram.sum(axis=1) / n_reads
+
+    low = np.flatnonzero(quality[:max_trim] < min_quality)
+    trim_left = int(low[-1]) + 1 if low.size else 0
+
+    # Mean quality of the window starting at each position (shorter at the end)
+    cumulative = np.concatenate([[0.0], np.cumsum(np.nan_to_num(quality))])
+    starts = np.arange(quality.size)
+    ends = np.minimum(starts + window, quality.size)
+    forward_mean = (cumulative[ends] - cumulative[starts]) / (ends - starts)
+
+    bad = ((quality < min_quality) & (forward_mean < min_quality)) | (coverage < min_coverage)
+    bad[:trim_left] = False
+    trunc_len = int(np.argmax(bad)) if bad.any() else quality.size
+
+    if trunc_len <= trim_left:
+        raise ValueError('The quality is below %d at all positions after trimming %d bases'
+                         % (min_quality, trim_left))
+    return trim_left, trunc_len
+
+
+def profile_manifest(manifest_fp: str, n_workers: int = None, subsample: float = None,
+                     max_reads: int = None, seed: int = 0) -> dict:
+    '''
+    Profiles all samples of a manifest in a process pool.
+        Returns:
+        -------
+        dict
+            'forward'/'reverse': (merged histogram, number of reads),
+            'samples': number of reads counted per sample
+    '''
+    records = read_manifest(manifest_fp)
+    fwd_histograms, rev_histograms = [], []
+    n_fwd = n_rev = 0
+    samples = {}
+
+    with ProcessPoolExecutor(max_workers=n_workers or os.cpu_count()) as executor:
+        futures = [executor.submit(profile_sample, record, subsample, max_reads, seed)
+                   for record in records]
+        for future in futures:
+            sid, (fwd_histogram, fwd_reads), (rev_histogram, rev_reads) = future.result()
+            fwd_histograms.append(fwd_histogram)
+            rev_histograms.append(rev_histogram)
+            n_fwd += fwd_reads
+            n_rev += rev_reads
+            samples[sid] = fwd_reads
+            print("%s: %d read pairs" % (sid, fwd_reads))
+
+    return {'forward': (merge_histograms(fwd_histograms), n_fwd),
+            'reverse': (merge_histograms(rev_histograms), n_rev),
+            'samples': samples}
+
+
+def write_profile(profile: dict, output_fp: str) -> None:
+    '''Writes the quality quantiles per direction and position as TSV.'''
+    header = ['direction', 'position', 'reads'] + ['q%d' % round(q * 100) for q in QUANTILES]
+    lines = ['\t'.join(header)]
+    for direction in ('forward', 'reverse'):
+        histogram, _ = profile[direction]
+        quantiles = histogram_quantiles(histogram)
+        for position, (n, values) in enumerate(zip(histogram.sum(axis=1), quantiles), start=1):
+            lines.append('\t'.join([direction, str(position), str(n)] +
+                                   ['%g' % value for value in values]))
+    with open(output_fp, 'w') as of:
+        of.write('\n'.join(lines))
+        of.write('\n')
+
+
+def suggest_parameters(profile: dict, amplicon_length: int = None, **criteria) -> dict:
+    '''Suggests the DADA2 trim/trunc parameters (keys as in dada2.py, lower case).'''
+    trim_left_f, trunc_len_f = suggest_trim_trunc(*profile['forward'], **criteria)
+    trim_left_r, trunc_len_r = suggest_trim_trunc(*profile['reverse'], **criteria)
+    suggestions = {'trim_left_f': trim_left_f, 'trunc_len_f': trunc_len_f,
+                   'trim_left_r': trim_left_r, 'trunc_len_r': trunc_len_r,
+                   'n_samples': len(profile['samples']),
+                   'n_read_pairs': profile['forward'][1],
+                   'criteria': criteria,
+                   'warnings': []}
+    if amplicon_length is not None and trunc_len_f + trunc_len_r < amplicon_length + MIN_OVERLAP:
+        suggestions['warnings'].append(
+            'trunc_len_f + trunc_len_r = %d is too short to merge a %d bp amplicon (overlap %d bp)'
+            % (trunc_len_f + trunc_len_r, amplicon_length, MIN_OVERLAP))
+    return suggestions
+
+
+# --- EXECUTION BLOCK ---
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-position quality profile and DADA2 trim/trunc suggestions.')
+    parser.add_argument('--manifest', default=MANIFEST_FP, help='fastq manifest of the import step')
+    parser.add_argument('--output', default=SUGGESTIONS_FP, help='suggested parameters (JSON)')
+    parser.add_argument('--profile', default=PROFILE_FP, help='quality quantiles per position (TSV)')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('N_THREADS', 0)) or None,
+                        help='samples profiled at the same time (default: all cores)')
+    parser.add_argument('--subsample', type=float, default=None, help='fraction of the reads to count')
+    parser.add_argument('--max-reads', type=int, default=None, help='reads counted per file')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the subsampling')
+    parser.add_argument('--quantile', type=float, default=0.25, help='quality quantile used for the suggestions')
+    parser.add_argument('--min-quality', type=int, default=25, help='minimal quality of the kept positions')
+    parser.add_argument('--amplicon-length', type=int, default=None, help='check that the truncated reads still overlap')
+    args = parser.parse_args()
+
+    print("Profiling reads...")
+    profile = profile_manifest(args.manifest, args.threads, args.subsample, args.max_reads, args.seed)
+    write_profile(profile, args.profile)
+
+    suggestions = suggest_parameters(profile, args.amplicon_length,
+                                     quantile=args.quantile, min_quality=args.min_quality)
+    with open(args.output, 'w') as of:
+        json.dump(suggestions, of, indent=2)
+
+    print("Suggested: trim_left_f=%(trim_left_f)d trunc_len_f=%(trunc_len_f)d "
+          "trim_left_r=%(trim_left_r)d trunc_len_r=%(trunc_len_r)d" % suggestions)
+    for warning in suggestions['warnings']:
+        print("** WARNING**: %s" % warning)
+    print("Done!")
+
+# in command line: python quality_profiler.py --subsample 0.1
@@ -1,31 +1,73 @@
 #!/usr/bin/env python
 
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import qiime2.plugins.vsearch.actions as vsearch_actions
 from qiime2 import Artifact
 
-# 1. Load the files from DADA2 step
-print("Loading DADA2 files...")
-table = Artifact.load('table.qza')
-representative_sequences = Artifact.load('rep-seqs.qza')
+# Threads for VSEARCH (0 = all available cores), set by the pipeline runner
+N_THREADS = int(os.environ.get('N_THREADS', 0))
+
+# Identity thresholds, e.g. "0.97" or "0.97,0.98,0.99"
+PERC_IDENTITIES = [float(value) for value in os.environ.get('PERC_IDENTITY', '0.97').split(',')]
+
+# Inputs from the DADA2 step
+TABLE_FP = 'table.qza'
+REP_SEQS_FP = 'rep-seqs.qza'
+
+
+def output_fps(perc_identity):
+    """Returns the table and sequence file names of one threshold, e.g. table-dn-97.qza."""
+    label = '%g' % round(perc_identity * 100, 2)
+    return 'table-dn-%s.qza' % label, 'rep-seqs-dn-%s.qza' % label
+
+
+def cluster(table, representative_sequences, perc_identity, n_threads):
+    """Runs the de novo clustering at one identity and saves the outputs."""
+    results = vsearch_actions.cluster_features_de_novo(
+        sequences=representative_sequences,
+        table=table,
+        perc_identity=perc_identity,
+        strand='plus',       # Standard for Illumina
+        threads=n_threads    # 0 = use all available cores
+    )
+    table_fp, rep_seqs_fp = output_fps(perc_identity)
+    results.clustered_table.save(table_fp)
+    results.clustered_sequences.save(rep_seqs_fp)
+    return perc_identity
+
+
+def split_threads(n_threads, n_jobs):
+    """Splits the thread budget between jobs (0 = all available cores)."""
+    total = n_threads or os.cpu_count()
+    return max(1, total // n_jobs)
+
 
-# 2. Run VSEARCH Clustering
-print("Running VSEARCH Clustering (97%)...")
+# --- EXECUTION BLOCK ---
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cluster the DADA2 ASVs into OTUs with VSEARCH.')
+    parser.add_argument('--identities', nargs='+', type=float, default=PERC_IDENTITIES,
+                        help='identity thresholds, e.g. 0.97 0.98 0.99 (default: %(default)s)')
+    args = parser.parse_args()
 
-results = vsearch_actions.cluster_features_de_novo(
-    sequences=representative_sequences,
-    table=table,
-    perc_identity=0.97,  # 97 % OTUs
-    strand='plus',       # Standard for Illumina
-    threads=0            # Use all available cores
-)
+    # 1. Load the files from DADA2 step (once for all thresholds)
+    print("Loading DADA2 files...")
+    table = Artifact.load(TABLE_FP)
+    representative_sequences = Artifact.load(REP_SEQS_FP)
 
-# 3. Extract the outputs
-clustered_table = results.clustered_table
-clustered_sequences = results.clustered_sequences
+    # 2. Run VSEARCH Clustering, the thresholds share the thread budget
+    n_threads = split_threads(N_THREADS, len(args.identities))
+    print("Running VSEARCH Clustering (%s) with %d threads each..."
+          % (', '.join('%g%%' % (p * 100) for p in args.identities), n_threads))
+    with ThreadPoolExecutor(max_workers=len(args.identities)) as executor:
+        futures = [executor.submit(cluster, table, representative_sequences, perc_identity, n_threads)
+                   for perc_identity in args.identities]
+        for future in futures:
+            perc_identity = future.result()
+            print("Saved %s" % ', '.join(output_fps(perc_identity)))
 
-# 4. Save the new files
-print("Saving OTU files...")
-clustered_table.save('table-dn-97.qza')
-clustered_sequences.save('rep-seqs-dn-97.qza')
+    print("Done! OTUs created.")
 
-print("Done! OTUs created.")
\ No newline at end of file
+# in command line: python vsearch.py --identities 0.97 0.98 0.99
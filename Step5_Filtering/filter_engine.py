@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+### Filter Engine (Step 5 and Step 6)
+
+#This script filters a feature table with a list of predicates in one pass:
+#minimal number of samples, minimal frequency, decontam score, a feature ID
+#allowlist and a sample metadata where-clause. The table is read once, all
+#predicates are evaluated on the sparse matrix, and the filtered table and
+#the matching representative sequences are written together. The summary
+#lists how many features, samples and reads each predicate removed.
+#
+#Order of evaluation: the sample predicates select the samples first, the
+#feature predicates are evaluated on the selected samples, features without
+#reads in the selected samples are dropped (like filter-samples does) and
+#samples left without reads are dropped at the end (like filter-features does).
+
+#Libraries
+import argparse
+import os
+
+import biom
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from qiime2 import Artifact, Metadata
+
+
+class MinSamples:
+    '''Keeps features observed in at least n samples (filter-features min_samples).'''
+    axis = 'feature'
+
+    def __init__(self, n: int):
+        self.n = n
+        self.name = f"min_samples={n}"
+
+    def mask(self, stats: dict) -> np.ndarray:
+        return stats['presence'] >= self.n
+
+
+class MinFrequency:
+    '''Keeps features with at least n reads in total (filter-features min_frequency).'''
+    axis = 'feature'
+
+    def __init__(self, n: int):
+        self.n = n
+        self.name = f"min_frequency={n}"
+
+    def mask(self, stats: dict) -> np.ndarray:
+        return stats['frequency'] >= self.n
+
+
+class DecontamScore:
+    '''Removes features with a decontam p-value <= threshold, untested features are kept.'''
+    axis = 'feature'
+
+    def __init__(self, scores: pd.Series, threshold: float):
+        self.scores = scores
+        self.threshold = threshold
+        self.name = f"decontam_p<={threshold}"
+
+    def mask(self, stats: dict) -> np.ndarray:
+        p_values = self.scores.reindex(stats['feature_ids']).to_numpy(dtype=float)
+        return ~(p_values <= self.threshold)
+
+
+class FeatureAllowlist:
+    '''Keeps only the listed feature IDs.'''
+    axis = 'feature'
+
+    def __init__(self, feature_ids, name: str = "allowlist"):
+        self.feature_ids = list(feature_ids)
+        self.name = name
+
+    def mask(self, stats: dict) -> np.ndarray:
+        return np.isin(stats['feature_ids'], self.feature_ids)
+
+
+class SampleWhere:
+    '''Keeps the samples selected by a metadata where-clause (filter-samples where).'''
+    axis = 'sample'
+
+    def __init__(self, metadata: Metadata, where: str):
+        self.ids = metadata.get_ids(where)
+        self.name = f"where {where}"
+
+    def mask(self, stats: dict) -> np.ndarray:
+        return np.isin(stats['sample_ids'], list(self.ids))
+
+
+def read_allowlist(allowlist_fp: str) -> list:
+    '''Reads feature IDs from a text file (first column, header and comments skipped).'''
+    feature_ids = []
+    with open(allowlist_fp) as fh:
+        for line in fh:
+            feature_id = line.split('\t')[0].strip()
+            if feature_id and not feature_id.startswith('#') and feature_id.lower() not in ('feature-id', 'featureid', 'id'):
+                feature_ids.append(feature_id)
+    return feature_ids
+
+
+def evaluate(matrix: sp.spmatrix, feature_ids: np.ndarray, sample_ids: np.ndarray,
+             predicates: list) -> tuple:
+    '''
+    Evaluates all predicates on a feature x sample matrix.
+        Parameters:
+        ----------
+        matrix : scipy.sparse matrix
+            Feature x sample counts
+        feature_ids : np.ndarray
+            IDs of the rows
+        sample_ids : np.ndarray
+            IDs of the columns
+        predicates : list
+            Predicate objects (MinSamples, MinFrequency, DecontamScore,
+            FeatureAllowlist, SampleWhere)
+        Returns:
+        -------
+        tuple
+            Feature mask, sample mask, one summary row per predicate and the
+            input/retained totals
+    '''
+    matrix = sp.csr_matrix(matrix, copy=True)
+    sample_reads = np.asarray(matrix.sum(axis=0)).ravel()
+    total_reads = sample_reads.sum()
+
+    # Samples first: the feature statistics refer to the selected samples
+    sample_mask = np.ones(len(sample_ids), dtype=bool)
+    sample_masks = []
+    for predicate in predicates:
+        if predicate.axis == 'sample':
+            mask = predicate.mask({'sample_ids': sample_ids})
+            sample_masks.append((predicate, mask))
+            sample_mask &= mask
+
+    selected = matrix[:, sample_mask] if not sample_mask.all() else matrix
+    selected.eliminate_zeros()
+    stats = {'feature_ids': feature_ids,
+             'sample_ids': sample_ids[sample_mask],
+             'presence': np.diff(selected.indptr),
+             'frequency': np.asarray(selected.sum(axis=1)).ravel()}
+
+    feature_mask = np.ones(len(feature_ids), dtype=bool)
+    feature_masks = []
+    for predicate in predicates:
+        if predicate.axis == 'feature':
+            mask = np.asarray(predicate.mask(stats), dtype=bool)
+            feature_masks.append((predicate, mask))
+            feature_mask &= mask
+
+    # Features without reads in the selected samples are dropped
+    empty_features = feature_mask & (stats['frequency'] == 0)
+    feature_mask &= ~empty_features
+
+    # Samples without reads after the feature filter are dropped
+    kept_reads = np.asarray(selected[feature_mask].sum(axis=0)).ravel()
+    empty = kept_reads == 0
+    final_sample_mask = sample_mask.copy()
+    final_sample_mask[np.flatnonzero(sample_mask)[empty]] = False
+
+    # "alone": removed by this predicate on its own,
+    # "in order": removed by this predicate and none listed before it
+    rows = []
+    kept_samples = np.ones(len(sample_ids), dtype=bool)
+    for predicate, mask in sample_masks:
+        first = kept_samples & ~mask
+        rows.append({'predicate': predicate.name, 'axis': 'sample',
+                     'removed': int((~mask).sum()), 'reads_removed': int(sample_reads[~mask].sum()),
+                     'removed_in_order': int(first.sum()), 'reads_removed_in_order': int(sample_reads[first].sum())})
+        kept_samples &= mask
+    kept_features = np.ones(len(feature_ids), dtype=bool)
+    for predicate, mask in feature_masks:
+        first = kept_features & ~mask
+        rows.append({'predicate': predicate.name, 'axis': 'feature',
+                     'removed': int((~mask).sum()), 'reads_removed': int(stats['frequency'][~mask].sum()),
+                     'removed_in_order': int(first.sum()), 'reads_removed_in_order': int(stats['frequency'][first].sum())})
+        kept_features &= mask
+    rows.append({'predicate': 'empty features', 'axis': 'feature',
+                 'removed': int(empty_features.sum()), 'reads_removed': 0,
+                 'removed_in_order': int(empty_features.sum()), 'reads_removed_in_order': 0})
+    rows.append({'predicate': 'empty samples', 'axis': 'sample',
+                 'removed': int(empty.sum()), 'reads_removed': 0,
+                 'removed_in_order': int(empty.sum()), 'reads_removed_in_order': 0})
+    totals = {'features': (len(feature_ids), int(feature_mask.sum())),
+              'samples': (len(sample_ids), int(final_sample_mask.sum())),
+              'reads': (int(total_reads), int(kept_reads.sum()))}
+
+    return feature_mask, final_sample_mask, rows, totals
+
+
+def write_summary(summary: pd.DataFrame, totals: dict, summary_fp: str) -> None:
+    '''Writes the per-predicate summary as TSV, preceded by the input -> retained totals as comments.'''
+    with open(summary_fp, 'w') as of:
+        for name, (n_input, n_retained) in totals.items():
+            of.write(f"# {name}: {n_input} -> {n_retained}\n")
+        summary.to_csv(of, sep='\t', index=False)
+
+
+def filter_table(table: Artifact, rep_seqs: Artifact, predicates: list) -> tuple:
+    '''
+    Filters a table and its representative sequences with all predicates at once.
+        Parameters:
+        ----------
+        table : Artifact
+            FeatureTable[Frequency]
+        rep_seqs : Artifact
+            FeatureData[Sequence] of the table (None to skip the sequences)
+        predicates : list
+            Predicate objects
+        Returns:
+        -------
+        tuple
+            Filtered table, filtered representative sequences (or None),
+            the summary per predicate and the input/retained totals
+    '''
+    biom_table = table.view(biom.Table)
+    feature_ids = np.asarray(biom_table.ids(axis='observation'))
+    sample_ids = np.asarray(biom_table.ids(axis='sample'))
+
+    feature_mask, sample_mask, rows, totals = evaluate(biom_table.matrix_data, feature_ids, sample_ids, predicates)
+
+    matrix = sp.csr_matrix(biom_table.matrix_data)[feature_mask][:, sample_mask]
+    filtered = biom.Table(matrix, feature_ids[feature_mask], sample_ids[sample_mask])
+    filtered_table = Artifact.import_data('FeatureTable[Frequency]', filtered)
+
+    filtered_rep_seqs = None
+    if rep_seqs is not None:
+        sequences = rep_seqs.view(pd.Series)
+        filtered_rep_seqs = Artifact.import_data(
+            'FeatureData[Sequence]', sequences[sequences.index.isin(feature_ids[feature_mask])])
+
+    return filtered_table, filtered_rep_seqs, pd.DataFrame(rows), totals
+
+
+# --- EXECUTION BLOCK ---
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Filter a feature table and its sequences with several predicates in one pass.')
+    parser.add_argument('--table', default="../Step4_QCFeatureTableConstruction/table.qza")
+    parser.add_argument('--rep-seqs', default="../Step4_QCFeatureTableConstruction/rep-seqs.qza",
+                        help='representative sequences of the table ("none" to skip)')
+    parser.add_argument('--min-samples', type=int, default=None)
+    parser.add_argument('--min-frequency', type=int, default=None)
+    parser.add_argument('--decontam-scores', default=None, help='FeatureData[DecontamScore] artifact')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='with --decontam-scores: features with p <= threshold are removed (default: %(default)s)')
+    parser.add_argument('--allowlist', default=None, help='text file with the feature IDs to keep')
+    parser.add_argument('--metadata', default="../Data/metadata.tsv")
+    parser.add_argument('--where', default=None, help='sample metadata where-clause, e.g. "[Type]=\'Feces\'"')
+    parser.add_argument('--output-table', default="filtered-table.qza")
+    parser.add_argument('--output-rep-seqs', default="filtered-rep-seqs.qza")
+    parser.add_argument('--summary', default="filter_summary.tsv")
+    args = parser.parse_args()
+
+    predicates = []
+    if args.where is not None:
+        predicates.append(SampleWhere(Metadata.load(args.metadata), args.where))
+    if args.min_samples is not None:
+        predicates.append(MinSamples(args.min_samples))
+    if args.min_frequency is not None:
+        predicates.append(MinFrequency(args.min_frequency))
+    if args.decontam_scores is not None:
+        scores = Artifact.load(args.decontam_scores).view(pd.DataFrame)['p']
+        predicates.append(DecontamScore(scores, args.threshold))
+    if args.allowlist is not None:
+        predicates.append(FeatureAllowlist(read_allowlist(args.allowlist), f"allowlist {os.path.basename(args.allowlist)}"))
+    if not predicates:
+        parser.error("no predicate given")
+
+    table = Artifact.load(args.table)
+    rep_seqs = None if args.rep_seqs == "none" else Artifact.load(args.rep_seqs)
+
+    print(f"Filtering {args.table} with: {', '.join(predicate.name for predicate in predicates)}")
+    filtered_table, filtered_rep_seqs, summary, totals = filter_table(table, rep_seqs, predicates)
+
+    filtered_table.save(args.output_table)
+    print(f"Filtered table saved to {args.output_table}")
+    if filtered_rep_seqs is not None:
+        filtered_rep_seqs.save(args.output_rep_seqs)
+        print(f"Filtered representative sequences saved to {args.output_rep_seqs}")
+
+    write_summary(summary, totals, args.summary)
+    print(summary.to_string(index=False))
+    for name, (n_input, n_retained) in totals.items():
+        print(f"{name}: {n_input} -> {n_retained}")
+    print(f"Summary saved to {args.summary}")
+
+# in command line: python filter_engine.py --min-samples 2 --decontam-scores ../Step6_Decontamination/asv_decontam_scores.qza --threshold 0.1
@@ -8,17 +8,24 @@ import qiime2.plugins.feature_table.actions as feature_table_actions
 import os
 
 
+# Minimum number of samples a feature has to be observed in
+# (can be overridden by the pipeline runner through an environment variable)
+MIN_SAMPLES = int(os.environ.get("MIN_SAMPLES", 2))
+
+# Branches to filter ("asv", "otu" or both), the pipeline runner filters them in parallel
+FILTER_BRANCHES = os.environ.get("FILTER_BRANCHES", "asv,otu").split(",")
+
 # Declaring paths and names
 unfiltered_otu_table_path = "../Step4_QCFeatureTableConstruction/table-dn-97.qza"
 filtered_otu_table_path = "otu_table-filtered.qza"
 
-if not os.path.exists(unfiltered_otu_table_path):
+if "otu" in FILTER_BRANCHES and not os.path.exists(unfiltered_otu_table_path):
     raise FileNotFoundError(f"Please check again the path to the unfiltered OTU table: {unfiltered_otu_table_path}")
 
 unfiltered_asv_table_path = "../Step4_QCFeatureTableConstruction/table.qza"
 filtered_asv_table_path = "asv_table-filtered.qza"
 
-if not os.path.exists(unfiltered_asv_table_path):
+if "asv" in FILTER_BRANCHES and not os.path.exists(unfiltered_asv_table_path):
     raise FileNotFoundError(f"Please check again the path to the unfiltered ASV table: {unfiltered_asv_table_path}")
 
 
@@ -26,33 +33,35 @@ if not os.path.exists(unfiltered_asv_table_path):
 
 
 #ASV
-print("Filtering ASV table to retain features present in at least 2 samples...")
-try:
-    unfiltered_table = Artifact.load(unfiltered_asv_table_path)
-    filtered_artifact, = feature_table_actions.filter_features(
-    table=unfiltered_table,
-    min_samples=2
-    )
-except Exception as e:
-    print(f"Something went wrong while filtering the table: {e}")
-    
-filtered_artifact.save(filtered_asv_table_path)
-print(f"Filtered ASV table saved to {filtered_asv_table_path}")
+if "asv" in FILTER_BRANCHES:
+    print(f"Filtering ASV table to retain features present in at least {MIN_SAMPLES} samples...")
+    try:
+        unfiltered_table = Artifact.load(unfiltered_asv_table_path)
+        filtered_artifact, = feature_table_actions.filter_features(
+        table=unfiltered_table,
+        min_samples=MIN_SAMPLES
+        )
+    except Exception as e:
+        print(f"Something went wrong while filtering the table: {e}")
+
+    filtered_artifact.save(filtered_asv_table_path)
+    print(f"Filtered ASV table saved to {filtered_asv_table_path}")
 
 
 #OTU
-print("Filtering OTU table to retain features present in at least 2 samples...")
-try:
-    unfiltered_table = Artifact.load(unfiltered_otu_table_path)
-    filtered_artifact, = feature_table_actions.filter_features(
-    table=unfiltered_table,
-    min_samples=2
-    )
-except Exception as e:
-    print(f"Something went wrong while filtering the table: {e}")
-
-filtered_artifact.save(filtered_otu_table_path)
-print(f"Filtered OTU table saved to {filtered_otu_table_path}")
+if "otu" in FILTER_BRANCHES:
+    print(f"Filtering OTU table to retain features present in at least {MIN_SAMPLES} samples...")
+    try:
+        unfiltered_table = Artifact.load(unfiltered_otu_table_path)
+        filtered_artifact, = feature_table_actions.filter_features(
+        table=unfiltered_table,
+        min_samples=MIN_SAMPLES
+        )
+    except Exception as e:
+        print(f"Something went wrong while filtering the table: {e}")
+
+    filtered_artifact.save(filtered_otu_table_path)
+    print(f"Filtered OTU table saved to {filtered_otu_table_path}")
 
 
 
@@ -8,19 +8,22 @@
 from qiime2.plugins.feature_table.actions import filter_features
 from qiime2.plugins.feature_table.actions import summarize_plus
 import os
-from qiime2 import Artifact, Metadata
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Additional_Scripts'))
+from artifact_cache import load_artifact, load_metadata
 
 
 # Define file paths
 TABLE = os.path.join("asv_table-filtered.qza")
-METADATA = os.path.join("../", "Data", "metadata_for_q.csv")
+METADATA = os.path.join("../", "Data", "metadata.tsv")
 
 
 
 #Loading Artifacts
 try:
-    table = Artifact.load(TABLE)
-    metadata = Metadata.load(METADATA)
+    table = load_artifact(TABLE)
+    metadata = load_metadata(METADATA)
 except Exception as e:
     print(f"Error loading artifacts: {e}")
     raise
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+### Decontamination Script (Step 6)
+
+#This script replaces decontamination_asv.sh and decontamination_otu.sh.
+#The Step 5 table and the representative sequences are loaded once per variant
+#and handed in memory through decontam-identify, decontam-score-viz,
+#filter-features and filter-seqs instead of being re-read by four CLI calls.
+
+#Libraries
+import argparse
+import os
+import sys
+
+import biom
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from qiime2 import Artifact, Metadata
+import qiime2.plugins.quality_control.actions as quality_control_actions
+import qiime2.plugins.feature_table.actions as feature_table_actions
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Additional_Scripts'))
+from pipeline_cache import CacheIndex, step_key
+
+
+# Threshold on the decontam score: features with p <= THRESHOLD are contaminants
+# (can be overridden by the pipeline runner through an environment variable)
+THRESHOLD = float(os.environ.get("THRESHOLD", 0.1))
+
+# Keys (input table, metadata, decontam settings) the saved scores were computed with
+SCORES_INDEX_FP = '.decontam_cache.json'
+
+# Settings of the two variants (taken over from the shell scripts)
+VARIANTS = {
+    'asv': {
+        'table': os.path.join("..", "Step5_Filtering", "asv_table-filtered.qza"),
+        'rep_seqs': os.path.join("..", "Step4_QCFeatureTableConstruction", "rep-seqs.qza"),
+        'metadata': os.path.join("..", "Data", "metadata.tsv"),
+        'method': "prevalence",
+        'prev_control_column': "Horse",
+        'prev_control_indicator': "H2O",
+        'freq_concentration_column': None,
+        'weighted': True,
+        'bin_size': 0.05,
+        'output_scores': "asv_decontam_scores.qza",
+        'output_viz': "asv_decontam_score_viz.qzv",
+        'output_table': "filtered-table.qza",
+        'output_rep_seqs': "filtered-rep-seqs.qza",
+    },
+    'otu': {
+        'table': os.path.join("..", "Step5_Filtering", "otu_table-filtered.qza"),
+        'rep_seqs': os.path.join("..", "Step4_QCFeatureTableConstruction", "rep-seqs-dn-97.qza"),
+        'metadata': os.path.join("..", "Data", "metadata.tsv"),
+        'method': "combined",
+        'prev_control_column': "Sample_or_Control",
+        'prev_control_indicator': "control",
+        'freq_concentration_column': "Concentration",
+        'weighted': False,
+        'bin_size': 0.05,
+        'output_scores': "otu_comb_decontam_scores.qza",
+        'output_viz': "otu_decontam_score_viz.qzv",
+        'output_table': "otu_table-decontam.qza",
+        'output_rep_seqs': "otu_rep_seqs-decontam.qza",
+    },
+}
+
+
+def keep_where(threshold: float) -> str:
+    '''Returns the where clause that keeps non-contaminant and untested features.'''
+    return f"[p]>{threshold} OR [p] IS NULL"
+
+
+def identify_contaminants(table: Artifact, metadata: Metadata, settings: dict) -> Artifact:
+    '''
+    Runs decontam-identify for one variant.
+        Parameters:
+        ----------
+        table : Artifact
+            FeatureTable[Frequency] from Step 5
+        metadata : Metadata
+            Sample metadata with the control (and concentration) columns
+        settings : dict
+            Settings of the variant (see VARIANTS)
+        Returns:
+        -------
+        Artifact
+            FeatureData[DecontamScore] with the p column
+    '''
+    params = {
+        'method': settings['method'],
+        'prev_control_column': settings['prev_control_column'],
+        'prev_control_indicator': settings['prev_control_indicator'],
+    }
+    if settings['method'] in ("frequency", "combined"):
+        params['freq_concentration_column'] = settings['freq_concentration_column']
+
+    decontam_scores, = quality_control_actions.decontam_identify(
+        table=table,
+        metadata=metadata,
+        **params,
+    )
+    return decontam_scores
+
+
+def scores_key(settings: dict) -> str:
+    '''Returns the cache key of the decontam scores: input table, metadata and decontam settings.'''
+    params = {name: settings[name] for name in ('method', 'prev_control_column', 'prev_control_indicator',
+                                                'freq_concentration_column')}
+    return step_key([settings['table'], settings['metadata']], params)
+
+
+def remove_contaminants(table: Artifact, rep_seqs: Artifact, decontam_scores: Artifact,
+                        threshold: float) -> tuple:
+    '''
+    Removes the contaminant features from the table and the representative sequences.
+        Parameters:
+        ----------
+        table : Artifact
+            FeatureTable[Frequency] the scores were computed on
+        rep_seqs : Artifact
+            FeatureData[Sequence] of the table
+        decontam_scores : Artifact
+            Output of identify_contaminants
+        threshold : float
+            Features with p <= threshold are removed
+        Returns:
+        -------
+        tuple
+            Filtered table and filtered representative sequences
+    '''
+    filtered_table, = feature_table_actions.filter_features(
+        table=table,
+        metadata=decontam_scores.view(Metadata),
+        where=keep_where(threshold),
+    )
+    filtered_rep_seqs, = feature_table_actions.filter_seqs(
+        data=rep_seqs,
+        table=filtered_table,
+    )
+    return filtered_table, filtered_rep_seqs
+
+
+def decontaminate(variant: str, threshold: float = THRESHOLD, method: str = None,
+                  metadata_cache: dict = None) -> None:
+    '''
+    Runs the complete decontamination of one variant and saves all outputs.
+        Parameters:
+        ----------
+        variant : str
+            Key of VARIANTS ("asv" or "otu")
+        threshold : float
+            Threshold on the decontam score
+        method : str
+            Overrides the decontam method of the variant (prevalence, frequency, combined)
+        metadata_cache : dict
+            Metadata objects already loaded in this run, keyed on file path
+    '''
+    settings = dict(VARIANTS[variant])
+    if method is not None:
+        settings['method'] = method
+    if metadata_cache is None:
+        metadata_cache = {}
+
+    for key in ('table', 'rep_seqs', 'metadata'):
+        if not os.path.exists(settings[key]):
+            raise FileNotFoundError(f"Please check again the path to the {key}: {settings[key]}")
+
+    print("===========================================================================")
+    print(f"Decontamination of the {variant.upper()} table ({settings['method']} method, threshold {threshold})")
+    print("===========================================================================")
+
+    # Loading the inputs once
+    table = Artifact.load(settings['table'])
+    rep_seqs = Artifact.load(settings['rep_seqs'])
+    if settings['metadata'] not in metadata_cache:
+        metadata_cache[settings['metadata']] = Metadata.load(settings['metadata'])
+    metadata = metadata_cache[settings['metadata']]
+
+    # --- Step 1: Identify Contaminants ---
+    print("1. Identifying contaminants...")
+    decontam_scores = identify_contaminants(table, metadata, settings)
+    decontam_scores.save(settings['output_scores'])
+    CacheIndex(SCORES_INDEX_FP).record([settings['output_scores']], scores_key(settings))
+    print(f"   -> Scores saved to {settings['output_scores']}")
+
+    # --- Step 2: Decontam Score Viz ---
+    print("2. Generating decontam score visualization...")
+    visualization, = quality_control_actions.decontam_score_viz(
+        decontam_scores=decontam_scores,
+        table=table,
+        rep_seqs=rep_seqs,
+        threshold=threshold,
+        weighted=settings['weighted'],
+        bin_size=settings['bin_size'],
+    )
+    visualization.save(settings['output_viz'])
+    print(f"   -> Visualization saved to {settings['output_viz']}")
+
+    # --- Step 3: Filter Contaminants ---
+    print("3. Filtering contaminants from table and representative sequences...")
+    filtered_table, filtered_rep_seqs = remove_contaminants(table, rep_seqs, decontam_scores, threshold)
+    filtered_table.save(settings['output_table'])
+    filtered_rep_seqs.save(settings['output_rep_seqs'])
+    print(f"   -> Filtered feature table saved to {settings['output_table']}")
+    print(f"   -> Filtered representative sequences saved to {settings['output_rep_seqs']}")
+
+
+def load_or_identify(variant: str, table: Artifact, settings: dict,
+                     metadata_cache: dict) -> Artifact:
+    '''
+    Returns the decontam scores of a variant: the saved scores if they were
+    computed from the same table, metadata and decontam settings, otherwise
+    decontam-identify is run once and its output saved.
+    '''
+    index = CacheIndex(SCORES_INDEX_FP)
+    key = scores_key(settings)
+    if index.is_current([settings['output_scores']], key):
+        print(f"Reusing decontam scores from {settings['output_scores']}")
+        return Artifact.load(settings['output_scores'])
+    if os.path.exists(settings['output_scores']):
+        print(f"Saved scores in {settings['output_scores']} do not match the inputs or settings, recomputing")
+
+    if settings['metadata'] not in metadata_cache:
+        metadata_cache[settings['metadata']] = Metadata.load(settings['metadata'])
+    print(f"Identifying contaminants for the {variant.upper()} table ({settings['method']} method)...")
+    decontam_scores = identify_contaminants(table, metadata_cache[settings['metadata']], settings)
+    decontam_scores.save(settings['output_scores'])
+    index.record([settings['output_scores']], key)
+    return decontam_scores
+
+
+def threshold_summary(matrix: sp.spmatrix, p_values: np.ndarray, thresholds: list) -> tuple:
+    '''
+    Computes the retained features and reads per sample for all thresholds in
+    one pass over the sparse table: every feature is assigned to the interval
+    of thresholds its p-value falls in and the reads are summed per interval.
+        Parameters:
+        ----------
+        matrix : scipy.sparse matrix
+            Feature x sample counts
+        p_values : np.ndarray
+            Decontam p-value per feature (NaN = not tested, always kept)
+        thresholds : list
+            Thresholds in increasing order
+        Returns:
+        -------
+        tuple
+            bins (per feature, kept for thresholds[j] if bins > j),
+            retained features per threshold and
+            retained reads per threshold x sample
+    '''
+    thresholds = np.asarray(thresholds, dtype=float)
+    n_bins = len(thresholds) + 1
+
+    # A feature is kept at thresholds[j] if p > thresholds[j] (or p is NaN)
+    bins = np.searchsorted(thresholds, p_values, side='left')
+    bins[np.isnan(p_values)] = len(thresholds)
+
+    indicator = sp.csr_matrix((np.ones(len(bins)), (bins, np.arange(len(bins)))),
+                              shape=(n_bins, len(bins)))
+    reads_per_bin = np.asarray((indicator @ matrix).todense())
+    features_per_bin = np.bincount(bins, minlength=n_bins)
+
+    # Retained at thresholds[j] = everything in the bins above j
+    reads_retained = np.cumsum(reads_per_bin[::-1], axis=0)[::-1][1:]
+    features_retained = np.cumsum(features_per_bin[::-1])[::-1][1:]
+    return bins, features_retained, reads_retained
+
+
+def sweep_thresholds(variant: str, thresholds: list, method: str = None,
+                     metadata_cache: dict = None, save_outputs: bool = True) -> pd.DataFrame:
+    '''
+    Filters one variant at several thresholds from a single set of decontam scores.
+        Parameters:
+        ----------
+        variant : str
+            Key of VARIANTS ("asv" or "otu")
+        thresholds : list
+            Thresholds on the decontam score to compare
+        method : str
+            Overrides the decontam method of the variant
+        metadata_cache : dict
+            Metadata objects already loaded in this run, keyed on file path
+        save_outputs : bool
+            Save a filtered table and filtered representative sequences per threshold
+        Returns:
+        -------
+        pd.DataFrame
+            Retained features and reads (total and per sample) per threshold
+    '''
+    settings = dict(VARIANTS[variant])
+    if method is not None:
+        settings['method'] = method
+    thresholds = sorted(set(thresholds))
+
+    table = Artifact.load(settings['table'])
+    decontam_scores = load_or_identify(variant, table, settings, metadata_cache or {})
+
+    biom_table = table.view(biom.Table)
+    feature_ids = np.asarray(biom_table.ids(axis='observation'))
+    sample_ids = biom_table.ids(axis='sample')
+    p_values = (decontam_scores.view(pd.DataFrame)['p']
+                .reindex(feature_ids).to_numpy(dtype=float))
+
+    bins, features_retained, reads_retained = threshold_summary(
+        biom_table.matrix_data, p_values, thresholds)
+
+    report = pd.DataFrame(reads_retained, columns=sample_ids)
+    report.insert(0, 'reads_removed', biom_table.sum() - reads_retained.sum(axis=1))
+    report.insert(0, 'reads_retained', reads_retained.sum(axis=1))
+    report.insert(0, 'features_removed', len(feature_ids) - features_retained)
+    report.insert(0, 'features_retained', features_retained)
+    report.insert(0, 'threshold', thresholds)
+
+    if save_outputs:
+        sweep_dir = f"{variant}_decontam_sweep"
+        os.makedirs(sweep_dir, exist_ok=True)
+        rep_seqs = Artifact.load(settings['rep_seqs']).view(pd.Series)
+        for j, threshold in enumerate(thresholds):
+            keep_ids = feature_ids[bins > j]
+            filtered = biom_table.filter(keep_ids, axis='observation', inplace=False)
+            # filter-features also drops the samples left without reads
+            filtered.remove_empty(axis='sample', inplace=True)
+            Artifact.import_data('FeatureTable[Frequency]', filtered).save(
+                os.path.join(sweep_dir, f"filtered-table-p{threshold}.qza"))
+            Artifact.import_data('FeatureData[Sequence]', rep_seqs[rep_seqs.index.isin(keep_ids)]).save(
+                os.path.join(sweep_dir, f"filtered-rep-seqs-p{threshold}.qza"))
+
+    return report
+
+
+# --- EXECUTION BLOCK ---
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decontaminate the ASV and/or OTU tables from Step 5.')
+    parser.add_argument('--variants', nargs='+', choices=sorted(VARIANTS), default=['asv', 'otu'],
+                        help='tables to decontaminate (default: asv otu)')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='features with p <= threshold are removed (default: %(default)s)')
+    parser.add_argument('--method', choices=['prevalence', 'frequency', 'combined'], default=None,
+                        help='decontam method for all variants (default: per variant)')
+    parser.add_argument('--sweep', nargs='+', type=float, metavar='THRESHOLD',
+                        help='compare several thresholds from one set of decontam scores')
+    parser.add_argument('--report-only', action='store_true',
+                        help='with --sweep: only write the report, no filtered artifacts')
+    args = parser.parse_args()
+
+    metadata_cache = {}
+    for variant in args.variants:
+        if args.sweep:
+            report = sweep_thresholds(variant, args.sweep, args.method, metadata_cache,
+                                      save_outputs=not args.report_only)
+            report_fp = f"{variant}_decontam_sweep.tsv"
+            report.to_csv(report_fp, sep='\t', index=False)
+            print(report[['threshold', 'features_retained', 'features_removed',
+                          'reads_retained', 'reads_removed']].to_string(index=False))
+            print(f"Sweep report (reads per sample) saved to {report_fp}")
+        else:
+            decontaminate(variant, args.threshold, args.method, metadata_cache)
+
+    print("===========================================================================")
+    print("Decontamination process completed successfully.")
+    print("===========================================================================")
+
+# in command line: python decontamination.py --variants asv --threshold 0.1
+#                  python decontamination.py --variants asv --sweep 0.05 0.1 0.2 0.3 --report-only
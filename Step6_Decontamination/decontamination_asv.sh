@@ -10,7 +10,7 @@ set -e
 # --- Configuration Variables ---
 
 TABLE="../Step5_Filtering/asv_table-filtered.qza"
-METADATA="../Data/metadata_for_q.csv"
+METADATA="../Data/metadata.tsv"
 METHOD="prevalence"
 PREV_CONTROL_COLUMN="Horse"
 PREV_CONTROL_INDICATOR="H2O"
@@ -43,7 +43,7 @@ echo "==========================================================================
 
 # --- Decontamination Variables ---
 REP_SEQS="../Step4_QCFeatureTableConstruction/rep-seqs.qza"
-TRESHOLD=0.1
+TRESHOLD="${TRESHOLD:-0.1}"
 BINSIZE=0.05
 VISUALIZATION="asv_decontam_score_viz.qzv"
 
@@ -70,7 +70,7 @@ FILTERED_TABLE="filtered-table.qza"
 qiime feature-table filter-features \
   --i-table "$TABLE" \
   --m-metadata-file "$DECONTAM_SCORES" \
-  --p-where '[p]>0.1 OR [p] IS NULL' \
+  --p-where "[p]>$TRESHOLD OR [p] IS NULL" \
   --o-filtered-table "$FILTERED_TABLE"
 
 qiime feature-table filter-seqs \
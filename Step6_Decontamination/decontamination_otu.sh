@@ -25,7 +25,7 @@ CONTROL_COL="Sample_or_Control"
 CONTROL_VAL="control"
 CONC_COL="Concentration"
 # IMPORTANT: This is the threshold to distinguish contaminants (p > 0.1)
-P_THRESHOLD=0.1 
+P_THRESHOLD="${P_THRESHOLD:-0.1}"
 
 echo "Starting Decontamination Pipeline (ASV Features)..."
 echo "----------------------------------------------------"
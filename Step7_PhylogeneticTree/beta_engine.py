@@ -0,0 +1,217 @@
+#! usr/bin/env python3
+
+#### Beta Diversity Engine
+
+#This script computes the four beta diversity metrics of core_metrics
+#(unweighted UniFrac, weighted unnormalized UniFrac, Jaccard, Bray-Curtis)
+#from one pass over the tree. A single postorder traversal numbers the tips
+#so that the tips below every node form a contiguous range; the counts of
+#every branch (the sum of the tips below it) are then differences of a
+#cumulative sum over the tip rows. From this branch x sample matrix:
+#   - unweighted UniFrac = branch length of the symmetric difference / union,
+#     with the shared length as a length-weighted product of presences
+#   - weighted UniFrac (unnormalized) = cityblock distance of the branch
+#     proportions scaled by the branch lengths
+#   - Jaccard and Bray-Curtis come from the tip rows alone
+#The samples are processed in blocks of output rows that run in parallel
+#threads (NumPy and SciPy release the GIL for the products and distances).
+
+import argparse
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.spatial.distance import cdist
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Additional_Scripts'))
+from distance_store import write_condensed
+from qza_io import QzaReader, read_table
+
+
+# Define files and names
+RAREFIED_TABLE = os.path.join("core_diversity_results", "core_metrics", "rarefied_table.qza")
+PHYLOGENY_TREE = "asv_rooted_tree.qza"
+OUTPUT_DIR = os.path.join("core_diversity_results", "core_metrics")
+N_THREADS = int(os.environ.get("N_THREADS", 0)) # 0 = all available cores
+
+METRICS = ['unweighted_unifrac', 'weighted_unifrac', 'jaccard', 'bray_curtis']
+
+# Output rows per block
+BLOCK_SIZE = 256
+
+
+def read_tree(tree_fp: str):
+    '''Reads the Phylogeny[Rooted] of a .qza as a skbio TreeNode.'''
+    from skbio import TreeNode
+
+    with QzaReader(tree_fp) as qza, qza.open_member('tree.nwk') as fh:
+        return TreeNode.read(io.TextIOWrapper(io.BufferedReader(fh)), format='newick')
+
+
+def tree_layout(tree, feature_ids) -> tuple:
+    '''
+    Walks the tree once (postorder) and describes it by tip ranges.
+        Parameters:
+        ----------
+        tree : skbio.TreeNode
+            Rooted tree
+        feature_ids : array-like
+            Feature IDs of the table rows
+        Returns:
+        -------
+        tuple
+            (tip order: table row of every tip or -1 if the tip is not in the table,
+             branch lengths, first tip and end tip of every branch; the root is left out)
+    '''
+    row_of = {feature_id: row for row, feature_id in enumerate(feature_ids)}
+    tip_rows, lengths, starts, stops = [], [], [], []
+    first_tip = {}
+    for node in tree.postorder(include_self=True):
+        if node.is_tip():
+            first_tip[id(node)] = len(tip_rows)
+            tip_rows.append(row_of.get(node.name, -1))
+        else:
+            first_tip[id(node)] = first_tip[id(node.children[0])]
+        if node.parent is not None:
+            lengths.append(node.length or 0.0)
+            starts.append(first_tip[id(node)])
+            stops.append(len(tip_rows))
+    missing = set(row_of) - {feature_ids[row] for row in tip_rows if row >= 0}
+    if missing:
+        raise ValueError(f"{len(missing)} features of the table are not tips of the tree, e.g. {sorted(missing)[:3]}")
+    return np.asarray(tip_rows), np.asarray(lengths), np.asarray(starts), np.asarray(stops)
+
+
+def branch_counts(matrix: sp.spmatrix, layout: tuple) -> np.ndarray:
+    '''Returns the counts of every branch per sample (branches x samples) from the feature x sample table.'''
+    tip_rows, _, starts, stops = layout
+    dense = np.asarray(matrix.todense(), dtype=np.float64)
+    tips = np.zeros((len(tip_rows), dense.shape[1]))
+    present = tip_rows >= 0
+    tips[present] = dense[tip_rows[present]]
+    cumulative = np.zeros((len(tip_rows) + 1, dense.shape[1]))
+    np.cumsum(tips, axis=0, out=cumulative[1:])
+    return cumulative[stops] - cumulative[starts]
+
+
+def _blocks(n_samples: int, block_size: int) -> list:
+    return [(start, min(start + block_size, n_samples)) for start in range(0, n_samples, block_size)]
+
+
+def beta_diversity(matrix: sp.spmatrix, layout: tuple, metrics: list = METRICS,
+                   n_threads: int = N_THREADS, block_size: int = BLOCK_SIZE) -> dict:
+    '''
+    Computes several beta diversity metrics from one traversal of the tree.
+        Parameters:
+        ----------
+        matrix : scipy.sparse matrix
+            Feature x sample counts (rarefied)
+        layout : tuple
+            Tree layout of the table features (see tree_layout)
+        metrics : list
+            Metrics to compute (see METRICS)
+        n_threads : int
+            Threads for the blocks (0 = all available cores)
+        block_size : int
+            Output rows per block
+        Returns:
+        -------
+        dict
+            Square distance matrix (samples x samples) per metric
+    '''
+    unknown = set(metrics) - set(METRICS)
+    if unknown:
+        raise ValueError(f"unknown metrics: {', '.join(sorted(unknown))}")
+    lengths = layout[1]
+    n_samples = matrix.shape[1]
+    inputs = {}
+
+    if 'unweighted_unifrac' in metrics or 'weighted_unifrac' in metrics:
+        branches = branch_counts(matrix, layout)
+        if 'unweighted_unifrac' in metrics:
+            presence = (branches > 0).astype(np.float64)
+            # Shared branch length of two samples = presence^T diag(L) presence
+            inputs['unweighted_unifrac'] = (presence.T * lengths, presence, presence.T @ lengths)
+        if 'weighted_unifrac' in metrics:
+            totals = np.asarray(matrix.sum(axis=0)).ravel()
+            inputs['weighted_unifrac'] = np.ascontiguousarray((branches * lengths[:, None] / totals).T)
+    if 'jaccard' in metrics or 'bray_curtis' in metrics:
+        counts = np.asarray(matrix.todense(), dtype=np.float64).T
+        if 'jaccard' in metrics:
+            presence = (counts > 0).astype(np.float64)
+            inputs['jaccard'] = (presence, presence.T, presence.sum(axis=1))
+        if 'bray_curtis' in metrics:
+            inputs['bray_curtis'] = (counts, counts.sum(axis=1))
+
+    def block(metric, start, stop):
+        if metric in ('unweighted_unifrac', 'jaccard'):
+            weighted_rows, columns, totals = inputs[metric]
+            shared = weighted_rows[start:stop] @ columns
+            union = totals[start:stop, None] + totals[None, :] - shared
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return np.where(union > 0, (union - shared) / union, 0.0)
+        if metric == 'weighted_unifrac':
+            scaled = inputs[metric]
+            return cdist(scaled[start:stop], scaled, 'cityblock')
+        counts, totals = inputs[metric]
+        denominator = totals[start:stop, None] + totals[None, :]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(denominator > 0, cdist(counts[start:stop], counts, 'cityblock') / denominator, 0.0)
+
+    results = {metric: np.empty((n_samples, n_samples)) for metric in metrics}
+    tasks = [(metric, start, stop) for metric in metrics for start, stop in _blocks(n_samples, block_size)]
+    with ThreadPoolExecutor(max_workers=max(1, min(n_threads or os.cpu_count(), len(tasks)))) as executor:
+        for (metric, start, stop), values in zip(tasks, executor.map(lambda task: block(*task), tasks)):
+            results[metric][start:stop] = values
+    for distances in results.values():
+        # Exact symmetry and zero diagonal, as required by DistanceMatrix
+        distances[:] = (distances + distances.T) / 2.0
+        np.fill_diagonal(distances, 0.0)
+    return results
+
+
+def save_distance_matrices(results: dict, sample_ids, output_dir: str) -> list:
+    '''Saves the distance matrices as DistanceMatrix artifacts (<metric>_distance_matrix.qza).'''
+    from qiime2 import Artifact
+    from skbio import DistanceMatrix
+
+    os.makedirs(output_dir, exist_ok=True)
+    saved = []
+    for metric, distances in results.items():
+        output_fp = os.path.join(output_dir, f"{metric}_distance_matrix.qza")
+        Artifact.import_data('DistanceMatrix', DistanceMatrix(distances, list(sample_ids))).save(output_fp)
+        saved.append(output_fp)
+    return saved
+
+
+# --- EXECUTION BLOCK ---
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the core beta diversity metrics with one tree traversal.')
+    parser.add_argument('--table', default=RAREFIED_TABLE, help='rarefied feature table (default: %(default)s)')
+    parser.add_argument('--tree', default=PHYLOGENY_TREE)
+    parser.add_argument('--metrics', nargs='+', default=METRICS, choices=METRICS)
+    parser.add_argument('--threads', type=int, default=N_THREADS, help='threads (0 = all cores)')
+    parser.add_argument('--output-dir', default=OUTPUT_DIR)
+    parser.add_argument('--compact', action='store_true',
+                        help='write compact float32 .cdm files instead of .qza (see distance_store.py)')
+    args = parser.parse_args()
+
+    print(f"Loading {args.table} and {args.tree}...")
+    matrix, feature_ids, sample_ids = read_table(args.table)
+    layout = tree_layout(read_tree(args.tree), feature_ids)
+
+    print(f"Computing {', '.join(args.metrics)} for {len(sample_ids)} samples and {len(layout[1])} branches...")
+    results = beta_diversity(matrix, layout, args.metrics, args.threads)
+    if args.compact:
+        os.makedirs(args.output_dir, exist_ok=True)
+        saved = [write_condensed(os.path.join(args.output_dir, f"{metric}_distance_matrix.cdm"), distances, sample_ids)
+                 for metric, distances in results.items()]
+    else:
+        saved = save_distance_matrices(results, sample_ids, args.output_dir)
+    for output_fp in saved:
+        print(f"Saved {output_fp}")
+
+# in command line: python beta_engine.py --table core_diversity_results/core_metrics/rarefied_table.qza
@@ -2,11 +2,25 @@
 
 #### Diversity Analysis Script
 
+#This script runs the Step 7 diversity analysis for the ASV data: core
+#metrics (rarefaction, alpha vectors, distance matrices, PCoA), alpha and
+#beta group significance and the Emperor plots. The results of
+#core_metrics_phylogenetic are handed to the downstream actions in memory,
+#and every output is saved by a background thread pool, so writing the
+#archives overlaps with the statistics instead of blocking them.
+
 from qiime2 import Artifact
 import qiime2.plugins.diversity.actions as diversity_actions
 import qiime2.plugins.emperor.actions as emperor_actions
 
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Additional_Scripts'))
+from artifact_cache import load_artifact, load_metadata
+from distance_store import artifact_to_compact, compact_fp
+from sampling_depth import depth_param
 
 
 #### ASV Diversity Analysis
@@ -14,141 +28,191 @@ import os
 # Define files and names
 PHYLOGENY_TREE = os.path.join("asv_rooted_tree.qza")
 TABLE = os.path.join("../", "Step6_Decontamination", "filtered-table.qza")
-SAMPLING_DEPTH = 9000 # according to table summary we exclude not many samples (<25%) by this threshold
-METADATA = os.path.join("../", "Data", "metadata_for_q.csv")
+SAMPLING_DEPTH = depth_param("SAMPLING_DEPTH", 9000) # according to table summary we exclude not many samples (<25%) by this threshold, "auto": chosen by sampling_depth.py
+METADATA = os.path.join("../", "Data", "metadata.tsv")
+N_THREADS = int(os.environ.get("N_THREADS", 1)) # raised by the pipeline runner, 0 = all available cores
+SAVE_THREADS = int(os.environ.get("SAVE_THREADS", 4)) # threads writing the output archives
+COMPACT_DISTANCES = os.environ.get("COMPACT_DISTANCES", "0") == "1" # also write the distance matrices as .cdm
 DIVERSITY_OUTPUT_DIR = "core_diversity_results"
 
-
+CORE_METRICS_PREFIX = os.path.join(DIVERSITY_OUTPUT_DIR, "core_metrics")
 ALPHA_OUTPUT_PREFIX = os.path.join(DIVERSITY_OUTPUT_DIR, "alpha_group_significance")
 BETA_OUTPUT_PREFIX = os.path.join(DIVERSITY_OUTPUT_DIR, "beta_group_significance")
 
-#checking if files exist or are found
-files = [PHYLOGENY_TREE, TABLE, METADATA]
-try:
-    missing_files = [path for path in files if not os.path.exists(path)]
-    if missing_files:
-        raise FileNotFoundError(f"Missing files: {missing_files}")
-except FileNotFoundError as e:
-    print(e)
+# Tests and plots (results of core_metrics_phylogenetic by name)
+ALPHA_VECTORS = {'faith_pd': 'faith_pd_vector', 'evenness': 'evenness_vector'}
+BETA_TESTS = [('unweighted_unifrac', 'unweighted_unifrac_distance_matrix', 'disease_state'),
+              ('unweighted_unifrac', 'unweighted_unifrac_distance_matrix', 'Horse')]
+EMPEROR_PLOTS = {'unweighted_unifrac': 'unweighted_unifrac_pcoa_results',
+                 'bray_curtis': 'bray_curtis_pcoa_results'}
 
 
-#defining saving function
-def save_artifact(results, prefix):
+class OutputWriter:
     '''
-    This function saves the artifacts from diversity analysis to specified output directory.
+    Saves artifacts and visualizations in background threads.
+    Leaving the with-block waits for all saves and raises the first error.
     '''
-    print(f"Saving artifacts to disk with prefix: {prefix}")
-    for name, artifact in results._asdict().items():
-        if isinstance(artifact, Artifact):
-            artifact.save(os.path.join(prefix, f"{name}.qza"))
-        elif visualization := getattr(artifact, 'visualization', None):
-            visualization.save(os.path.join(prefix, f"{name}.qzv"))
-
-# executing diversity analysis
-print("============================================")
-print("1.Starting diversity analysis for ASV data...")
-print("============================================")
-
-try:
-    action_results = diversity_actions.core_metrics_phylogenetic(
-        phylogeny=Artifact.load(PHYLOGENY_TREE),
-        table=Artifact.load(TABLE),
-        sampling_depth=SAMPLING_DEPTH,
-        metadata = METADATA,
-    )
 
-    rarefied_table = action_results.rarefied_table
-    faith_pd_vector = action_results.faith_pd_vector
-    observed_features_vector = action_results.observed_features_vector
-    shannon_vector = action_results.shannon_vector
-    evenness_vector = action_results.evenness_vector
-    unweighted_unifrac_distance_matrix = action_results.unweighted_unifrac_distance_matrix
-    weighted_unifrac_distance_matrix = action_results.weighted_unifrac_distance_matrix
-    jaccard_distance_matrix = action_results.jaccard_distance_matrix
-    bray_curtis_distance_matrix = action_results.bray_curtis_distance_matrix
-    unweighted_unifrac_pcoa_results = action_results.unweighted_unifrac_pcoa_results
-    weighted_unifrac_pcoa_results = action_results.weighted_unifrac_pcoa_results
-    jaccard_pcoa_results = action_results.jaccard_pcoa_results
-    bray_curtis_pcoa_results = action_results.bray_curtis_pcoa_results
-    unweighted_unifrac_emperor_viz = action_results.unweighted_unifrac_emperor
-    weighted_unifrac_emperor_viz = action_results.weighted_unifrac_emperor
-    jaccard_emperor_viz = action_results.jaccard_emperor
-    bray_curtis_emperor_viz = action_results.bray_curtis_emperor
-
-except Exception as e:
-    print(f"An error occurred during diversity analysis: {e}")
-
-print("Finished  calculating diverstiy metrics succesfulley")
-
-
-print("============================================")
-print("2.Testing for associations between categorical metadata columns and alpha diversity data")
-print("============================================")
-
-print("Testing Faith's PD...")
-
-try:
-    faith_pd_group_significance_viz, = diversity_actions.alpha_group_significance(
-        alpha_diversity = faith_pd_vector,
-        metadata = METADATA,
-    )
+    def __init__(self, n_threads: int = SAVE_THREADS):
+        self.executor = ThreadPoolExecutor(max_workers=max(1, n_threads))
+        self.futures = []
 
-    eveness_group_significance_viz, = diversity_actions.alpha_group_significance(
-        alpha_diversity = evenness_vector,
-        metadata = METADATA,
-    )
+    def save(self, result, fp: str) -> None:
+        os.makedirs(os.path.dirname(fp) or ".", exist_ok=True)
+        self.futures.append(self.executor.submit(self._save, result, fp))
 
-except Exception as e:
-    print(f"An error occurred during alpha diversity group significance testing: {e}")
+    def submit(self, function, *args) -> None:
+        '''Runs another writing function (returning the written file path) in the background.'''
+        self.futures.append(self.executor.submit(function, *args))
 
-print("Finished testing for associations with categorical metadata columns")
+    @staticmethod
+    def _save(result, fp):
+        result.save(fp)
+        return fp
 
+    def wait(self) -> list:
+        saved = [future.result() for future in self.futures]
+        self.futures = []
+        return saved
 
-print("============================================")
-print("3.Analyzing beta diversity differences with PERMANOVA")
-print("============================================")
+    def __enter__(self):
+        return self
 
-print("Running PERMANOVA on Unweighted UniFrac...")
+    def __exit__(self, *exc):
+        try:
+            if exc[0] is None:
+                self.wait()
+        finally:
+            self.executor.shutdown(wait=True)
 
-try:
-    disease_state_mdc = sample_metadata_md.get_column('disease_state')
-    unweighted_unifrac_disease_state_group_significance_viz, = diversity_actions.beta_group_significance(
-    distance_matrix=unweighted_unifrac_distance_matrix,
-    metadata=disease_state_mdc,
-    pairwise=True,
-    )
-    horse_mdc = sample_metadata_md.get_column('Horse')
-    unweighted_unifrac_horse_group_significance_viz, = diversity_actions.beta_group_significance(
-        distance_matrix=unweighted_unifrac_distance_matrix,
-        metadata=horse_mdc,
-        pairwise=True,
-    )
-except Exception as e:
-    print(f"An error occurred during beta diversity group significance testing: {e}")
 
-print("Finished PERMANOVA analysis on beta diversity metrics")
-
-
-
-print("=============================================")
-print("4.Ordination for exploring microbial community composition")
-print("=============================================")
+def save_artifacts(results, prefix, writer):
+    '''
+    Queues the artifacts of a results object for saving to the output directory.
+        Parameters:
+        ----------
+        results : qiime2.Results
+            Results of an action
+        prefix : str
+            Output directory
+        writer : OutputWriter
+            Background writer
+    '''
+    print(f"Saving artifacts to disk with prefix: {prefix}")
+    for name, artifact in results._asdict().items():
+        if isinstance(artifact, Artifact):
+            writer.save(artifact, os.path.join(prefix, f"{name}.qza"))
+            if COMPACT_DISTANCES and name.endswith("_distance_matrix"):
+                writer.submit(artifact_to_compact, artifact, compact_fp(os.path.join(prefix, f"{name}.qza")))
+        elif visualization := getattr(artifact, 'visualization', None):
+            writer.save(visualization, os.path.join(prefix, f"{name}.qzv"))
 
-print("Generating Emperor plots for Unweighted UniFrac...")
 
-try:
-    unweighted_unifrac_emperor_days_since_experiment_start_viz, = emperor_actions.plot(
-        pcoa=unweighted_unifrac_pcoa_results,
-        metadata= METADATA,
+def core_metrics(table, phylogeny, metadata, sampling_depth=SAMPLING_DEPTH, n_threads=N_THREADS):
+    '''Runs core_metrics_phylogenetic and returns its results.'''
+    return diversity_actions.core_metrics_phylogenetic(
+        phylogeny=phylogeny,
+        table=table,
+        sampling_depth=sampling_depth,
+        metadata=metadata,
+        n_jobs_or_threads=n_threads if n_threads > 0 else "auto",
     )
-    bray_curtis_emperor_days_since_experiment_start_viz, = emperor_actions.plot(
-        pcoa=bray_curtis_pcoa_results,
-        metadata= METADATA,
-    )
-
-except Exception as e:
-    print(f"An error occurred during Emperor plot generation: {e}")
-print("Finished generating Emperor plots for ordination analysis")
 
 
-print("Diversity analysis script completed.")
+def alpha_significance(results, metadata, writer):
+    '''Tests the alpha vectors against the categorical metadata columns (Kruskal-Wallis).'''
+    for label, name in ALPHA_VECTORS.items():
+        print(f"Testing {label}...")
+        significance = diversity_actions.alpha_group_significance(
+            alpha_diversity=getattr(results, name),
+            metadata=metadata,
+        )
+        writer.save(significance.visualization, f"{ALPHA_OUTPUT_PREFIX}_{label}.qzv")
+
+
+def beta_significance(results, metadata, writer):
+    '''Runs PERMANOVA (with pairwise tests) for the configured distance matrices and columns.'''
+    for label, name, column in BETA_TESTS:
+        print(f"Running PERMANOVA on {label} for '{column}'...")
+        visualization, = diversity_actions.beta_group_significance(
+            distance_matrix=getattr(results, name),
+            metadata=metadata.get_column(column),
+            pairwise=True,
+        )
+        writer.save(visualization, f"{BETA_OUTPUT_PREFIX}_{label}_{column.lower()}.qzv")
+
+
+def ordination(results, metadata, writer):
+    '''Generates the Emperor plots of the PCoA results.'''
+    for label, name in EMPEROR_PLOTS.items():
+        print(f"Generating Emperor plot for {label}...")
+        visualization, = emperor_actions.plot(
+            pcoa=getattr(results, name),
+            metadata=metadata,
+        )
+        writer.save(visualization, os.path.join(DIVERSITY_OUTPUT_DIR, f"emperor_{label}.qzv"))
+
+
+# --- EXECUTION BLOCK ---
+if __name__ == '__main__':
+    print("============================================")
+    print("1. Initializing Diversity Analysis for ASV Data...")
+    print("============================================")
+
+    # Load Metadata and check inputs
+    try:
+        missing_files = [path for path in [PHYLOGENY_TREE, TABLE, METADATA] if not os.path.exists(path)]
+        if missing_files:
+            raise FileNotFoundError(f"Missing files: {missing_files}")
+        metadata_obj = load_metadata(METADATA)
+        rooted_tree_art = load_artifact(PHYLOGENY_TREE)
+        table_art = load_artifact(TABLE)
+    except Exception as e:
+        print(f"ERROR during setup: {e}")
+        exit(1)
+
+    with OutputWriter() as writer:
+        # Core metrics, saved in the background while the tests run
+        print(f"Executing core_metrics_phylogenetic at depth: {SAMPLING_DEPTH}...")
+        try:
+            action_results = core_metrics(table_art, rooted_tree_art, metadata_obj)
+            save_artifacts(action_results, CORE_METRICS_PREFIX, writer)
+        except Exception as e:
+            print(f"An error occurred during core metrics calculation: {e}")
+            exit(1)
+        print("Finished calculating diversity metrics successfully.")
+
+        print("============================================")
+        print("2. Testing for associations between metadata and alpha diversity data")
+        print("============================================")
+        try:
+            alpha_significance(action_results, metadata_obj, writer)
+        except Exception as e:
+            # Continue even if alpha testing fails, beta and ordination may still be fine
+            print(f"An error occurred during alpha diversity group significance testing: {e}")
+        print("Finished testing for associations with categorical metadata columns")
+
+        print("============================================")
+        print("3. Analyzing beta diversity differences with PERMANOVA")
+        print("============================================")
+        try:
+            beta_significance(action_results, metadata_obj, writer)
+        except Exception as e:
+            print(f"An error occurred during beta diversity group significance testing: {e}")
+            exit(1)
+        print("Finished PERMANOVA analysis on beta diversity metrics")
+
+        print("=============================================")
+        print("4. Ordination for exploring microbial community composition")
+        print("=============================================")
+        try:
+            ordination(action_results, metadata_obj, writer)
+        except Exception as e:
+            print(f"An error occurred during Emperor plot generation: {e}")
+            exit(1)
+        print("Finished generating Emperor plots for ordination analysis")
+
+        print("Waiting for the outputs to be written...")
+    print(f"\nDiversity analysis script completed successfully, outputs in {DIVERSITY_OUTPUT_DIR}.")
+
+# in command line: python diversity_analysis.py
@@ -0,0 +1,287 @@
+#! usr/bin/env python3
+
+#### Batch Group Significance Script
+
+#This script tests every categorical metadata column against all distance
+#matrices (PERMANOVA, overall and pairwise) and all alpha vectors
+#(Kruskal-Wallis, overall and pairwise) of the core metrics. The tests are
+#the ones behind beta_group_significance and alpha_group_significance
+#(PERMANOVA through the batched engine in permanova.py). They run in a
+#process pool whose workers share the distance matrices loaded once by the
+#main process, and all results are written to one table of test statistics,
+#p-values and Benjamini-Hochberg q-values. The .qzv visualizations are only
+#generated with --qzv.
+
+import argparse
+import itertools
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.stats import kruskal
+from statsmodels.stats.multitest import multipletests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Additional_Scripts'))
+from distance_store import open_matrix
+from qza_io import read_alpha_diversity
+from permanova import permanova, squared_distances
+
+
+# Define files and names
+CORE_METRICS_DIR = os.path.join("core_diversity_results", "core_metrics")
+METADATA = os.path.join("../", "Data", "metadata.tsv")
+OUTPUT_TSV = os.path.join("core_diversity_results", "group_significance.tsv")
+OUTPUT_QZV_DIR = os.path.join("core_diversity_results", "group_significance")
+N_THREADS = int(os.environ.get("N_THREADS", 0)) # 0 = all available cores
+PERMUTATIONS = int(os.environ.get("PERMUTATIONS", 999))
+
+DISTANCE_MATRICES = ['unweighted_unifrac', 'weighted_unifrac', 'jaccard', 'bray_curtis']
+ALPHA_VECTORS = ['faith_pd', 'observed_features', 'shannon', 'evenness']
+
+RESULT_COLUMNS = ['test', 'metric', 'column', 'group1', 'group2', 'sample_size', 'number_of_groups',
+                  'test_statistic', 'p_value', 'q_value', 'permutations']
+
+# Loaded data of the worker processes (set once per worker by _init_worker)
+_distance_matrices = {}
+_alpha_vectors = {}
+
+
+def load_inputs(core_metrics_dir: str, metrics: list, alpha_metrics: list) -> tuple:
+    '''
+    Opens the distance matrices (memory mapped if there is a compact .cdm
+    file, see distance_store.py) and reads the alpha vectors of the core metrics.
+    '''
+    distance_matrices = {metric: open_matrix(os.path.join(core_metrics_dir, f"{metric}_distance_matrix.qza"))
+                         for metric in metrics}
+    alpha_vectors = {metric: read_alpha_diversity(os.path.join(core_metrics_dir, f"{metric}_vector.qza"))
+                     for metric in alpha_metrics}
+    return distance_matrices, alpha_vectors
+
+
+def categorical_columns(metadata: pd.DataFrame, columns: list = None) -> pd.DataFrame:
+    '''
+    Selects the categorical columns that can be tested, like the QIIME 2 actions do:
+    columns with a single value or only unique values are dropped.
+    '''
+    selected = {}
+    for column in columns or metadata.columns:
+        values = metadata[column].dropna()
+        if pd.api.types.is_numeric_dtype(values):
+            continue
+        n_groups = values.nunique()
+        if 1 < n_groups < len(values):
+            selected[column] = metadata[column]
+    return pd.DataFrame(selected, index=metadata.index)
+
+
+def _init_worker(distance_matrices: dict, alpha_vectors: dict) -> None:
+    global _distance_matrices, _alpha_vectors
+    _distance_matrices = distance_matrices
+    _alpha_vectors = alpha_vectors
+
+
+def _result(test, metric, column, group1, group2, sample_size, number_of_groups, statistic, p_value, permutations):
+    return {'test': test, 'metric': metric, 'column': column, 'group1': group1, 'group2': group2,
+            'sample_size': sample_size, 'number_of_groups': number_of_groups,
+            'test_statistic': statistic, 'p_value': p_value, 'q_value': np.nan, 'permutations': permutations}
+
+
+def add_q_values(rows: list) -> list:
+    '''Sets the Benjamini-Hochberg q-values of the pairwise rows (per metric and column, as in the visualizations).'''
+    pairwise = [row for row in rows if row['group2'] and not np.isnan(row['p_value'])]
+    if pairwise:
+        pairwise_p = [row['p_value'] for row in pairwise]
+        for row, q_value in zip(pairwise, multipletests(pairwise_p, method='fdr_bh')[1]):
+            row['q_value'] = q_value
+    return rows
+
+
+def beta_test(metric: str, column: str, grouping: pd.Series, permutations: int, pairwise: bool, seed: int) -> list:
+    '''
+    Runs PERMANOVA of one distance matrix against one metadata column.
+        Parameters:
+        ----------
+        metric : str
+            Name of a loaded distance matrix
+        column : str
+            Name of the metadata column
+        grouping : pd.Series
+            Metadata column (missing values are dropped)
+        permutations : int
+            Number of permutations
+        pairwise : bool
+            Also test every pair of groups
+        seed : int
+            Seed of the permutations (None for a random seed)
+        Returns:
+        -------
+        list
+            One result row for the overall test and one per pair
+    '''
+    distance_matrix = _distance_matrices[metric]
+    ids = pd.Index(distance_matrix.ids)
+    grouping = grouping.dropna()
+    index = np.flatnonzero(ids.isin(grouping.index))
+    # Only the distances of the tested samples are read
+    d2 = squared_distances(distance_matrix.submatrix(index))
+    grouping = grouping.reindex(ids[index]).to_numpy()
+
+    try:
+        result = permanova(d2, grouping, permutations, seed)
+        statistic, p_value = float(result['test statistic']), float(result['p-value'])
+    except ValueError:
+        # Every group has a single sample (or there is only one group)
+        statistic, p_value = np.nan, np.nan
+    rows = [_result('permanova', metric, column, '', '', len(grouping), len(np.unique(grouping)),
+                    statistic, p_value, permutations)]
+    if pairwise:
+        for group1, group2 in itertools.combinations(np.unique(grouping), 2):
+            pair = np.flatnonzero((grouping == group1) | (grouping == group2))
+            try:
+                result = permanova(d2[np.ix_(pair, pair)], grouping[pair], permutations, seed)
+                statistic, p_value = float(result['test statistic']), float(result['p-value'])
+            except ValueError:
+                # Both groups have a single sample
+                statistic, p_value = np.nan, np.nan
+            rows.append(_result('permanova', metric, column, group1, group2, len(pair), 2,
+                                statistic, p_value, permutations))
+    return add_q_values(rows)
+
+
+def alpha_test(metric: str, column: str, grouping: pd.Series, pairwise: bool) -> list:
+    '''Runs the Kruskal-Wallis test of one alpha vector against one metadata column (overall and pairwise).'''
+    alpha = _alpha_vectors[metric]
+    grouping = grouping.dropna()
+    grouping = grouping[grouping.index.isin(alpha.index)]
+    groups = {name: alpha[ids.index].to_numpy() for name, ids in grouping.groupby(grouping)}
+
+    try:
+        statistic, p_value = kruskal(*groups.values()) if len(groups) > 1 else (np.nan, np.nan)
+    except ValueError:
+        # All values identical
+        statistic, p_value = np.nan, np.nan
+    rows = [_result('kruskal-wallis', metric, column, '', '', len(grouping), len(groups),
+                    float(statistic), float(p_value), 0)]
+    if pairwise:
+        for group1, group2 in itertools.combinations(sorted(groups), 2):
+            try:
+                statistic, p_value = kruskal(groups[group1], groups[group2])
+            except ValueError:
+                # All values identical
+                statistic, p_value = np.nan, np.nan
+            rows.append(_result('kruskal-wallis', metric, column, group1, group2,
+                                len(groups[group1]) + len(groups[group2]), 2,
+                                float(statistic), float(p_value), 0))
+    return add_q_values(rows)
+
+
+def run_batch(distance_matrices: dict, alpha_vectors: dict, metadata: pd.DataFrame,
+              permutations: int = PERMUTATIONS, pairwise: bool = True, seed: int = None,
+              n_workers: int = N_THREADS) -> pd.DataFrame:
+    '''
+    Tests every metadata column against every distance matrix and alpha vector.
+        Parameters:
+        ----------
+        distance_matrices : dict
+            Opened distance matrix per metric (see distance_store.open_matrix)
+        alpha_vectors : dict
+            pd.Series per alpha metric
+        metadata : pd.DataFrame
+            Categorical metadata columns to test
+        permutations : int
+            Number of PERMANOVA permutations
+        pairwise : bool
+            Also test every pair of groups
+        seed : int
+            Seed of the permutations (None for a random seed)
+        n_workers : int
+            Worker processes (0 = all available cores)
+        Returns:
+        -------
+        pd.DataFrame
+            One row per test (see RESULT_COLUMNS)
+    '''
+    n_tasks = len(metadata.columns) * (len(distance_matrices) + len(alpha_vectors))
+    n_workers = max(1, min(n_workers or os.cpu_count(), n_tasks))
+    rows = []
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                             initargs=(distance_matrices, alpha_vectors)) as executor:
+        futures = []
+        for column in metadata.columns:
+            for metric in distance_matrices:
+                futures.append(executor.submit(beta_test, metric, column, metadata[column],
+                                               permutations, pairwise, seed))
+            for metric in alpha_vectors:
+                futures.append(executor.submit(alpha_test, metric, column, metadata[column], pairwise))
+        for future in futures:
+            rows.extend(future.result())
+    return pd.DataFrame(rows, columns=RESULT_COLUMNS)
+
+
+def write_visualizations(metrics: list, alpha_metrics: list, columns: list, core_metrics_dir: str,
+                         metadata_fp: str, output_dir: str, pairwise: bool, permutations: int) -> None:
+    '''Generates the alpha/beta_group_significance .qzv files of the batch.'''
+    import qiime2.plugins.diversity.actions as diversity_actions
+    from artifact_cache import load_artifact, load_metadata
+    from diversity_analysis import OutputWriter
+
+    metadata = load_metadata(metadata_fp)
+    with OutputWriter() as writer:
+        for metric in alpha_metrics:
+            print(f"Generating alpha group significance for {metric}...")
+            visualization, = diversity_actions.alpha_group_significance(
+                alpha_diversity=load_artifact(os.path.join(core_metrics_dir, f"{metric}_vector.qza")),
+                metadata=metadata.filter_columns(column_type='categorical'),
+            )
+            writer.save(visualization, os.path.join(output_dir, f"alpha_{metric}.qzv"))
+        for metric, column in itertools.product(metrics, columns):
+            print(f"Generating beta group significance for {metric} and '{column}'...")
+            visualization, = diversity_actions.beta_group_significance(
+                distance_matrix=load_artifact(os.path.join(core_metrics_dir, f"{metric}_distance_matrix.qza")),
+                metadata=metadata.get_column(column),
+                pairwise=pairwise,
+                permutations=permutations,
+            )
+            writer.save(visualization, os.path.join(output_dir, f"beta_{metric}_{column.lower()}.qzv"))
+
+
+# --- EXECUTION BLOCK ---
+if __name__ == '__main__':
+    from artifact_cache import load_metadata
+
+    parser = argparse.ArgumentParser(description='Test all categorical metadata columns against all diversity metrics.')
+    parser.add_argument('--core-metrics-dir', default=CORE_METRICS_DIR)
+    parser.add_argument('--metadata', default=METADATA)
+    parser.add_argument('--columns', nargs='+', default=None, help='metadata columns (default: all categorical columns)')
+    parser.add_argument('--metrics', nargs='+', default=DISTANCE_MATRICES, help='distance matrices (default: %(default)s)')
+    parser.add_argument('--alpha-metrics', nargs='+', default=ALPHA_VECTORS, help='alpha vectors (default: %(default)s)')
+    parser.add_argument('--permutations', type=int, default=PERMUTATIONS)
+    parser.add_argument('--seed', type=int, default=None, help='seed of the permutations (default: random)')
+    parser.add_argument('--no-pairwise', action='store_true', help='only run the overall tests')
+    parser.add_argument('--workers', type=int, default=N_THREADS, help='worker processes (0 = all cores)')
+    parser.add_argument('--output', default=OUTPUT_TSV)
+    parser.add_argument('--qzv', action='store_true', help=f'also write the .qzv visualizations to {OUTPUT_QZV_DIR}')
+    args = parser.parse_args()
+
+    metadata = categorical_columns(load_metadata(args.metadata).to_dataframe(), args.columns)
+    if metadata.empty:
+        parser.error("no testable categorical metadata column")
+    print(f"Testing {len(metadata.columns)} columns ({', '.join(metadata.columns)}) against "
+          f"{len(args.metrics)} distance matrices and {len(args.alpha_metrics)} alpha vectors...")
+
+    distance_matrices, alpha_vectors = load_inputs(args.core_metrics_dir, args.metrics, args.alpha_metrics)
+    results = run_batch(distance_matrices, alpha_vectors, metadata, args.permutations,
+                        not args.no_pairwise, args.seed, args.workers)
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    results.to_csv(args.output, sep='\t', index=False)
+    print(results[results['group2'] == ''].to_string(index=False))
+    print(f"{len(results)} tests saved to {args.output}")
+
+    if args.qzv:
+        write_visualizations(args.metrics, args.alpha_metrics, list(metadata.columns), args.core_metrics_dir,
+                             args.metadata, OUTPUT_QZV_DIR, not args.no_pairwise, args.permutations)
+        print(f"Visualizations saved to {OUTPUT_QZV_DIR}")
+
+# in command line: python group_significance.py --permutations 999 --seed 42
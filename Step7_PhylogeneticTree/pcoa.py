@@ -0,0 +1,282 @@
+#! usr/bin/env python3
+
+#### Randomized PCoA Script
+
+#This script computes only the first k axes of a principal coordinate
+#analysis with a randomized eigensolver instead of the full
+#eigendecomposition (O(N^3)) behind the *_pcoa_results.qza of core_metrics.
+#The double-centered matrix B = -1/2 J D^2 J is never built: products with
+#B are formed from blocks of rows of the squared distances, the row means
+#and the grand mean. A randomized range finder with a few power iterations
+#gives an orthonormal basis Q of the leading subspace, and the eigenvalues
+#and axes come from the small matrix Q^T B Q.
+#
+#The full method divides the eigenvalues by the sum of the positive
+#eigenvalues of B. For non-Euclidean matrices (UniFrac, Bray-Curtis) this
+#sum is larger than trace(B) = N * mean(D^2) / 2, the sum of all eigenvalues
+#that scikit-bio's fsvd divides by, so the trace overstates the proportions.
+#The proportions are therefore computed from (--proportions):
+#   estimate: the first k eigenvalues plus a stochastic Lanczos quadrature
+#             estimate of the positive eigenvalues of B outside the first k
+#             axes (products with B only, within a few percent of the full
+#             method), the default
+#   exact:    all eigenvalues of B (B in memory, O(N^3)), equal to the full method
+#   trace:    trace(B), like fsvd (not comparable with the full method)
+
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Additional_Scripts'))
+from distance_store import open_matrix
+
+
+# Define files and names
+DISTANCE_MATRIX = os.path.join("core_diversity_results", "core_metrics", "unweighted_unifrac_distance_matrix.qza")
+METADATA = os.path.join("../", "Data", "metadata.tsv")
+N_THREADS = int(os.environ.get("N_THREADS", 0)) # 0 = all available cores
+DIMENSIONS = int(os.environ.get("PCOA_DIMENSIONS", 10))
+
+# Extra random vectors and power iterations of the range finder
+OVERSAMPLING = 10
+POWER_ITERATIONS = 4
+
+# Random probe vectors and Lanczos steps of the positive eigenvalue estimate
+# (every step is one product of B with all probes)
+PROBES = 30
+LANCZOS_STEPS = 15
+
+PROPORTIONS = ['estimate', 'exact', 'trace']
+
+# Rows of the squared distances held in memory per block
+BLOCK_ROWS = 1024
+
+
+class CenteredOperator:
+    '''
+    Products with the double-centered matrix B = -1/2 J D^2 J of a distance matrix,
+    computed from row blocks of D^2 (the matrix is read block by block, never squared in full).
+    '''
+
+    def __init__(self, distance_matrix, n_threads: int = N_THREADS, block_rows: int = BLOCK_ROWS):
+        self.distance_matrix = distance_matrix
+        self.n = distance_matrix.n
+        self.blocks = [(start, min(start + block_rows, self.n)) for start in range(0, self.n, block_rows)]
+        self.n_threads = max(1, min(n_threads or os.cpu_count(), len(self.blocks)))
+        ones = np.ones((self.n, 1))
+        self.row_means = self._d2_product(ones)[:, 0] / self.n
+        self.grand_mean = self.row_means.mean()
+
+    def _d2_block(self, start, stop, x):
+        block = self.distance_matrix.rows(start, stop)
+        return (block * block) @ x
+
+    def _d2_product(self, x: np.ndarray) -> np.ndarray:
+        result = np.empty((self.n, x.shape[1]))
+        with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+            for (start, stop), values in zip(self.blocks, executor.map(lambda block: self._d2_block(*block, x), self.blocks)):
+                result[start:stop] = values
+        return result
+
+    def trace(self) -> float:
+        '''trace(B) = N * mean(D^2) / 2, the sum of all eigenvalues.'''
+        return self.n * self.grand_mean / 2.0
+
+    def positive_eigenvalue_sum(self) -> float:
+        '''Sum of the positive eigenvalues of B (the total of the full method), from the full spectrum.'''
+        from scipy.linalg import eigvalsh
+
+        centered = np.empty((self.n, self.n))
+        for start, stop in self.blocks:
+            block = self.distance_matrix.rows(start, stop)
+            centered[start:stop] = -0.5 * (block * block - self.row_means[start:stop, None]
+                                           - self.row_means[None, :] + self.grand_mean)
+        eigvals = eigvalsh(centered, overwrite_a=True, check_finite=False)
+        return eigvals[eigvals > 0].sum()
+
+    def dot(self, x: np.ndarray) -> np.ndarray:
+        '''Returns B @ x for a block of column vectors x (N x m).'''
+        column_sums = x.sum(axis=0)[None, :]
+        centered = (self._d2_product(x)
+                    - self.row_means[:, None] * column_sums
+                    - (self.row_means @ x)[None, :]
+                    + self.grand_mean * column_sums)
+        return -0.5 * centered
+
+
+def randomized_eigh(operator: CenteredOperator, k: int, seed=None, oversampling: int = OVERSAMPLING,
+                    power_iterations: int = POWER_ITERATIONS) -> tuple:
+    '''
+    Computes the k largest eigenvalues and eigenvectors of B.
+        Parameters:
+        ----------
+        operator : CenteredOperator
+            Products with B
+        k : int
+            Number of axes
+        seed : int
+            Seed of the random start vectors (None for a random seed)
+        oversampling : int
+            Additional random vectors of the range finder
+        power_iterations : int
+            Subspace iterations (improve the accuracy for slowly decaying eigenvalues)
+        Returns:
+        -------
+        tuple
+            (eigenvalues in decreasing order, eigenvectors N x k)
+    '''
+    rng = np.random.default_rng(seed)
+    m = min(operator.n, k + oversampling)
+    basis, _ = np.linalg.qr(operator.dot(rng.standard_normal((operator.n, m))))
+    for _ in range(power_iterations):
+        basis, _ = np.linalg.qr(operator.dot(basis))
+    projected = basis.T @ operator.dot(basis)
+    eigvals, eigvecs = np.linalg.eigh((projected + projected.T) / 2.0)
+    order = np.argsort(eigvals)[::-1][:k]
+    return eigvals[order], basis @ eigvecs[:, order]
+
+
+def estimate_positive_sum(operator: CenteredOperator, eigvals: np.ndarray, eigvecs: np.ndarray, seed=None,
+                          probes: int = PROBES, steps: int = LANCZOS_STEPS) -> float:
+    '''
+    Estimates the sum of the positive eigenvalues of B without the full spectrum:
+    the known leading eigenvalues plus a stochastic Lanczos quadrature estimate
+    of trace(max(B, 0)) on the complement of their eigenvectors.
+        Parameters:
+        ----------
+        operator : CenteredOperator
+            Products with B
+        eigvals, eigvecs : np.ndarray
+            Leading eigenvalues and eigenvectors (see randomized_eigh)
+        seed : int
+            Seed of the Rademacher probe vectors
+        probes : int
+            Number of probe vectors
+        steps : int
+            Lanczos steps per probe
+        Returns:
+        -------
+        float
+            Estimated sum of the positive eigenvalues
+    '''
+    def deflate(x):
+        return x - eigvecs @ (eigvecs.T @ x)
+
+    rng = np.random.default_rng(seed)
+    probes_block = deflate(rng.choice([-1.0, 1.0], size=(operator.n, probes)))
+    norms = np.linalg.norm(probes_block, axis=0)
+    # Lanczos on all probes at once, with full reorthogonalization
+    basis = [probes_block / norms]
+    alphas, betas = [], []
+    previous, beta = np.zeros_like(basis[0]), np.zeros(probes)
+    for step in range(min(steps, operator.n - eigvecs.shape[1])):
+        current = basis[-1]
+        w = deflate(operator.dot(deflate(current))) - beta * previous
+        alpha = np.einsum('ij,ij->j', w, current)
+        stacked = np.stack(basis)
+        w -= np.einsum('kp,knp->np', np.einsum('knp,np->kp', stacked, w), stacked)
+        beta = np.linalg.norm(w, axis=0)
+        alphas.append(alpha)
+        betas.append(beta)
+        previous = current
+        basis.append(w / np.where(beta > 0, beta, 1.0))
+
+    # Gauss quadrature of max(x, 0) from the tridiagonal matrix of every probe
+    alphas, betas = np.array(alphas), np.array(betas)
+    remainder = 0.0
+    for probe in range(probes):
+        tridiagonal = (np.diag(alphas[:, probe]) + np.diag(betas[:-1, probe], 1)
+                       + np.diag(betas[:-1, probe], -1))
+        theta, vectors = np.linalg.eigh(tridiagonal)
+        remainder += norms[probe] ** 2 * (vectors[0] ** 2 * np.maximum(theta, 0.0)).sum()
+    return np.maximum(eigvals, 0.0).sum() + remainder / probes
+
+
+def pcoa(distance_matrix, k: int = DIMENSIONS, seed=None, n_threads: int = N_THREADS,
+         proportions: str = 'estimate'):
+    '''
+    Randomized top-k PCoA of a distance matrix.
+        Parameters:
+        ----------
+        distance_matrix : CondensedMatrix or DenseMatrix
+            Opened distance matrix (see distance_store.open_matrix)
+        k : int
+            Number of axes
+        seed : int
+            Seed of the random start vectors (None for a random seed)
+        n_threads : int
+            Threads for the row blocks (0 = all available cores)
+        proportions : str
+            Total the eigenvalues are divided by: 'estimate' (estimated sum of
+            the positive eigenvalues), 'exact' (computed from all eigenvalues)
+            or 'trace' (trace(B), like fsvd)
+        Returns:
+        -------
+        skbio.OrdinationResults
+            Eigenvalues, sample coordinates and proportion explained of the first k axes
+    '''
+    from skbio import OrdinationResults
+
+    k = min(k, distance_matrix.n)
+    operator = CenteredOperator(distance_matrix, n_threads)
+    eigvals, eigvecs = randomized_eigh(operator, k, seed)
+    if proportions == 'exact':
+        total = operator.positive_eigenvalue_sum()
+    elif proportions == 'estimate':
+        total = estimate_positive_sum(operator, eigvals, eigvecs, seed)
+    elif proportions == 'trace':
+        total = operator.trace()
+    else:
+        raise ValueError(f"proportions must be one of {PROPORTIONS}, not {proportions!r}")
+    # Negative eigenvalues (non-Euclidean distances) give no coordinates, like skbio
+    eigvals = np.where(eigvals < 0, 0.0, eigvals)
+    axes = [f"PC{axis + 1}" for axis in range(k)]
+    return OrdinationResults(
+        short_method_name='PCoA',
+        long_method_name='Principal Coordinate Analysis',
+        eigvals=pd.Series(eigvals, index=axes),
+        samples=pd.DataFrame(eigvecs * np.sqrt(eigvals), index=list(distance_matrix.ids), columns=axes),
+        proportion_explained=pd.Series(eigvals / total, index=axes),
+    )
+
+
+# --- EXECUTION BLOCK ---
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the first k PCoA axes with a randomized eigensolver.')
+    parser.add_argument('--distance-matrix', default=DISTANCE_MATRIX, help='DistanceMatrix .qza or compact .cdm')
+    parser.add_argument('--dimensions', type=int, default=DIMENSIONS, help='number of axes (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random start vectors (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=N_THREADS, help='threads (0 = all cores)')
+    parser.add_argument('--proportions', choices=PROPORTIONS, default='estimate',
+                        help='total of the proportion explained: estimated or exact (O(N^3)) sum of the positive '
+                             'eigenvalues like the full PCoA, or the trace like fsvd (default: %(default)s)')
+    parser.add_argument('--output', default=None, help='PCoAResults .qza (default: <metric>_pcoa_results.qza)')
+    parser.add_argument('--emperor', default=None, help='also write an Emperor plot with the metadata to this .qzv')
+    parser.add_argument('--metadata', default=METADATA)
+    args = parser.parse_args()
+
+    from qiime2 import Artifact
+
+    output_fp = args.output or args.distance_matrix.rsplit('_distance_matrix', 1)[0] + '_pcoa_results.qza'
+    print(f"Computing {args.dimensions} PCoA axes of {args.distance_matrix}...")
+    results = pcoa(open_matrix(args.distance_matrix), args.dimensions, args.seed, args.threads, args.proportions)
+    pcoa_artifact = Artifact.import_data('PCoAResults', results)
+    pcoa_artifact.save(output_fp)
+    print(f"Proportion explained ({args.proportions} total):")
+    for axis, proportion in results.proportion_explained.items():
+        print(f"  {axis}: {proportion:.2%}")
+    print(f"PCoA results saved to {output_fp}")
+
+    if args.emperor:
+        import qiime2.plugins.emperor.actions as emperor_actions
+        from artifact_cache import load_metadata
+
+        visualization, = emperor_actions.plot(pcoa=pcoa_artifact, metadata=load_metadata(args.metadata))
+        visualization.save(args.emperor)
+        print(f"Emperor plot saved to {args.emperor}")
+
+# in command line: python pcoa.py --distance-matrix core_diversity_results/core_metrics/bray_curtis_distance_matrix.qza --dimensions 10 --seed 0
@@ -0,0 +1,254 @@
+#! usr/bin/env python3
+
+#### PERMANOVA Engine
+
+#This script implements PERMANOVA (the test behind beta_group_significance)
+#with the permutations evaluated in batches. The squared distances are
+#computed once, and the within-group sums of squares of a batch of B permuted
+#groupings are computed with one of two kernels:
+#   dense:  one product of the squared distances with the stacked one-hot
+#           group matrices (BLAS, N^2 * B * G operations), fastest for few groups
+#   blocks: the samples of every permutation are sorted by group and only the
+#           distances inside the groups are summed (sum of n_k^2 / 2 per
+#           permutation, so the cost falls with the number of groups); compiled
+#           with numba and run in parallel over the permutations, without numba
+#           a sparse one-hot product (N^2 * B, independent of G) is used
+#The kernel with the lower estimated cost is chosen per test.
+#Pairwise tests use slices of the same squared distances.
+#
+#The permutations are drawn from the same random stream as scikit-bio
+#(rng.permutation of the integer grouping vector, rng = default_rng(seed)),
+#so with the same seed the p-values equal those of skbio's permanova:
+#p = (number of permuted pseudo-F >= observed pseudo-F + 1) / (permutations + 1).
+
+import argparse
+import itertools
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Additional_Scripts'))
+from distance_store import open_matrix
+
+
+# Define files and names
+DISTANCE_MATRIX = os.path.join("core_diversity_results", "core_metrics", "unweighted_unifrac_distance_matrix.qza")
+METADATA = os.path.join("../", "Data", "metadata.tsv")
+PERMUTATIONS = int(os.environ.get("PERMUTATIONS", 999))
+
+# Elements of the N x (B * groups) product evaluated at once (~128 MB as float64)
+BATCH_ELEMENTS = 1 << 24
+
+# Relative cost of one distance read by the blocks kernel (random access) and
+# one multiply-add of the dense kernel (BLAS), measured on 500-3000 samples
+BLOCK_COST = 60
+
+# Permuted statistics within this relative distance of the observed one count
+# as ties (the products sum in another order than skbio's loops)
+TIE_TOLERANCE = 1e-10
+
+
+def squared_distances(distances: np.ndarray) -> np.ndarray:
+    '''Returns the squared square-form distance matrix as float64 (computed once per matrix).'''
+    distances = np.asarray(distances, dtype=np.float64)
+    return distances * distances
+
+
+def encode_grouping(grouping) -> tuple:
+    '''Returns the sorted group labels and the grouping as integer codes (like skbio).'''
+    labels, codes = np.unique(np.asarray(grouping), return_inverse=True)
+    return labels, codes.astype(np.intp)
+
+
+def within_dense(d2: np.ndarray, codes: np.ndarray, n_groups: int, group_sizes: np.ndarray) -> np.ndarray:
+    '''Returns the within-group sums of squares of a batch of groupings (B x N codes) from the one-hot product.'''
+    n_batch, n_samples = codes.shape
+    # Column b * n_groups + k of the one-hot matrix selects the samples of group k in grouping b
+    one_hot = np.zeros((n_samples, n_batch * n_groups))
+    columns = codes + (np.arange(n_batch) * n_groups)[:, None]
+    one_hot[np.arange(n_samples)[None, :], columns] = 1.0
+
+    within = (one_hot * (d2 @ one_hot)).sum(axis=0).reshape(n_batch, n_groups)
+    return (within / (2.0 * group_sizes)).sum(axis=1)
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _block_sums(d2, orders, offsets, weights):
+        # orders: samples of every permutation sorted by group, group k at offsets[k]:offsets[k + 1]
+        sums = np.zeros(orders.shape[0])
+        for b in prange(orders.shape[0]):
+            total = 0.0
+            for k in range(len(offsets) - 1):
+                part = 0.0
+                for x in range(offsets[k], offsets[k + 1]):
+                    row = d2[orders[b, x]]
+                    for y in range(x + 1, offsets[k + 1]):
+                        part += row[orders[b, y]]
+                total += part * weights[k]
+            sums[b] = total
+        return sums
+
+
+def within_blocks(d2: np.ndarray, codes: np.ndarray, n_groups: int, group_sizes: np.ndarray) -> np.ndarray:
+    '''Returns the within-group sums of squares of a batch of groupings from the distances inside the groups only.'''
+    n_batch, n_samples = codes.shape
+    if njit is not None:
+        # A permutation keeps the group sizes, so every group has the same slots in all sorted orders
+        orders = np.argsort(codes, axis=1, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(group_sizes.astype(np.int64))])
+        return _block_sums(d2, orders, offsets, 1.0 / group_sizes)
+
+    # Sparse one-hot (B * G x N, N * B entries): one pass over d2 per permutation
+    rows = (codes + (np.arange(n_batch) * n_groups)[:, None]).ravel()
+    columns = np.tile(np.arange(n_samples), n_batch)
+    one_hot = sp.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(n_batch * n_groups, n_samples))
+    group_rows = np.asarray(one_hot @ d2)
+    within = np.bincount(rows, weights=group_rows[rows, columns], minlength=n_batch * n_groups)
+    return (within.reshape(n_batch, n_groups) / (2.0 * group_sizes)).sum(axis=1)
+
+
+def choose_kernel(n_samples: int, group_sizes: np.ndarray):
+    '''Returns the within-group kernel with the lower estimated cost per permutation.'''
+    dense_cost = n_samples * n_samples * len(group_sizes)
+    block_cost = BLOCK_COST * (group_sizes * group_sizes).sum() / 2 if njit is not None else 8 * n_samples * n_samples
+    return within_blocks if block_cost < dense_cost else within_dense
+
+
+def pseudo_f(d2: np.ndarray, codes: np.ndarray, n_groups: int, group_sizes: np.ndarray, s_total: float,
+             kernel=within_dense) -> np.ndarray:
+    '''
+    Computes the pseudo-F statistic of a batch of groupings.
+        Parameters:
+        ----------
+        d2 : np.ndarray
+            Squared distances (N x N)
+        codes : np.ndarray
+            Groupings as integer codes (B x N)
+        n_groups : int
+            Number of groups
+        group_sizes : np.ndarray
+            Samples per group (identical for all permutations)
+        s_total : float
+            Total sum of squares
+        kernel : function
+            Computes the within-group sums of squares (within_dense or within_blocks)
+        Returns:
+        -------
+        np.ndarray
+            Pseudo-F of every grouping (B)
+    '''
+    n_samples = codes.shape[1]
+    s_within = kernel(d2, codes, n_groups, group_sizes)
+    s_among = s_total - s_within
+    return (s_among / (n_groups - 1)) / (s_within / (n_samples - n_groups))
+
+
+def permanova(d2: np.ndarray, grouping, permutations: int = PERMUTATIONS, seed=None,
+              batch_size: int = None) -> pd.Series:
+    '''
+    Runs PERMANOVA on precomputed squared distances.
+        Parameters:
+        ----------
+        d2 : np.ndarray
+            Squared distances (N x N), see squared_distances
+        grouping : array-like
+            Group label of every sample (in the order of d2)
+        permutations : int
+            Number of permutations
+        seed : int or np.random.Generator
+            Seed of the permutations (None for a random seed)
+        batch_size : int
+            Permutations per batch (default: from BATCH_ELEMENTS)
+        Returns:
+        -------
+        pd.Series
+            Results with the same fields as skbio.stats.distance.permanova
+    '''
+    labels, codes = encode_grouping(grouping)
+    n_samples, n_groups = len(codes), len(labels)
+    if n_groups < 2 or n_groups == n_samples:
+        raise ValueError("PERMANOVA needs at least two groups and at least one group with more than one sample")
+    group_sizes = np.bincount(codes, minlength=n_groups).astype(np.float64)
+    s_total = d2.sum() / (2.0 * n_samples)
+
+    statistic = pseudo_f(d2, codes[None, :], n_groups, group_sizes, s_total)[0]
+    p_value = np.nan
+    if permutations > 0:
+        rng = seed if isinstance(seed, np.random.Generator) else np.random.default_rng(seed)
+        kernel = choose_kernel(n_samples, group_sizes)
+        batch_size = batch_size or max(1, BATCH_ELEMENTS // (n_samples * n_groups))
+        n_greater = 0
+        threshold = statistic - TIE_TOLERANCE * abs(statistic)
+        for start in range(0, permutations, batch_size):
+            # Row-wise permuted() draws the same stream as consecutive rng.permutation calls
+            batch = rng.permuted(np.broadcast_to(codes, (min(batch_size, permutations - start), n_samples)), axis=1)
+            n_greater += int((pseudo_f(d2, batch, n_groups, group_sizes, s_total, kernel) >= threshold).sum())
+        p_value = (n_greater + 1) / (permutations + 1)
+
+    return pd.Series(['PERMANOVA', 'pseudo-F', n_samples, n_groups, statistic, p_value, permutations],
+                     index=['method name', 'test statistic name', 'sample size', 'number of groups',
+                            'test statistic', 'p-value', 'number of permutations'],
+                     name='PERMANOVA results')
+
+
+def pairwise_permanova(d2: np.ndarray, grouping, permutations: int = PERMUTATIONS, seed=None) -> list:
+    '''
+    Runs PERMANOVA for every pair of groups on slices of the squared distances.
+        Parameters:
+        ----------
+        d2 : np.ndarray
+            Squared distances (N x N)
+        grouping : array-like
+            Group label of every sample
+        permutations : int
+            Number of permutations per pair
+        seed : int
+            Seed of the permutations, every pair starts from the same seed
+            like separate skbio calls would
+        Returns:
+        -------
+        list
+            (group1, group2, results) per pair
+    '''
+    grouping = np.asarray(grouping)
+    results = []
+    for group1, group2 in itertools.combinations(np.unique(grouping), 2):
+        index = np.flatnonzero((grouping == group1) | (grouping == group2))
+        results.append((group1, group2, permanova(d2[np.ix_(index, index)], grouping[index], permutations, seed)))
+    return results
+
+
+# --- EXECUTION BLOCK ---
+if __name__ == '__main__':
+    from artifact_cache import load_metadata
+
+    parser = argparse.ArgumentParser(description='PERMANOVA of a distance matrix against a metadata column.')
+    parser.add_argument('--distance-matrix', default=DISTANCE_MATRIX, help='DistanceMatrix .qza or compact .cdm')
+    parser.add_argument('--metadata', default=METADATA)
+    parser.add_argument('--column', default='disease_state')
+    parser.add_argument('--permutations', type=int, default=PERMUTATIONS)
+    parser.add_argument('--seed', type=int, default=None, help='seed of the permutations (default: random)')
+    parser.add_argument('--pairwise', action='store_true', help='also test every pair of groups')
+    args = parser.parse_args()
+
+    distance_matrix = open_matrix(args.distance_matrix)
+    grouping = load_metadata(args.metadata).get_column(args.column).to_series().dropna()
+    index = [position for position, sample_id in enumerate(distance_matrix.ids) if sample_id in grouping.index]
+    d2 = squared_distances(distance_matrix.submatrix(index))
+    grouping = grouping.reindex([distance_matrix.ids[position] for position in index]).to_numpy()
+
+    print(permanova(d2, grouping, args.permutations, args.seed).to_string())
+    if args.pairwise:
+        for group1, group2, result in pairwise_permanova(d2, grouping, args.permutations, args.seed):
+            print(f"{group1} vs {group2}: pseudo-F = {result['test statistic']:.4f}, p = {result['p-value']:.4f}")
+
+# in command line: python permanova.py --column Horse --pairwise --seed 42
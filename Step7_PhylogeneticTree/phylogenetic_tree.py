@@ -9,50 +9,64 @@ import qiime2.plugins.phylogeny.actions as phylogeny_actions
 import os
 
 
-##### ASV Phylogenetic Tree Construction
-# Define file paths
-rep_seqs_path = os.path.join("../", "Step6_Decontamination", "filtered-rep-seqs.qza")
-if not os.path.exists(rep_seqs_path):
-    raise FileNotFoundError(f"Please check again the path to the representative sequences: {rep_seqs_path}")
-
-
-
-# Run phylogenetic tree construction
-try:
-    print("Constructing phylogenetic tree for ASV representative sequences...")
-    rep_seqs = Artifact.load(rep_seqs_path)
-    asv_aligned_rep_seqs, asv_masked_aligned_rep_seqs, asv_unrooted_tree, asv_rooted_tree = phylogeny_actions.align_to_tree_mafft_fasttree(
-        sequences=rep_seqs,
-    )
-except Exception as e:
-    print(f"An error occurred during phylogenetic tree construction: {e}")
+# Branches to build trees for ("asv", "otu" or both), the pipeline runner builds them in parallel
+TREE_BRANCHES = os.environ.get("TREE_BRANCHES", "asv").split(",")
 
-#Saving the rooted tree
-print("Saving asv_rooted_tree.qza...")
-asv_rooted_tree.save(os.path.join( "asv_rooted_tree.qza"))
+# Threads for MAFFT/FastTree (0 = all available cores)
+N_THREADS = int(os.environ.get("N_THREADS", 0))
+MAFFT_THREADS = N_THREADS if N_THREADS > 0 else "auto"
 
-print("Constructing phylogenetic tree finished")
 
+##### ASV Phylogenetic Tree Construction
+if "asv" in TREE_BRANCHES:
+    # Define file paths
+    rep_seqs_path = os.path.join("../", "Step6_Decontamination", "filtered-rep-seqs.qza")
+    if not os.path.exists(rep_seqs_path):
+        raise FileNotFoundError(f"Please check again the path to the representative sequences: {rep_seqs_path}")
 
 
-##### OTU phylogenetic Tree Construction
-# Define file paths
-# rep_seqs_path = os.path.join("../", "Step6_Decontamination", "otu_rep_seqs-decontam.qza")
-# if not os.path.exists(rep_seqs_path):
-#     raise FileNotFoundError(f"Please check again the path to the representative sequences: {rep_seqs_path}")
 
+    # Run phylogenetic tree construction
+    try:
+        print("Constructing phylogenetic tree for ASV representative sequences...")
+        rep_seqs = Artifact.load(rep_seqs_path)
+        asv_aligned_rep_seqs, asv_masked_aligned_rep_seqs, asv_unrooted_tree, asv_rooted_tree = phylogeny_actions.align_to_tree_mafft_fasttree(
+            sequences=rep_seqs,
+            n_threads=MAFFT_THREADS,
+        )
+    except Exception as e:
+        print(f"An error occurred during phylogenetic tree construction: {e}")
 
+    #Saving the rooted tree
+    print("Saving asv_rooted_tree.qza...")
+    asv_rooted_tree.save(os.path.join( "asv_rooted_tree.qza"))
 
-# # Run phylogenetic tree construction
-# try:
-#     print("Constructing phylogenetic tree for OTU representative sequences...")
-#     rep_seqs = Artifact.load(rep_seqs_path)
-#     otu_aligned_rep_seqs, otu_masked_aligned_rep_seqs, otu_unrooted_tree, otu_rooted_tree = phylogeny_actions.align_to_tree_mafft_fasttree(
-#         sequences=rep_seqs,
-#     )
-# except Exception as e:
-#     print(f"An error occurred during phylogenetic tree construction: {e}")
+    print("Constructing phylogenetic tree finished")
 
 
 
-# print("Constructing phylogenetic tree finished")
\ No newline at end of file
+##### OTU phylogenetic Tree Construction
+if "otu" in TREE_BRANCHES:
+    # Define file paths
+    rep_seqs_path = os.path.join("../", "Step6_Decontamination", "otu_rep_seqs-decontam.qza")
+    if not os.path.exists(rep_seqs_path):
+        raise FileNotFoundError(f"Please check again the path to the representative sequences: {rep_seqs_path}")
+
+
+
+    # Run phylogenetic tree construction
+    try:
+        print("Constructing phylogenetic tree for OTU representative sequences...")
+        rep_seqs = Artifact.load(rep_seqs_path)
+        otu_aligned_rep_seqs, otu_masked_aligned_rep_seqs, otu_unrooted_tree, otu_rooted_tree = phylogeny_actions.align_to_tree_mafft_fasttree(
+            sequences=rep_seqs,
+            n_threads=MAFFT_THREADS,
+        )
+    except Exception as e:
+        print(f"An error occurred during phylogenetic tree construction: {e}")
+
+    #Saving the rooted tree
+    print("Saving otu_rooted_tree.qza...")
+    otu_rooted_tree.save(os.path.join( "otu_rooted_tree.qza"))
+
+    print("Constructing phylogenetic tree finished")
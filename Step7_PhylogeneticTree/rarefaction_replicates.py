@@ -0,0 +1,259 @@
+#! usr/bin/env python3
+
+#### Multi-Replicate Rarefaction Script
+
+#This script repeats the rarefaction of core_metrics R times and reports the
+#mean and the dispersion of every alpha and beta diversity metric, so the
+#results no longer depend on a single random subsample.
+#Every replicate subsamples all samples at once: drawing `depth` reads
+#without replacement from a sample is a multivariate hypergeometric draw,
+#which is sampled as a chain of univariate hypergeometric draws over the
+#non-zero features of the sparse table (feature k gets
+#Hypergeometric(count_k, reads left - count_k, draws left)). Step k of the
+#chain is one vectorized draw for the k-th feature of all samples.
+#The replicates run in a process pool; a worker rarefies one replicate,
+#computes its metrics (beta_engine.py) and returns only the results, so each
+#worker holds one rarefied matrix at a time. The main process folds the
+#results into running means and variances (Welford) in replicate order.
+#Replicate r uses the seed SeedSequence([seed, r]), so the results do not
+#depend on the number of workers.
+
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy.spatial.distance import squareform
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Additional_Scripts'))
+from distance_store import write_condensed
+from qza_io import read_table
+from sampling_depth import depth_param
+from beta_engine import METRICS, beta_diversity, branch_counts, read_tree, save_distance_matrices, tree_layout
+
+
+# Define files and names
+TABLE = os.path.join("../", "Step6_Decontamination", "filtered-table.qza")
+PHYLOGENY_TREE = "asv_rooted_tree.qza"
+SAMPLING_DEPTH = depth_param("SAMPLING_DEPTH", 9000)
+REPLICATES = int(os.environ.get("RAREFACTION_REPLICATES", 10))
+N_THREADS = int(os.environ.get("N_THREADS", 0)) # 0 = all available cores
+OUTPUT_DIR = os.path.join("core_diversity_results", "rarefaction_replicates")
+
+ALPHA_METRICS = ['observed_features', 'shannon', 'evenness', 'faith_pd']
+
+# Loaded data of the worker processes (set once per worker by _init_worker)
+_matrix = None
+_layout = None
+_options = {}
+
+
+def rarefy(matrix: sp.csc_matrix, depth: int, rng: np.random.Generator) -> sp.csc_matrix:
+    '''
+    Subsamples every sample (column) to the same depth without replacement.
+        Parameters:
+        ----------
+        matrix : scipy.sparse.csc_matrix
+            Feature x sample counts, all samples with at least `depth` reads
+        depth : int
+            Reads per sample after rarefaction
+        rng : np.random.Generator
+            Random generator of the replicate
+        Returns:
+        -------
+        scipy.sparse.csc_matrix
+            Rarefied counts (same sparsity structure, features that were not drawn are removed)
+    '''
+    counts = matrix.data.astype(np.int64)
+    lengths = np.diff(matrix.indptr)
+    # Samples sorted by their number of features: the samples still active at step k are a prefix
+    order = np.argsort(-lengths, kind='stable')
+    starts = matrix.indptr[:-1][order]
+    sorted_lengths = lengths[order]
+    reads_left = np.asarray(matrix.sum(axis=0)).ravel()[order].astype(np.int64)
+    draws_left = np.full(len(order), depth, dtype=np.int64)
+    rarefied = np.zeros_like(counts)
+    for k in range(int(sorted_lengths[0]) if len(order) else 0):
+        active = int(np.searchsorted(-sorted_lengths, -k, side='left'))
+        positions = starts[:active] + k
+        good = counts[positions]
+        drawn = rng.hypergeometric(good, reads_left[:active] - good, draws_left[:active])
+        rarefied[positions] = drawn
+        reads_left[:active] -= good
+        draws_left[:active] -= drawn
+    result = sp.csc_matrix((rarefied, matrix.indices.copy(), matrix.indptr.copy()), shape=matrix.shape)
+    result.eliminate_zeros()
+    return result
+
+
+def alpha_diversity(matrix: sp.csc_matrix, layout: tuple, metrics: list = ALPHA_METRICS) -> dict:
+    '''Computes the alpha diversity metrics of core_metrics (Shannon in bits, Pielou evenness) per sample.'''
+    results = {}
+    counts = matrix.tocsc()
+    observed = np.diff(counts.indptr).astype(np.float64)
+    if 'observed_features' in metrics:
+        results['observed_features'] = observed
+    if 'shannon' in metrics or 'evenness' in metrics:
+        totals = np.asarray(counts.sum(axis=0)).ravel()
+        proportions = counts.data / np.repeat(totals, np.diff(counts.indptr))
+        entropy = -np.add.reduceat(proportions * np.log(proportions), counts.indptr[:-1]) \
+            if counts.nnz else np.zeros(counts.shape[1])
+        entropy[np.diff(counts.indptr) == 0] = 0.0
+        if 'shannon' in metrics:
+            results['shannon'] = entropy / np.log(2)
+        if 'evenness' in metrics:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                results['evenness'] = np.where(observed > 1, entropy / np.log(observed), np.nan)
+    if 'faith_pd' in metrics:
+        results['faith_pd'] = (branch_counts(counts, layout) > 0).T.astype(np.float64) @ layout[1]
+    return {metric: results[metric] for metric in metrics}
+
+
+class RunningStats:
+    '''Running mean and variance of equally shaped arrays (Welford's algorithm).'''
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self._m2 = None
+
+    def update(self, values: np.ndarray) -> None:
+        values = np.asarray(values, dtype=np.float64)
+        self.count += 1
+        if self.mean is None:
+            self.mean = values.copy()
+            self._m2 = np.zeros_like(values)
+            return
+        delta = values - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (values - self.mean)
+
+    @property
+    def variance(self) -> np.ndarray:
+        return self._m2 / (self.count - 1) if self.count > 1 else np.zeros_like(self.mean)
+
+    @property
+    def std(self) -> np.ndarray:
+        return np.sqrt(self.variance)
+
+
+def _init_worker(matrix: sp.csc_matrix, layout: tuple, options: dict) -> None:
+    global _matrix, _layout, _options
+    _matrix, _layout, _options = matrix, layout, options
+
+
+def replicate(index: int) -> tuple:
+    '''Rarefies replicate `index` and returns its alpha vectors and condensed distance matrices.'''
+    rng = np.random.default_rng(np.random.SeedSequence([_options['seed'], index]))
+    rarefied = rarefy(_matrix, _options['depth'], rng)
+    alpha = alpha_diversity(rarefied, _layout, _options['alpha_metrics'])
+    beta = beta_diversity(rarefied, _layout, _options['metrics'], n_threads=1)
+    return alpha, {metric: squareform(distances, checks=False) for metric, distances in beta.items()}
+
+
+def run_replicates(matrix: sp.spmatrix, layout: tuple, depth: int = SAMPLING_DEPTH, replicates: int = REPLICATES,
+                   metrics: list = METRICS, alpha_metrics: list = ALPHA_METRICS, seed: int = 0,
+                   n_workers: int = N_THREADS) -> tuple:
+    '''
+    Rarefies the table `replicates` times and accumulates the diversity metrics.
+        Parameters:
+        ----------
+        matrix : scipy.sparse matrix
+            Feature x sample counts of the samples with at least `depth` reads
+        layout : tuple
+            Tree layout of the table features (see beta_engine.tree_layout)
+        depth : int
+            Sampling depth
+        replicates : int
+            Number of rarefied replicates
+        metrics : list
+            Beta diversity metrics (see beta_engine.METRICS)
+        alpha_metrics : list
+            Alpha diversity metrics (see ALPHA_METRICS)
+        seed : int
+            Seed of the replicates
+        n_workers : int
+            Worker processes (0 = all available cores)
+        Returns:
+        -------
+        tuple
+            (RunningStats per alpha metric, RunningStats of the condensed distances per beta metric)
+    '''
+    options = {'depth': depth, 'seed': seed, 'metrics': metrics, 'alpha_metrics': alpha_metrics}
+    alpha_stats = {metric: RunningStats() for metric in alpha_metrics}
+    beta_stats = {metric: RunningStats() for metric in metrics}
+    n_workers = max(1, min(n_workers or os.cpu_count(), replicates))
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                             initargs=(sp.csc_matrix(matrix), layout, options)) as executor:
+        # map() yields in replicate order, so the running statistics are reproducible
+        for number, (alpha, beta) in enumerate(executor.map(replicate, range(replicates)), start=1):
+            for metric, values in alpha.items():
+                alpha_stats[metric].update(values)
+            for metric, values in beta.items():
+                beta_stats[metric].update(values)
+            print(f"  replicate {number}/{replicates} done")
+    return alpha_stats, beta_stats
+
+
+def save_results(alpha_stats: dict, beta_stats: dict, sample_ids, output_dir: str, compact: bool = False) -> list:
+    '''
+    Writes the alpha means and standard deviations to alpha_replicates.tsv, the mean
+    distance matrices as <metric>_distance_matrix.qza (.cdm with compact) and their
+    standard deviations as <metric>_distance_std.cdm.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    alpha = pd.DataFrame(index=pd.Index(sample_ids, name='sample-id'))
+    for metric, stats in alpha_stats.items():
+        alpha[f"{metric}_mean"] = stats.mean
+        alpha[f"{metric}_std"] = stats.std
+    alpha_fp = os.path.join(output_dir, "alpha_replicates.tsv")
+    alpha.to_csv(alpha_fp, sep='\t')
+    saved = [alpha_fp]
+
+    means = {metric: squareform(stats.mean, checks=False) for metric, stats in beta_stats.items()}
+    if compact:
+        saved += [write_condensed(os.path.join(output_dir, f"{metric}_distance_matrix.cdm"), distances, sample_ids)
+                  for metric, distances in means.items()]
+    else:
+        saved += save_distance_matrices(means, sample_ids, output_dir)
+    saved += [write_condensed(os.path.join(output_dir, f"{metric}_distance_std.cdm"), stats.std, sample_ids)
+              for metric, stats in beta_stats.items()]
+    return saved
+
+
+# --- EXECUTION BLOCK ---
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Average the diversity metrics over repeated rarefactions.')
+    parser.add_argument('--table', default=TABLE, help='feature table before rarefaction (default: %(default)s)')
+    parser.add_argument('--tree', default=PHYLOGENY_TREE)
+    parser.add_argument('--depth', type=int, default=SAMPLING_DEPTH, help='sampling depth (default: %(default)s)')
+    parser.add_argument('--replicates', type=int, default=REPLICATES, help='rarefied replicates (default: %(default)s)')
+    parser.add_argument('--metrics', nargs='+', default=METRICS, choices=METRICS)
+    parser.add_argument('--alpha-metrics', nargs='+', default=ALPHA_METRICS, choices=ALPHA_METRICS)
+    parser.add_argument('--seed', type=int, default=0, help='seed of the replicates (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=N_THREADS, help='worker processes (0 = all cores)')
+    parser.add_argument('--output-dir', default=OUTPUT_DIR)
+    parser.add_argument('--compact', action='store_true', help='write the mean distance matrices as .cdm instead of .qza')
+    args = parser.parse_args()
+
+    print(f"Loading {args.table} and {args.tree}...")
+    matrix, feature_ids, sample_ids = read_table(args.table)
+    totals = np.asarray(matrix.sum(axis=0)).ravel()
+    kept = np.flatnonzero(totals >= args.depth)
+    if len(kept) < len(sample_ids):
+        print(f"{len(sample_ids) - len(kept)} samples have fewer than {args.depth} reads and are dropped")
+    matrix, sample_ids = matrix[:, kept], sample_ids[kept]
+    layout = tree_layout(read_tree(args.tree), feature_ids)
+
+    print(f"Rarefying {len(sample_ids)} samples to {args.depth} reads, {args.replicates} replicates...")
+    alpha_stats, beta_stats = run_replicates(matrix, layout, args.depth, args.replicates, args.metrics,
+                                             args.alpha_metrics, args.seed, args.workers)
+    for metric, stats in {**alpha_stats, **beta_stats}.items():
+        print(f"  {metric}: mean {np.nanmean(stats.mean):.4f}, mean std over replicates {np.nanmean(stats.std):.4f}")
+    for output_fp in save_results(alpha_stats, beta_stats, list(sample_ids), args.output_dir, args.compact):
+        print(f"Saved {output_fp}")
+
+# in command line: python rarefaction_replicates.py --depth 9000 --replicates 20 --seed 42
@@ -0,0 +1,163 @@
+#! usr/bin/env python3
+
+#### Sampling Depth Explorer
+
+#This script chooses the rarefaction depth of the diversity analysis from the
+#filtered table instead of reading it off the table summary by hand. The
+#sample totals are sorted once; for every candidate depth (every distinct
+#sample total, the depths at which the retained samples change) the retained
+#samples and reads follow from a binary search in the sorted totals, and the
+#samples lost per metadata group from cumulative group counts along the same
+#order. The report lists, per depth, the retained samples and reads and the
+#groups of disease_state, Horse and Type that lose samples.
+#
+#The chosen depth is the largest depth that keeps at least
+#MIN_SAMPLE_FRACTION of the samples and at least MIN_GROUP_SAMPLES samples of
+#every group (all samples of smaller groups). It is written to
+#sampling_depth.json together with the median sample total (the maximal
+#depth of the alpha rarefaction curves); Step7 and Step8 use these values
+#when SAMPLING_DEPTH / MAX_DEPTH are set to "auto" (the file must belong to
+#the current filtered table). Without "auto" the fixed depths are kept.
+
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Additional_Scripts'))
+from pipeline_cache import input_fingerprint
+from qza_io import read_table
+
+
+# Define files and names
+TABLE = os.path.join("../", "Step6_Decontamination", "filtered-table.qza")
+METADATA = os.path.join("../", "Data", "metadata.tsv")
+DEPTH_FP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sampling_depth.json")
+REPORT_FP = "sampling_depth_report.tsv"
+
+GROUP_COLUMNS = ['disease_state', 'Horse', 'Type']
+
+# Retention policy (can be overridden by the pipeline runner through environment variables)
+MIN_SAMPLE_FRACTION = float(os.environ.get("MIN_SAMPLE_FRACTION", 0.75)) # exclude at most 25% of the samples
+MIN_GROUP_SAMPLES = int(os.environ.get("MIN_GROUP_SAMPLES", 2))
+
+
+def depth_param(name: str, default: int, key: str = 'sampling_depth', table_fp: str = None) -> int:
+    '''
+    Reads a depth parameter from the environment (the default if it is not set).
+    "auto" takes the value chosen by this script from sampling_depth.json; the
+    file must have been written for the current filtered table.
+    '''
+    value = os.environ.get(name, str(default))
+    if value != 'auto':
+        return int(value)
+    table_fp = table_fp or os.path.join(os.path.dirname(os.path.abspath(__file__)), TABLE)
+    try:
+        with open(DEPTH_FP) as fh:
+            chosen = json.load(fh)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"{name}=auto needs {DEPTH_FP}, run sampling_depth.py first")
+    if chosen.get('table') != input_fingerprint(table_fp):
+        raise ValueError(f"{DEPTH_FP} was written for another table than {table_fp}, run sampling_depth.py again")
+    return int(chosen[key])
+
+
+def explore_depths(totals: np.ndarray, groups: pd.DataFrame, depths: np.ndarray = None) -> tuple:
+    '''
+    Computes the retention of every candidate depth.
+        Parameters:
+        ----------
+        totals : np.ndarray
+            Reads per sample
+        groups : pd.DataFrame
+            Group labels per sample (rows in the order of totals, one column per metadata column)
+        depths : np.ndarray
+            Candidate depths (default: every distinct sample total)
+        Returns:
+        -------
+        tuple
+            (report with one row per depth, samples lost per group: {column: depths x groups DataFrame})
+    '''
+    order = np.argsort(totals, kind='stable')
+    sorted_totals = totals[order]
+    depths = np.unique(sorted_totals) if depths is None else np.asarray(sorted(depths), dtype=np.int64)
+    dropped = np.searchsorted(sorted_totals, depths, side='left')
+    retained = len(totals) - dropped
+    report = pd.DataFrame({'depth': depths,
+                           'samples_retained': retained,
+                           'samples_fraction': retained / len(totals),
+                           'reads_retained': retained * depths,
+                           'reads_fraction': retained * depths / totals.sum()})
+
+    lost = {}
+    for column in groups.columns:
+        labels = groups[column].to_numpy()[order]
+        present = pd.notna(labels)
+        names, codes = np.unique(labels[present].astype(str), return_inverse=True)
+        one_hot = np.zeros((len(totals) + 1, len(names)), dtype=np.int64)
+        one_hot[1:][np.flatnonzero(present), codes] = 1
+        lost[column] = pd.DataFrame(np.cumsum(one_hot, axis=0)[dropped], index=depths, columns=names)
+        sizes = one_hot.sum(axis=0)
+        report[f"lost_{column}"] = [';'.join(f"{name}:{count}/{size}" for name, count, size in zip(names, row, sizes)
+                                             if count) for row in lost[column].to_numpy()]
+    return report, lost
+
+
+def choose_depth(report: pd.DataFrame, lost: dict, groups: pd.DataFrame,
+                 min_sample_fraction: float = MIN_SAMPLE_FRACTION, min_group_samples: int = MIN_GROUP_SAMPLES) -> int:
+    '''Returns the largest depth that meets the retention policy (the smallest candidate if none does).'''
+    allowed = report['samples_fraction'].to_numpy() >= min_sample_fraction
+    for column, lost_counts in lost.items():
+        sizes = groups[column].dropna().astype(str).value_counts().reindex(lost_counts.columns).to_numpy()
+        kept = sizes - lost_counts.to_numpy()
+        allowed &= (kept >= np.minimum(min_group_samples, sizes)).all(axis=1)
+    candidates = report['depth'].to_numpy()[allowed]
+    return int(candidates.max()) if len(candidates) else int(report['depth'].min())
+
+
+# --- EXECUTION BLOCK ---
+if __name__ == '__main__':
+    from artifact_cache import load_metadata
+
+    parser = argparse.ArgumentParser(description='Report the retention of candidate sampling depths and choose one.')
+    parser.add_argument('--table', default=TABLE)
+    parser.add_argument('--metadata', default=METADATA)
+    parser.add_argument('--columns', nargs='+', default=GROUP_COLUMNS, help='metadata groups (default: %(default)s)')
+    parser.add_argument('--depths', nargs='+', type=int, default=None,
+                        help='candidate depths (default: every distinct sample total)')
+    parser.add_argument('--min-sample-fraction', type=float, default=MIN_SAMPLE_FRACTION)
+    parser.add_argument('--min-group-samples', type=int, default=MIN_GROUP_SAMPLES)
+    parser.add_argument('--report', default=REPORT_FP)
+    parser.add_argument('--output', default=DEPTH_FP, help='chosen depth (JSON)')
+    args = parser.parse_args()
+
+    matrix, _, sample_ids = read_table(args.table)
+    totals = np.asarray(matrix.sum(axis=0)).ravel().astype(np.int64)
+    metadata = load_metadata(args.metadata).to_dataframe()
+    groups = metadata.reindex(list(sample_ids))[args.columns]
+
+    report, lost = explore_depths(totals, groups, args.depths)
+    report.to_csv(args.report, sep='\t', index=False, float_format='%.4f')
+    depth = choose_depth(report, lost, groups, args.min_sample_fraction, args.min_group_samples)
+    chosen = report[report['depth'] == depth].iloc[0]
+
+    result = {'sampling_depth': depth,
+              'max_depth': int(np.median(totals)),
+              'samples_retained': int(chosen['samples_retained']),
+              'n_samples': len(totals),
+              'reads_fraction': round(float(chosen['reads_fraction']), 4),
+              'policy': {'min_sample_fraction': args.min_sample_fraction,
+                         'min_group_samples': args.min_group_samples,
+                         'columns': args.columns},
+              'table': input_fingerprint(args.table)}
+    with open(args.output, 'w') as of:
+        json.dump(result, of, indent=2)
+
+    print(report.to_string(index=False))
+    print(f"Chosen sampling depth: {depth} ({result['samples_retained']}/{len(totals)} samples, "
+          f"{result['reads_fraction']:.1%} of the reads), saved to {args.output}")
+
+# in command line: python sampling_depth.py --min-sample-fraction 0.75 --min-group-samples 2
@@ -1,20 +1,34 @@
 #### Alpha Rarefactioning Script
 
 #Libraries
-from qiime2 import Artifact
 import qiime2.plugins.diversity.actions as diversity_actions
-from qiime2 import Metadata
 import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Additional_Scripts'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Step7_PhylogeneticTree'))
+from artifact_cache import load_artifact, load_metadata
+from rarefaction_curves import METRICS, PHYLOGENETIC_METRICS, precomputed_rarefaction_data, rarefaction_data
+from sampling_depth import depth_param
 
 # paths and names
 TABLE = os.path.join("../", "Step6_Decontamination", "filtered-table.qza")
 TREE = os.path.join("../", "Step7_PhylogeneticTree", "asv_rooted_tree.qza")
-METADATA = os.path.join("../", "Data", "metadata_for_q.csv")
+METADATA = os.path.join("../", "Data", "metadata.tsv")
 
 OUTPUT_VIZ_FILE = "asv_alpha_rarefaction.qzv"
+MAX_DEPTH = depth_param("MAX_DEPTH", 13000, key='max_depth') #choosing value close to median (recommended in tutorial), "auto": median from sampling_depth.py
+MIN_DEPTH = int(os.environ.get("MIN_DEPTH", 1))
+STEPS = int(os.environ.get("STEPS", 10))
+ITERATIONS = int(os.environ.get("ITERATIONS", 10))
+SEED = int(os.environ.get("RAREFACTION_SEED", 0))
+N_THREADS = int(os.environ.get("N_THREADS", 0)) # 0 = all available cores
+
 # Execution of Alpha Rarefactioning
 # Creation of function between alpha diversity and sampling depth
-# using the qimme diversity alpha-rarefaction visualizer
+# The points of the curves (depth x iteration) are computed in parallel and cached
+# per depth (rarefaction_curves.py), the visualization is created by the
+# qiime diversity alpha-rarefaction visualizer from these points
 
 
 print("============================================== ")
@@ -26,27 +40,44 @@ for file in files:
     if not os.path.exists(file):
         raise FileNotFoundError(f"Required file not found: {file}")
 
+metrics = METRICS + PHYLOGENETIC_METRICS
+
+#Computing the rarefaction curves (only the points missing in the cache)
+try:
+    print(f"Computing rarefaction curves up to depth {MAX_DEPTH} ({STEPS} steps, {ITERATIONS} iterations)...")
+    curves = rarefaction_data(TABLE, TREE, MAX_DEPTH, MIN_DEPTH, STEPS, ITERATIONS, metrics, SEED, N_THREADS)
+except Exception as e:
+    print(f"An error occurred while computing the rarefaction curves: {e}")
+    exit(1)
 
 #Loading artifacts
-try:    
+try:
     print("Loading input artifacts...")
-    table_artifact = Artifact.load(TABLE)
-    tree_artifact = Artifact.load(TREE)
-    metadata_obj = Metadata.load(METADATA)
+    table_artifact = load_artifact(TABLE)
+    tree_artifact = load_artifact(TREE)
+    metadata_obj = load_metadata(METADATA)
     print("Artifacts loaded successfully.")
 except Exception as e:
     print(f"An error occurred while loading artifacts: {e}")
     exit(1)
 
 try:
-    alpha_rarefaction_viz, = diversity_actions.alpha_rarefaction(
-    table=table_artifact,
-    phylogeny=tree_artifact,
-    max_depth=13000, #choosing value close to median (recommended in tutorial)
-    metadata=metadata_obj,
-)
+    with precomputed_rarefaction_data(curves) as precomputed:
+        if not precomputed:
+            print("The installed q2-diversity cannot take precomputed curves, the action rarefies the table itself.")
+        alpha_rarefaction_viz, = diversity_actions.alpha_rarefaction(
+            table=table_artifact,
+            phylogeny=tree_artifact,
+            max_depth=MAX_DEPTH,
+            min_depth=MIN_DEPTH,
+            steps=STEPS,
+            iterations=ITERATIONS,
+            metrics=set(metrics),
+            metadata=metadata_obj,
+        )
 except Exception as e:
     print(f"An error occurred during alpha rarefactioning: {e}")
+    exit(1)
 
 print("Alpha rarefactioning completed successfully.")
 
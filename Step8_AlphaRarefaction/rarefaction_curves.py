@@ -0,0 +1,218 @@
+#### Rarefaction Curve Engine
+
+#This script computes the data of the alpha rarefaction curves (the depths
+#and iterations of diversity alpha_rarefaction) in a process pool and caches
+#it per depth, so extending the depth range, adding iterations or adding a
+#metadata column only computes the points that are missing.
+#Every point (depth, iteration) is rarefied with the seed
+#SeedSequence([seed, depth, iteration]) (rarefy and the alpha metrics of
+#Step7 rarefaction_replicates.py), so a point has the same value no matter
+#when or in which worker it is computed. The cache lives in
+#.rarefaction_cache/<key>/, with the key built from the table and tree
+#artifacts and the seed; one .npz per depth holds an iterations x samples
+#array per metric.
+#The .qzv is still written by the alpha_rarefaction action: its internal
+#computation of the rarefaction data is replaced by the cached data
+#(see precomputed_rarefaction_data).
+
+#Libraries
+import contextlib
+import hashlib
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Additional_Scripts'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Step7_PhylogeneticTree'))
+from pipeline_cache import input_fingerprint
+from qza_io import read_table
+from beta_engine import read_tree, tree_layout
+from rarefaction_replicates import alpha_diversity, rarefy
+
+
+# paths and names
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".rarefaction_cache")
+N_THREADS = int(os.environ.get("N_THREADS", 0)) # 0 = all available cores
+
+# Defaults of diversity alpha_rarefaction
+MIN_DEPTH = 1
+STEPS = 10
+ITERATIONS = 10
+METRICS = ['observed_features', 'shannon']
+PHYLOGENETIC_METRICS = ['faith_pd']
+
+# Column names of the rarefaction data expected by the alpha_rarefaction visualizer
+DEPTH_COLUMN = '_alpha_rarefaction_depth_column_'
+ITERATION_COLUMN = 'iter'
+
+# Loaded data of the worker processes (set once per worker by _init_worker)
+_matrix = None
+_totals = None
+_layout = None
+
+
+def depth_range(min_depth: int, max_depth: int, steps: int) -> list:
+    '''Returns the rarefaction depths, spaced like those of alpha_rarefaction.'''
+    return [int(depth) for depth in np.linspace(min_depth, max_depth, num=steps, dtype=int)]
+
+
+def cache_key(table_fp: str, tree_fp: str, seed: int) -> str:
+    '''Returns the cache key of a table, tree and seed (the artifact UUIDs, or content hashes).'''
+    fingerprint = '\n'.join([input_fingerprint(table_fp),
+                             input_fingerprint(tree_fp) if tree_fp else 'no-tree', str(seed)])
+    return hashlib.sha256(fingerprint.encode()).hexdigest()[:16]
+
+
+def _init_worker(matrix: sp.csc_matrix, layout: tuple) -> None:
+    global _matrix, _totals, _layout
+    _matrix, _layout = matrix, layout
+    _totals = np.asarray(matrix.sum(axis=0)).ravel()
+
+
+def compute_point(seed: int, depth: int, iteration: int, metrics: list) -> dict:
+    '''Rarefies the table at one depth and computes the metrics (NaN for samples with fewer reads).'''
+    rng = np.random.default_rng(np.random.SeedSequence([seed, depth, iteration]))
+    kept = np.flatnonzero(_totals >= depth)
+    values = alpha_diversity(rarefy(_matrix[:, kept], depth, rng), _layout, metrics)
+    results = {}
+    for metric, vector in values.items():
+        results[metric] = np.full(_matrix.shape[1], np.nan)
+        results[metric][kept] = vector
+    return results
+
+
+class DepthCache:
+    '''Rarefaction results per depth: one .npz with an iterations x samples array per metric.'''
+
+    def __init__(self, key: str, sample_ids, cache_dir: str = CACHE_DIR):
+        self.dir = os.path.join(cache_dir, key)
+        self.sample_ids = np.asarray(sample_ids, dtype=str)
+
+    def _fp(self, depth: int) -> str:
+        return os.path.join(self.dir, f"depth_{depth}.npz")
+
+    def load(self, depth: int) -> dict:
+        '''Returns the cached arrays of a depth (empty if nothing is cached).'''
+        try:
+            with np.load(self._fp(depth)) as npz:
+                if not np.array_equal(npz['sample_ids'], self.sample_ids):
+                    return {}
+                return {name: npz[name] for name in npz.files if name != 'sample_ids'}
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            return {}
+
+    def save(self, depth: int, arrays: dict) -> None:
+        os.makedirs(self.dir, exist_ok=True)
+        tmp_fp = self._fp(depth) + '.tmp.npz'
+        np.savez(tmp_fp, sample_ids=self.sample_ids, **arrays)
+        os.replace(tmp_fp, self._fp(depth))
+
+
+def rarefaction_data(table_fp: str, tree_fp: str = None, max_depth: int = None, min_depth: int = MIN_DEPTH,
+                     steps: int = STEPS, iterations: int = ITERATIONS, metrics: list = None, seed: int = 0,
+                     n_workers: int = N_THREADS, cache_dir: str = CACHE_DIR) -> dict:
+    '''
+    Computes (or loads from the cache) the alpha diversity of every depth and iteration.
+        Parameters:
+        ----------
+        table_fp : str
+            FeatureTable[Frequency] .qza
+        tree_fp : str
+            Phylogeny[Rooted] .qza (None without phylogenetic metrics)
+        max_depth, min_depth, steps : int
+            Depth range (as in alpha_rarefaction)
+        iterations : int
+            Rarefied tables per depth
+        metrics : list
+            Alpha metrics (default: observed_features, shannon and faith_pd with a tree)
+        seed : int
+            Seed of the rarefactions
+        n_workers : int
+            Worker processes (0 = all available cores)
+        cache_dir : str
+            Directory of the per-depth cache
+        Returns:
+        -------
+        dict
+            pd.DataFrame per metric (samples x (depth, iteration)), like the
+            rarefaction data of the alpha_rarefaction visualizer
+    '''
+    metrics = metrics or METRICS + (PHYLOGENETIC_METRICS if tree_fp else [])
+    matrix, feature_ids, sample_ids = read_table(table_fp)
+    totals = np.asarray(matrix.sum(axis=0)).ravel()
+    if max_depth is None or max_depth <= min_depth:
+        raise ValueError(f"max_depth ({max_depth}) must be greater than min_depth ({min_depth})")
+    if max_depth > totals.max():
+        raise ValueError(f"max_depth ({max_depth}) is greater than the largest sample frequency ({int(totals.max())})")
+    layout = tree_layout(read_tree(tree_fp), feature_ids) if tree_fp else None
+    if layout is None and set(metrics) & set(PHYLOGENETIC_METRICS):
+        raise ValueError("phylogenetic metrics need a tree")
+
+    cache = DepthCache(cache_key(table_fp, tree_fp, seed), sample_ids, cache_dir)
+    depths = depth_range(min_depth, max_depth, steps)
+    cached = {depth: cache.load(depth) for depth in depths}
+
+    # Missing points: (depth, iteration) with the metrics not cached for that iteration
+    tasks = []
+    for depth in depths:
+        for iteration in range(1, iterations + 1):
+            missing = [metric for metric in metrics
+                       if metric not in cached[depth] or len(cached[depth][metric]) < iteration]
+            if missing:
+                tasks.append((depth, iteration, missing))
+    print(f"{len(depths) * iterations - len(tasks)} of {len(depths) * iterations} points cached, computing {len(tasks)}...")
+
+    if tasks:
+        n_workers = max(1, min(n_workers or os.cpu_count(), len(tasks)))
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(sp.csc_matrix(matrix), layout)) as executor:
+            futures = [executor.submit(compute_point, seed, depth, iteration, missing)
+                       for depth, iteration, missing in tasks]
+            for (depth, iteration, _), future in zip(tasks, futures):
+                for metric, values in future.result().items():
+                    arrays = cached[depth]
+                    known = arrays.get(metric, np.empty((0, len(sample_ids))))
+                    if len(known) < iteration:
+                        known = np.vstack([known, np.full((iteration - len(known), len(sample_ids)), np.nan)])
+                    known[iteration - 1] = values
+                    arrays[metric] = known
+        for depth in {depth for depth, _, _ in tasks}:
+            cache.save(depth, cached[depth])
+
+    columns = pd.MultiIndex.from_product([depths, list(range(1, iterations + 1))],
+                                         names=[DEPTH_COLUMN, ITERATION_COLUMN])
+    return {metric: pd.DataFrame(np.column_stack([cached[depth][metric][iteration - 1]
+                                                  for depth, iteration in columns]),
+                                 index=pd.Index(list(sample_ids)), columns=columns)
+            for metric in metrics}
+
+
+@contextlib.contextmanager
+def precomputed_rarefaction_data(data: dict):
+    '''
+    Makes the alpha_rarefaction visualizer use precomputed rarefaction data
+    instead of rarefying the table itself. Yields False (and changes nothing)
+    if the installed q2-diversity has no _compute_rarefaction_data.
+    '''
+    try:
+        from q2_diversity._alpha import _visualizer
+    except ImportError:
+        yield False
+        return
+    original = getattr(_visualizer, '_compute_rarefaction_data', None)
+    if original is None:
+        yield False
+        return
+
+    def compute_rarefaction_data(feature_table, *args, **kwargs):
+        return {metric: values.reindex(list(feature_table.ids(axis='sample'))) for metric, values in data.items()}
+
+    _visualizer._compute_rarefaction_data = compute_rarefaction_data
+    try:
+        yield True
+    finally:
+        _visualizer._compute_rarefaction_data = original
@@ -4,18 +4,20 @@
 ### Script for Taxonomic Analysis
 
 # Libraries
-from qiime2 import Artifact
-from qiime2 import Metadata
 import qiime2.plugins.feature_classifier.actions as feature_classifier_actions
 import qiime2.plugins.taxa.actions as taxa_actions
 
 import os
+import sys
 from urllib.request import urlretrieve # Used for downloading the classifier file
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Additional_Scripts'))
+from artifact_cache import load_artifact, load_metadata
+
 
 # Paths and Names
 READS = os.path.join("../", "Step4_QCFeatureTableConstruction/", "rep-seqs.qza")
-METADATA = os.path.join("../", "Data/", "metadata_for_q.csv")
+METADATA = os.path.join("../", "Data/", "metadata.tsv")
 TABLE = os.path.join("../", "Step6_Decontamination/", "filtered-table.qza")
 
 CLASSIFIER_FN = "2024.09.backbone.v4.nb.sklearn-1.4.2.qza"
@@ -23,6 +25,9 @@ CLASSIFIER_URL = "https://data.qiime2.org/classifiers/sklearn-1.4.2/greengenes2/
 
 
 OUTPUT_TAXONOMY = "taxonomy.qza"
+# Parallel jobs for classify_sklearn (one classifier copy in memory per job), raised by the
+# pipeline runner within its core budget; 0 = all available cores
+N_THREADS = int(os.environ.get("N_THREADS", 1))
 OUTPUT_TAXONOMY_VIZ = "taxonomy_barplot.qzv"
 # Getting classifier from URL
 
@@ -50,10 +55,10 @@ print("=============================================")
 
 print("Loading artifacts...")
 try:
-    classifier = Artifact.load("2024.09.backbone.v4.nb.sklearn-1.4.2.qza")
-    reads_artifact = Artifact.load(READS)
-    table_artifact = Artifact.load(TABLE)
-    metadata = Metadata.load(METADATA)
+    classifier = load_artifact(CLASSIFIER_FN, disk=False) # multi-GB, not kept in the on-disk cache
+    reads_artifact = load_artifact(READS)
+    table_artifact = load_artifact(TABLE)
+    metadata = load_metadata(METADATA)
     
 except Exception as e:
     print(f"An error occurred while loading artifacts: {e}")
@@ -65,6 +70,7 @@ try:
     taxonomy, = feature_classifier_actions.classify_sklearn(
         classifier=classifier,
         reads=reads_artifact,
+        n_jobs=N_THREADS if N_THREADS > 0 else -1,
     )
     taxonomy.save(OUTPUT_TAXONOMY)
 